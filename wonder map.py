@@ -2,12 +2,31 @@ import os
 import re
 import uuid
 import requests
-from flask import Flask, jsonify, request
+from requests.adapters import HTTPAdapter
+from flask import Flask, Response, g, jsonify, request, stream_with_context
 import firebase_admin
 from firebase_admin import credentials, firestore, auth, storage
 from firebase_admin import firestore as admin_firestore
 from firebase_admin.exceptions import FirebaseError
+from google.api_core.exceptions import FailedPrecondition
+import base64
+import bisect
+import contextlib
 import datetime
+import functools
+import gzip
+import hashlib
+import heapq
+import io
+import json
+import math
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from urllib.parse import unquote, urlparse
 from firebase_admin import auth as admin_auth
 
 # ===== Flask & CORS =====
@@ -17,6 +36,20 @@ try:
 except Exception:
     _has_cors = False
 
+# ===== NumPy（可選：行程可行性向量化計算）=====
+try:
+    import numpy as np
+    _has_numpy = True
+except Exception:
+    _has_numpy = False
+
+# ===== Pillow（可選：照片縮圖 / 轉檔；沒裝就照原檔上傳）=====
+try:
+    from PIL import Image, ImageOps
+    _has_pil = True
+except Exception:
+    _has_pil = False
+
 app = Flask(__name__)
 if _has_cors:
     CORS(app)
@@ -37,6 +70,178 @@ if not firebase_admin._apps:
 db = firestore.client()
 bucket = storage.bucket()
 
+# ===== 對外 HTTP（Gemini / Places 共用連線池） =====
+HTTP_RETRY_STATUS = {429, 500, 502, 503, 504}
+HTTP_IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+HTTP_BACKOFF_BASE_SEC = 0.5
+HTTP_BACKOFF_MAX_SEC = 8.0
+HTTP_LATENCY_BUCKETS_MS = [50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000]
+
+_http_session = requests.Session()
+_http_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32)  # 每個 host 一個 pool，keep-alive 重用
+_http_session.mount("https://", _http_adapter)
+_http_session.mount("http://", _http_adapter)
+
+
+class UpstreamUnavailable(RuntimeError):
+    pass
+
+
+class Upstream:
+    def __init__(self, name: str, max_concurrency: int, max_retries: int,
+                 breaker_threshold: int = 5, breaker_cooldown_sec: float = 30.0):
+        self.name = name
+        self.max_retries = max_retries
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown_sec = breaker_cooldown_sec
+        self._sem = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = 0.0
+        self._buckets = [0] * (len(HTTP_LATENCY_BUCKETS_MS) + 1)
+        self._count = 0
+        self._sum_ms = 0.0
+        self._retries = 0
+        self._rejected = 0
+
+    # ----- circuit breaker -----
+    def _allow(self) -> bool:
+        with self._lock:
+            if self._failures < self.breaker_threshold:
+                return True
+            # 冷卻時間過了放一個請求試試看（half-open）
+            if time.time() - self._opened_at >= self.breaker_cooldown_sec:
+                self._opened_at = time.time()
+                return True
+            self._rejected += 1
+            return False
+
+    def _record_result(self, ok: bool):
+        with self._lock:
+            if ok:
+                self._failures = 0
+            else:
+                self._failures += 1
+                if self._failures >= self.breaker_threshold:
+                    self._opened_at = time.time()
+
+    def _observe(self, ms: float):
+        i = 0
+        while i < len(HTTP_LATENCY_BUCKETS_MS) and ms > HTTP_LATENCY_BUCKETS_MS[i]:
+            i += 1
+        with self._lock:
+            self._buckets[i] += 1
+            self._count += 1
+            self._sum_ms += ms
+
+    def stats(self) -> dict:
+        with self._lock:
+            labels = [f"le_{b}" for b in HTTP_LATENCY_BUCKETS_MS] + ["le_inf"]
+            return {
+                "count": self._count,
+                "avgMs": round(self._sum_ms / self._count, 1) if self._count else 0.0,
+                "histogramMs": dict(zip(labels, self._buckets)),
+                "retries": self._retries,
+                "rejected": self._rejected,
+                "circuitOpen": self._failures >= self.breaker_threshold,
+            }
+
+
+def _retry_delay(attempt: int, resp=None) -> float:
+    if resp is not None:
+        ra = (resp.headers.get("Retry-After") or "").strip()
+        if ra.isdigit():
+            return min(float(ra), HTTP_BACKOFF_MAX_SEC)
+    # full jitter
+    return random.uniform(0, min(HTTP_BACKOFF_MAX_SEC, HTTP_BACKOFF_BASE_SEC * (2 ** attempt)))
+
+
+def http_request(up: Upstream, method: str, url: str, timeout: float, _hold_slot: bool = False, **kwargs):
+    """
+    共用 session 打外部 API：429/5xx/連線錯誤會退避重試（尊重 Retry-After）
+    回傳最後一次的 Response；重試用完仍是連線錯誤就丟出例外
+    非冪等的請求（POST）讀取逾時不重試：server 可能已經在算了，再送一次只會讓最壞延遲翻倍
+    _hold_slot=True 時成功的 response 不放 semaphore、不記斷路器結果，交給 http_stream 收尾
+    """
+    if not up._allow():
+        raise UpstreamUnavailable(f"{up.name} circuit open")
+
+    if not up._sem.acquire(timeout=timeout):
+        raise UpstreamUnavailable(f"{up.name} too many concurrent requests")
+    held = False
+    try:
+        attempt = 0
+        while True:
+            t0 = time.perf_counter()
+            try:
+                r = _http_session.request(method, url, timeout=timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                up._observe((time.perf_counter() - t0) * 1000)
+                no_retry = isinstance(e, requests.ReadTimeout) and method.upper() not in HTTP_IDEMPOTENT_METHODS
+                if no_retry or attempt >= up.max_retries:
+                    up._record_result(False)
+                    raise
+                time.sleep(_retry_delay(attempt))
+            else:
+                up._observe((time.perf_counter() - t0) * 1000)
+                if r.status_code not in HTTP_RETRY_STATUS:
+                    if _hold_slot and r.status_code < 400:
+                        held = True
+                        return r
+                    up._record_result(r.status_code < 500)
+                    return r
+                if attempt >= up.max_retries:
+                    up._record_result(False)
+                    return r
+                delay = _retry_delay(attempt, r)
+                # 要重試的 response 先還回連線池（stream=True 時不 close 會一直佔著連線）
+                r.close()
+                time.sleep(delay)
+
+            attempt += 1
+            with up._lock:
+                up._retries += 1
+    finally:
+        if not held:
+            up._sem.release()
+
+
+@contextlib.contextmanager
+def http_stream(up: Upstream, method: str, url: str, timeout: float, **kwargs):
+    """
+    stream=True 版的 http_request：併發名額一直佔到 body 讀完（或放棄）才放
+    body 讀到一半斷線 / 逾時也會記進斷路器；client 自己中途離開不算上游失敗
+    """
+    r = http_request(up, method, url, timeout, _hold_slot=True, stream=True, **kwargs)
+    if r.status_code >= 400:
+        # 錯誤 response 在 http_request 裡已經記過結果、放過名額
+        with r:
+            yield r
+        return
+
+    ok = True
+    try:
+        with r:
+            yield r
+    except requests.RequestException:
+        ok = False
+        raise
+    finally:
+        up._record_result(ok)
+        up._sem.release()
+
+
+UPSTREAM_GEMINI = Upstream("gemini", max_concurrency=8, max_retries=2)
+UPSTREAM_PLACES = Upstream("places", max_concurrency=16, max_retries=2)
+
+GEMINI_TIMEOUT_SEC = 60
+# 一次 call_gemini 最久會卡多久：排隊拿 semaphore + 每次嘗試的 timeout + 每次退避上限
+GEMINI_MAX_CALL_SEC = (
+    GEMINI_TIMEOUT_SEC * (UPSTREAM_GEMINI.max_retries + 2)
+    + HTTP_BACKOFF_MAX_SEC * UPSTREAM_GEMINI.max_retries
+)
+
+
 ## ===== Gemini AI 設定 =====
 GEMINI_MODEL = "models/gemini-2.0-flash"  
 
@@ -44,7 +249,9 @@ def get_gemini_api_key() -> str:
     """每次呼叫都從環境變數讀取，避免 reloader/ngrok/子程序拿不到"""
     return (os.environ.get("GEMINI_API_KEY") or "").strip()
 
-def call_gemini(prompt: str) -> str:
+GEMINI_EMPTY_TEXT = "（AI 沒有回覆內容）"
+
+def _call_gemini_uncached(prompt: str) -> str:
     api_key = get_gemini_api_key()
     if not api_key:
         raise RuntimeError("GEMINI_API_KEY is not set")
@@ -56,7 +263,7 @@ def call_gemini(prompt: str) -> str:
         ]
     }
 
-    r = requests.post(url, json=payload, timeout=60)
+    r = http_request(UPSTREAM_GEMINI, "POST", url, timeout=GEMINI_TIMEOUT_SEC, json=payload)
 
     # 印出 Google 回的錯誤 body（很重要）
     if r.status_code >= 400:
@@ -66,16 +273,307 @@ def call_gemini(prompt: str) -> str:
     try:
         return data["candidates"][0]["content"]["parts"][0]["text"]
     except Exception:
-        return "（AI 沒有回覆內容）"
-    
+        return GEMINI_EMPTY_TEXT
+
+
+# ===== Gemini 回應快取（記憶體 LRU + 可選 SQLite） =====
+GEMINI_CACHE_TTL_SEC = int(os.environ.get("GEMINI_CACHE_TTL_SEC") or 3600)
+GEMINI_CACHE_MAX_ITEMS = int(os.environ.get("GEMINI_CACHE_MAX_ITEMS") or 1000)
+GEMINI_CACHE_DB = (os.environ.get("GEMINI_CACHE_DB") or "").strip()  # 空字串 = 不開磁碟層
+
+
+def normalize_prompt(prompt: str) -> str:
+    """去掉每行頭尾空白、合併連續空白與空行，避免排版差異打不中快取"""
+    lines = [re.sub(r"[ \t\u3000]+", " ", ln).strip() for ln in (prompt or "").splitlines()]
+    return "\n".join(ln for ln in lines if ln)
+
+
+class _InFlight:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class GeminiResponseCache:
+    def __init__(self, ttl_sec: int, max_items: int, db_path: str = ""):
+        self.ttl_sec = ttl_sec
+        self.max_items = max_items
+        self._lock = threading.Lock()
+        self._mem = OrderedDict()  # key -> (expires_at, text)
+        self._inflight = {}
+        self.stats = {"hits": 0, "diskHits": 0, "misses": 0, "coalesced": 0, "errors": 0}
+
+        self._db = None
+        self._db_lock = threading.Lock()
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS gemini_cache ("
+                " key TEXT PRIMARY KEY, text TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._db.commit()
+
+    @staticmethod
+    def make_key(model: str, prompt: str) -> str:
+        h = hashlib.sha256(normalize_prompt(prompt).encode("utf-8")).hexdigest()
+        return f"{model}:{h}"
+
+    # ----- 記憶體層 -----
+    def _mem_get(self, key: str, now: float):
+        item = self._mem.get(key)
+        if item is None:
+            return None
+        if item[0] < now:
+            del self._mem[key]
+            return None
+        self._mem.move_to_end(key)
+        return item[1]
+
+    def _mem_put(self, key: str, text: str, expires_at: float):
+        self._mem[key] = (expires_at, text)
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_items:
+            self._mem.popitem(last=False)
+
+    # ----- 磁碟層 -----
+    def _disk_get(self, key: str, now: float):
+        if self._db is None:
+            return None
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT text, expires_at FROM gemini_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row and row[1] < now:
+                self._db.execute("DELETE FROM gemini_cache WHERE key = ?", (key,))
+                self._db.commit()
+                return None
+        return row
+
+    def _disk_put(self, key: str, text: str, expires_at: float):
+        if self._db is None:
+            return
+        with self._db_lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO gemini_cache (key, text, expires_at) VALUES (?, ?, ?)",
+                (key, text, expires_at)
+            )
+            self._db.commit()
+
+    def _lookup(self, key: str):
+        now = time.time()
+        with self._lock:
+            text = self._mem_get(key, now)
+            if text is not None:
+                self.stats["hits"] += 1
+                return text
+
+        row = self._disk_get(key, now)
+        if row:
+            with self._lock:
+                self._mem_put(key, row[0], row[1])
+                self.stats["diskHits"] += 1
+            return row[0]
+        return None
+
+    def _store(self, key: str, text: str):
+        # 空回覆不快取，下次再試
+        if not text or not text.strip() or text == GEMINI_EMPTY_TEXT:
+            return
+        expires_at = time.time() + self.ttl_sec
+        with self._lock:
+            self._mem_put(key, text, expires_at)
+        self._disk_put(key, text, expires_at)
+
+    def lookup(self, model: str, prompt: str):
+        """只查快取，不打 Gemini（串流模式用）"""
+        return self._lookup(self.make_key(model, prompt))
+
+    def store(self, model: str, prompt: str, text: str):
+        self._store(self.make_key(model, prompt), text)
+
+    def get_or_call(self, model: str, prompt: str, fn) -> str:
+        key = self.make_key(model, prompt)
+        text = self._lookup(key)
+        if text is not None:
+            return text
+
+        # 同一個 prompt 同時只打一次 Gemini，其他人等結果
+        with self._lock:
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = _InFlight()
+                self._inflight[key] = flight
+                self.stats["misses"] += 1
+            else:
+                self.stats["coalesced"] += 1
+
+        if not leader:
+            # 等的時間要蓋過 leader 最壞的情況，不然 leader 還在正常重試，follower 就先放棄了
+            if not flight.event.wait(timeout=GEMINI_MAX_CALL_SEC):
+                raise RuntimeError("Gemini request timed out (waiting for in-flight call)")
+            if flight.error is not None:
+                raise RuntimeError(str(flight.error))
+            return flight.result
+
+        try:
+            text = fn(prompt)
+            flight.result = text
+            self._store(key, text)
+            return text
+        except Exception as e:
+            flight.error = e
+            with self._lock:
+                self.stats["errors"] += 1
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.event.set()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            out = dict(self.stats)
+            out["memoryItems"] = len(self._mem)
+            out["inFlight"] = len(self._inflight)
+        out["diskEnabled"] = self._db is not None
+        out["ttlSec"] = self.ttl_sec
+        return out
+
+
+gemini_cache = GeminiResponseCache(GEMINI_CACHE_TTL_SEC, GEMINI_CACHE_MAX_ITEMS, GEMINI_CACHE_DB)
+
+
+def call_gemini(prompt: str, use_cache: bool = True) -> str:
+    if not use_cache:
+        return _call_gemini_uncached(prompt)
+    return gemini_cache.get_or_call(GEMINI_MODEL, prompt, _call_gemini_uncached)
+
+
+def stream_gemini(prompt: str, use_cache: bool = True):
+    """
+    streamGenerateContent（alt=sse）：一段一段 yield 文字
+    快取有就一次吐完整段；串完才寫進快取（中途斷掉不寫）
+    """
+    if use_cache:
+        cached = gemini_cache.lookup(GEMINI_MODEL, prompt)
+        if cached is not None:
+            yield cached
+            return
+
+    api_key = get_gemini_api_key()
+    if not api_key:
+        raise RuntimeError("GEMINI_API_KEY is not set")
+
+    url = f"https://generativelanguage.googleapis.com/v1beta/{GEMINI_MODEL}:streamGenerateContent?alt=sse&key={api_key}"
+    payload = {
+        "contents": [
+            {"role": "user", "parts": [{"text": prompt}]}
+        ]
+    }
+
+    # 併發名額佔到 body 收完；body 中途斷掉也算進斷路器
+    with http_stream(UPSTREAM_GEMINI, "POST", url, timeout=GEMINI_TIMEOUT_SEC, json=payload) as r:
+        # SSE 的 Content-Type 沒帶 charset，requests 會當成 ISO-8859-1，中文會變亂碼
+        r.encoding = "utf-8"
+        if r.status_code >= 400:
+            raise RuntimeError(f"Gemini HTTP {r.status_code}: {r.text}")
+
+        parts = []
+        for line in r.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data:"):
+                continue
+            try:
+                data = json.loads(line[5:].strip())
+                cand = (data.get("candidates") or [{}])[0]
+                chunk = "".join(p.get("text", "") for p in (cand.get("content") or {}).get("parts") or [])
+            except Exception:
+                continue
+            if chunk:
+                parts.append(chunk)
+                yield chunk
+
+    text = "".join(parts)
+    if not text:
+        yield GEMINI_EMPTY_TEXT
+    elif use_cache:
+        gemini_cache.store(GEMINI_MODEL, prompt, text)
+
+
+def stream_mode_of(data: dict):
+    """
+    body 的 stream：true / "sse" → SSE，"ndjson" → 每行一個 JSON；沒給就看 Accept header
+    回傳 "sse" / "ndjson" / None（照舊一次回完整 JSON）
+    """
+    mode = data.get("stream")
+    if mode is True or mode == "sse":
+        return "sse"
+    if mode == "ndjson":
+        return "ndjson"
+    accept = request.headers.get("Accept") or ""
+    if "text/event-stream" in accept:
+        return "sse"
+    if "application/x-ndjson" in accept:
+        return "ndjson"
+    return None
+
+
+def stream_text_response(chunks, mode: str, finish=None):
+    """
+    把文字片段轉成 SSE / NDJSON：
+      SSE    → data: {"delta": "..."}  …  event: done / data: {"text": 全文}
+      NDJSON → {"delta": "..."}  …  {"done": true, "text": 全文}
+    出錯時送一個 error 事件（header 已經送出去，沒辦法改 status code）
+    finish：全文的後處理（例如 strip），只影響最後的 text
+    """
+    def dump(obj):
+        return json.dumps(obj, ensure_ascii=False)
+
+    def gen():
+        parts = []
+        try:
+            for chunk in chunks:
+                parts.append(chunk)
+                if mode == "sse":
+                    yield f"data: {dump({'delta': chunk})}\n\n"
+                else:
+                    yield dump({"delta": chunk}) + "\n"
+        except Exception as e:
+            if mode == "sse":
+                yield f"event: error\ndata: {dump({'error': str(e)})}\n\n"
+            else:
+                yield dump({"error": str(e)}) + "\n"
+            return
+
+        text = "".join(parts)
+        if finish is not None:
+            text = finish(text)
+        if mode == "sse":
+            yield f"event: done\ndata: {dump({'text': text})}\n\n"
+        else:
+            yield dump({"done": True, "text": text}) + "\n"
+
+    mimetype = "text/event-stream" if mode == "sse" else "application/x-ndjson"
+    resp = Response(stream_with_context(gen()), mimetype=mimetype)
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"   # nginx / ngrok 不要整包緩衝
+    return resp
+
 WEEKDAY_MAP = {
     0: "週一", 1: "週二", 2: "週三",
     3: "週四", 4: "週五", 5: "週六", 6: "週日"
 }
 
+# "HH:mm" -> 分鐘 查表（常用路徑不用跑 regex）
+_HHMM_TABLE = {f"{h:02d}:{m:02d}": h * 60 + m for h in range(24) for m in range(60)}
+
 def parse_hhmm_to_minutes(hhmm: str):
     if not hhmm:
         return None
+    hit = _HHMM_TABLE.get(hhmm.strip())
+    if hit is not None:
+        return hit
     m = re.match(r"^(\d{2}):(\d{2})$", hhmm.strip())
     if not m:
         return None
@@ -85,33 +583,179 @@ def parse_hhmm_to_minutes(hhmm: str):
         return None
     return h * 60 + mm
 
-def is_likely_open(opening_hours: dict, visit_hhmm: str):
-    mins = parse_hhmm_to_minutes(visit_hhmm)
-    if mins is None:
-        return None
+# ===== 營業時間編譯（存的時候轉一次，之後查表）=====
+OPENING_HOURS_COMPILED_VERSION = 1
+DAY_MINUTES = 24 * 60
+WEEK_MINUTES = 7 * DAY_MINUTES
+TRIP_TZ = datetime.timezone(datetime.timedelta(minutes=int(os.environ.get("TRIP_TZ_OFFSET_MIN") or 480)))
 
-    weekday = WEEKDAY_MAP[datetime.datetime.now().weekday()]
-    wt = (opening_hours or {}).get("weekday_text") or []
-    line = next((x for x in wt if x.startswith(weekday)), None)
-    if not line:
-        return None
+_WEEKDAY_PREFIX = {v: k for k, v in WEEKDAY_MAP.items()}
+_OPEN_RANGE_RE = re.compile(r"(\d{1,2}):(\d{2})\s*[–-]\s*(\d{1,2}):(\d{2})")
 
-    if "休息" in line:
-        return False
-    if "24 小時" in line:
-        return True
 
-    ranges = re.findall(r"(\d{1,2}):(\d{2})\s*[–-]\s*(\d{1,2}):(\d{2})", line)
-    if not ranges:
+def _places_week_minute(point: dict):
+    """Places periods 的 {"day": 0(週日)~6, "time": "HHMM"} → 一週分鐘（週一 00:00 = 0）"""
+    try:
+        day = int(point.get("day"))
+        t = str(point.get("time") or "0000")
+        return ((day + 6) % 7) * DAY_MINUTES + int(t[:2]) * 60 + int(t[2:4])
+    except Exception:
         return None
 
-    for (sh, sm, eh, em) in ranges:
-        start = int(sh) * 60 + int(sm)
-        end = int(eh) * 60 + int(em)
-        if start <= mins <= end:
-            return True
 
-    return False
+def _merge_week_intervals(raw: list) -> list:
+    """[(start, end)] → 排序、合併、跨週拆段後攤平成 [s0, e0, s1, e1, ...]"""
+    parts = []
+    for start, end in raw:
+        start %= WEEK_MINUTES
+        end = start + min(end - start, WEEK_MINUTES)   # 呼叫端保證 end > start
+        if end > WEEK_MINUTES:
+            parts.append((start, WEEK_MINUTES))
+            parts.append((0, end - WEEK_MINUTES))
+        else:
+            parts.append((start, end))
+    parts.sort()
+
+    merged = []
+    for start, end in parts:
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [x for pair in merged for x in pair]
+
+
+def compile_opening_hours(oh):
+    """
+    Places opening_hours → {"v": 版本, "known": 有資料的星期 bitmask（bit0 = 週一）, "iv": [s0, e0, ...]}
+    iv 是一週分鐘的半開區間 [s, e)，已排序合併；跨午夜 / 跨週都已攤平
+    Firestore 不能存巢狀陣列，所以區間攤成一維
+    有 periods 就用 periods（最準）；只有 weekday_text（手動輸入）才解析文字
+    """
+    if not isinstance(oh, dict) or not oh:
+        return None
+
+    periods = oh.get("periods")
+    if isinstance(periods, list) and periods:
+        raw = []
+        for p in periods:
+            if not isinstance(p, dict):
+                continue
+            start = _places_week_minute(p.get("open") or {})
+            if start is None:
+                continue
+            if not p.get("close"):
+                # Places：只有 open、沒有 close = 24 小時全年無休
+                raw.append((0, WEEK_MINUTES))
+                continue
+            end = _places_week_minute(p["close"])
+            if end is None:
+                continue
+            if end <= start:
+                end += WEEK_MINUTES
+            raw.append((start, end))
+        if raw:
+            return {"v": OPENING_HOURS_COMPILED_VERSION, "known": 0b1111111, "iv": _merge_week_intervals(raw)}
+
+    known = 0
+    raw = []
+    for line in oh.get("weekday_text") or []:
+        line = str(line).strip()
+        wd = next((d for prefix, d in _WEEKDAY_PREFIX.items() if line.startswith(prefix)), None)
+        if wd is None:
+            continue
+        base = wd * DAY_MINUTES
+        if "休息" in line:
+            known |= 1 << wd
+            continue
+        if "24 小時" in line:
+            known |= 1 << wd
+            raw.append((base, base + DAY_MINUTES))
+            continue
+        ranges = _OPEN_RANGE_RE.findall(line)
+        if not ranges:
+            continue
+        known |= 1 << wd
+        for sh, sm, eh, em in ranges:
+            start = base + int(sh) * 60 + int(sm)
+            end = base + int(eh) * 60 + int(em)
+            if end <= start:
+                end += DAY_MINUTES   # 例如 18:00–02:00
+            raw.append((start, end))
+
+    if not known:
+        return None
+    return {"v": OPENING_HOURS_COMPILED_VERSION, "known": known, "iv": _merge_week_intervals(raw)}
+
+
+def stop_opening_compiled(s: dict):
+    """stop 上存好的編譯結果（版本對才用），舊資料就現場編譯並留在 s 裡"""
+    c = s.get("openingHoursCompiled")
+    if isinstance(c, dict) and c.get("v") == OPENING_HOURS_COMPILED_VERSION and isinstance(c.get("iv"), list):
+        return c
+    c = compile_opening_hours(s.get("openingHours"))
+    s["openingHoursCompiled"] = c
+    return c
+
+
+def with_compiled_opening_hours(fields: dict) -> dict:
+    """寫入 openingHours 時順便存編譯結果"""
+    if "openingHours" in fields:
+        fields["openingHoursCompiled"] = compile_opening_hours(fields["openingHours"])
+    return fields
+
+
+def opening_state_at(compiled, weekday: int, minute: int):
+    """回傳 (是否營業 True/False/None, 距離打烊分鐘；24 小時或不知道為 None)"""
+    if not compiled:
+        return None, None
+    iv = compiled.get("iv") or []
+    t = weekday * DAY_MINUTES + minute
+    i = bisect.bisect_right(iv, t)
+    if i % 2 == 0:
+        # 不在任何區間：那天有資料才算「沒開」，否則不知道
+        return (False if (compiled.get("known", 0) >> weekday) & 1 else None), None
+    if iv == [0, WEEK_MINUTES]:
+        return True, None
+    until = iv[i] - t
+    # 週日晚上開到週一凌晨：接上開頭那段
+    if iv[i] == WEEK_MINUTES and iv[0] == 0:
+        until += iv[1]
+    return True, until
+
+
+def trip_day_weekday(trip: dict, day: int) -> int:
+    """行程第 day 天是星期幾（0 = 週一）；trip 沒有 startDate 就用今天"""
+    start = (trip or {}).get("startDate")
+    if isinstance(start, datetime.datetime):
+        if start.tzinfo is None:
+            start = start.replace(tzinfo=datetime.timezone.utc)
+        d = start.astimezone(TRIP_TZ).date() + datetime.timedelta(days=max(1, day) - 1)
+        return d.weekday()
+    return datetime.datetime.now(TRIP_TZ).weekday()
+
+
+def evaluate_opening_batch(stops: list, weekday: int) -> list:
+    """
+    整天 stops 一次判斷：開始時間有沒有營業、還有多久打烊、停留中會不會打烊
+    回傳 [{"stopId", "open", "minutesUntilClose", "closesBeforeEnd"}]（跟 stops 同順序）
+    """
+    out = []
+    for s in stops:
+        compiled = stop_opening_compiled(s)
+        st = parse_hhmm_to_minutes((s.get("startTime") or "").strip())
+        et = parse_hhmm_to_minutes((s.get("endTime") or "").strip())
+        state, until = (None, None) if st is None else opening_state_at(compiled, weekday, st)
+        closes_before_end = None
+        if state is True and et is not None and et > st:
+            closes_before_end = until is not None and until < et - st
+        out.append({
+            "stopId": s.get("_id"),
+            "open": state,
+            "minutesUntilClose": until,
+            "closesBeforeEnd": closes_before_end,
+        })
+    return out
 
 def minutes_to_hhmm(mins: int) -> str:
     mins = mins % (24 * 60)
@@ -145,112 +789,957 @@ def sort_key_for_stop(stop: dict):
         (stop.get("name") or "")
     )
 
-def get_next_stop_info(trip_id: str, day: int, stop_id: str):
-    """
-    回傳：(next_stop_dict_or_none, dist_m, travel_min, late_flag, travel_hint_text)
-    late_flag: True / False / None(資料不足)
-    """
-    try:
-        col = db.collection("trips").document(trip_id).collection("days").document(str(day)).collection("stops")
-        docs = col.get()
+def stop_order_key(stop: dict, fallback: tuple) -> tuple:
+    """有 order（批次編輯排過）就照 order，沒有的排在後面再照 fallback"""
+    order = stop.get("order")
+    if isinstance(order, int) and not isinstance(order, bool):
+        return (0, order)
+    return (1,) + tuple(fallback)
+
+def load_day_stops(trip_id: str, day: int) -> list:
+    """一次讀出某天所有 stop（含 _id），依時間排序（算兩站移動 / 遲到用；order 只管畫面顯示順序）"""
+    col = db.collection("trips").document(trip_id).collection("days").document(str(day)).collection("stops")
+    stops = []
+    for d in col.get():
+        s = d.to_dict() or {}
+        s["_id"] = d.id
+        stops.append(s)
+    stops.sort(key=sort_key_for_stop)
+    return stops
 
-        stops = []
-        for d in docs:
-            s = d.to_dict() or {}
-            s["_id"] = d.id
-            stops.append(s)
 
-        stops.sort(key=sort_key_for_stop)
+MISSING_COORD_HINT = "【移動/遲到判斷】缺少座標，無法計算兩站距離與移動時間。"
 
-        idx = next((i for i, s in enumerate(stops) if s.get("_id") == stop_id), -1)
-        if idx < 0 or idx >= len(stops) - 1:
-            return None, None, None, None, "【移動/遲到判斷】這是當天最後一站或找不到下一站，無法計算下一段移動時間。"
 
-        cur = stops[idx]
-        nxt = stops[idx + 1]
+def _has_coord(s: dict) -> bool:
+    return not (float(s.get("lat") or 0.0) == 0.0 and float(s.get("lng") or 0.0) == 0.0)
 
-        cur_lat = float(cur.get("lat") or 0.0)
-        cur_lng = float(cur.get("lng") or 0.0)
-        nxt_lat = float(nxt.get("lat") or 0.0)
-        nxt_lng = float(nxt.get("lng") or 0.0)
 
-        if (cur_lat == 0.0 and cur_lng == 0.0) or (nxt_lat == 0.0 and nxt_lng == 0.0):
-            return nxt, None, None, None, "【移動/遲到判斷】缺少座標，無法計算兩站距離與移動時間。"
+def _depart_src(s: dict) -> str:
+    # 出發時間：優先用本站 endTime，沒有就用 startTime
+    return (s.get("endTime") or s.get("startTime") or "").strip()
 
-        dist_m = haversine_meters(cur_lat, cur_lng, nxt_lat, nxt_lng)
-        travel_min = estimate_travel_minutes_by_distance(dist_m, mode="drive")
 
-        # 出發時間：優先用本站 endTime，沒有就用 startTime
-        depart_src = (cur.get("endTime") or cur.get("startTime") or "").strip()
-        next_start_src = (nxt.get("startTime") or "").strip()
-        depart_min = parse_hhmm_to_minutes(depart_src) if depart_src else None
-        next_start_min = parse_hhmm_to_minutes(next_start_src) if next_start_src else None
+def _leg_hint(cur: dict, nxt: dict, dist_m: float, travel_min: int):
+    """已知距離/車程，判斷是否遲到並組提示文字。回傳：(late_flag, hint)"""
+    depart_src = _depart_src(cur)
+    next_start_src = (nxt.get("startTime") or "").strip()
+    depart_min = parse_hhmm_to_minutes(depart_src) if depart_src else None
+    next_start_min = parse_hhmm_to_minutes(next_start_src) if next_start_src else None
 
-        km = dist_m / 1000.0
+    km = dist_m / 1000.0
 
-        if depart_min is None or next_start_min is None:
-            return nxt, dist_m, travel_min, None, (
-                f"【移動/遲到判斷】下一站「{(nxt.get('name') or '').strip() or '未命名地點'}」距離約 {km:.1f} km，"
-                f"預估移動 {travel_min} 分鐘（含緩衝）。但缺少完整時間（本站出發或下一站開始時間），無法判斷是否會遲到。"
+    if depart_min is None or next_start_min is None:
+        return None, (
+            f"【移動/遲到判斷】下一站「{(nxt.get('name') or '').strip() or '未命名地點'}」距離約 {km:.1f} km，"
+            f"預估移動 {travel_min} 分鐘（含緩衝）。但缺少完整時間（本站出發或下一站開始時間），無法判斷是否會遲到。"
+        )
+
+    arrive_min = depart_min + travel_min
+    late = arrive_min > next_start_min
+    next_name = (nxt.get("name") or "").strip() or "下一站"
+    base = f"【下一站】{next_name}｜約 {km:.1f} km｜車程約 {travel_min} 分（含緩衝）"
+
+    if late:
+        hint = (
+            f"{base} ⚠️ 可能趕不上："
+            f"{minutes_to_hhmm(depart_min)} 出發約 {minutes_to_hhmm(arrive_min)} 抵達，"
+            f"但行程安排為 {next_start_src}。"
             )
+    else:
+        hint = (
+            f"{base} ✅ 時間可行："
+            f"{minutes_to_hhmm(depart_min)} 出發約 {minutes_to_hhmm(arrive_min)} 抵達（{next_start_src}）。"
+        )
+
+    return late, hint
 
-        arrive_min = depart_min + travel_min
-        late = arrive_min > next_start_min
-        next_name = (nxt.get("name") or "").strip() or "下一站"
-        base = f"【下一站】{next_name}｜約 {km:.1f} km｜車程約 {travel_min} 分（含緩衝）"
 
-        
+LAST_STOP_HINT = "【移動/遲到判斷】這是當天最後一站或找不到下一站，無法計算下一段移動時間。"
 
-        if late:
-            hint = (
-                f"{base} ⚠️ 可能趕不上："
-                f"{minutes_to_hhmm(depart_min)} 出發約 {minutes_to_hhmm(arrive_min)} 抵達，"
-                f"但行程安排為 {next_start_src}。"
-                )
+
+# ===== 整天可行性（一次算完所有相鄰兩站）=====
+TRAVEL_MODES = ("walk", "transit", "drive")
+TRAVEL_SPEED_KMH = {"walk": 5.0, "transit": 18.0, "drive": 30.0}
+TRAVEL_BUFFER_MIN = {"walk": 3, "transit": 3, "drive": 8}
+
+
+def _none_where(values: list, ok: list) -> list:
+    return [v if k else None for v, k in zip(values, ok)]
+
+
+def compute_day_feasibility(stops: list, mode: str = "drive") -> dict:
+    """
+    stops 需已排序（load_day_stops）；回傳欄位式結果，每個 list 長度 n-1（第 i 段 = i -> i+1）
+    distanceM / travelMin(三種交通方式) / departMin / arriveMin / nextStartMin / slackMin / late
+    資料不足的位置是 None；有 NumPy 就整段向量化，沒有就逐段算（結果一樣）
+    """
+    if mode not in TRAVEL_MODES:
+        mode = "drive"
+
+    n = len(stops)
+    cols = {
+        "mode": mode,
+        "fromId": [s["_id"] for s in stops[:-1]],
+        "toId": [s["_id"] for s in stops[1:]],
+    }
+    if n < 2:
+        cols.update(distanceM=[], travelMin={m: [] for m in TRAVEL_MODES}, departMin=[],
+                    arriveMin=[], nextStartMin=[], slackMin=[], late=[])
+        return cols
+
+    lat = [float(s.get("lat") or 0.0) for s in stops]
+    lng = [float(s.get("lng") or 0.0) for s in stops]
+    depart = [parse_hhmm_to_minutes(_depart_src(s)) for s in stops[:-1]]
+    next_start = [parse_hhmm_to_minutes((s.get("startTime") or "").strip()) for s in stops[1:]]
+
+    if _has_numpy:
+        lat_a = np.asarray(lat)
+        lng_a = np.asarray(lng)
+        has = ~((lat_a == 0.0) & (lng_a == 0.0))
+        ok = has[:-1] & has[1:]
+
+        la = np.radians(lat_a)
+        ln = np.radians(lng_a)
+        dlat = la[1:] - la[:-1]
+        dlng = ln[1:] - ln[:-1]
+        a = np.sin(dlat / 2) ** 2 + np.cos(la[:-1]) * np.cos(la[1:]) * np.sin(dlng / 2) ** 2
+        dist = 6371000.0 * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+        travel = {
+            m: np.ceil((dist / 1000.0) / TRAVEL_SPEED_KMH[m] * 60.0) + TRAVEL_BUFFER_MIN[m]
+            for m in TRAVEL_MODES
+        }
+        dep = np.array([np.nan if v is None else v for v in depart], dtype=float)
+        nst = np.array([np.nan if v is None else v for v in next_start], dtype=float)
+        arrive = np.where(ok, dep + travel[mode], np.nan)
+        slack = nst - arrive
+
+        ok_l = ok.tolist()
+        t_ok = (~np.isnan(arrive)).tolist()
+        s_ok = (~np.isnan(slack)).tolist()
+        cols.update(
+            distanceM=_none_where(np.round(dist, 1).tolist(), ok_l),
+            travelMin={m: _none_where(travel[m].astype(np.int64).tolist(), ok_l) for m in TRAVEL_MODES},
+            departMin=depart,
+            arriveMin=_none_where(np.nan_to_num(arrive).astype(np.int64).tolist(), t_ok),
+            nextStartMin=next_start,
+            slackMin=_none_where(np.nan_to_num(slack).astype(np.int64).tolist(), s_ok),
+            late=_none_where((slack < 0).tolist(), s_ok),
+        )
+        return cols
+
+    dist = []
+    for i in range(n - 1):
+        if (lat[i] == 0.0 and lng[i] == 0.0) or (lat[i + 1] == 0.0 and lng[i + 1] == 0.0):
+            dist.append(None)
         else:
-            hint = (
-                f"{base} ✅ 時間可行："
-                f"{minutes_to_hhmm(depart_min)} 出發約 {minutes_to_hhmm(arrive_min)} 抵達（{next_start_src}）。"
-            )
+            dist.append(haversine_meters(lat[i], lng[i], lat[i + 1], lng[i + 1]))
+    travel = {
+        m: [estimate_travel_minutes_by_distance(d, mode=m) if d is not None else None for d in dist]
+        for m in TRAVEL_MODES
+    }
+    arrive = [d + t if d is not None and t is not None else None for d, t in zip(depart, travel[mode])]
+    slack = [b - a if a is not None and b is not None else None for a, b in zip(arrive, next_start)]
+    cols.update(
+        distanceM=[round(d, 1) if d is not None else None for d in dist],
+        travelMin=travel,
+        departMin=depart,
+        arriveMin=arrive,
+        nextStartMin=next_start,
+        slackMin=slack,
+        late=[(x < 0) if x is not None else None for x in slack],
+    )
+    return cols
 
-        return nxt, dist_m, travel_min, late, hint
 
-    except Exception as e:
-        return None, None, None, None, f"【移動/遲到判斷】計算失敗：{e}"
-    
+def feasibility_rows(cols: dict) -> list:
+    """欄位式結果轉成每段一筆（API 回傳用）"""
+    walk, transit, drive = (cols["travelMin"][m] for m in TRAVEL_MODES)
+    keys = ("fromId", "toId", "distanceM", "departMin", "arriveMin", "nextStartMin", "slackMin", "late")
+    rows = []
+    for i, vals in enumerate(zip(*(cols[k] for k in keys))):
+        row = dict(zip(keys, vals))
+        row["travelMin"] = {"walk": walk[i], "transit": transit[i], "drive": drive[i]}
+        rows.append(row)
+    return rows
+
+
+def compute_day_legs(stops: list, cols: dict = None) -> dict:
+    """
+    已排序的 stops 一次算完所有相鄰兩站（共用 compute_day_feasibility 的結果）
+    回傳：{stop_id: (next_stop_or_none, dist_m, travel_min, late_flag, hint)}
+    """
+    if cols is None:
+        cols = compute_day_feasibility(stops, mode="drive")
+
+    out = {}
+    for i, cur in enumerate(stops):
+        if i >= len(stops) - 1:
+            out[cur["_id"]] = (None, None, None, None, LAST_STOP_HINT)
+            continue
+        nxt = stops[i + 1]
+        dist_m = cols["distanceM"][i]
+        if dist_m is None:
+            out[cur["_id"]] = (nxt, None, None, None, MISSING_COORD_HINT)
+            continue
+        travel_min = cols["travelMin"]["drive"][i]
+        late, hint = _leg_hint(cur, nxt, dist_m, travel_min)
+        out[cur["_id"]] = (nxt, dist_m, travel_min, late, hint)
+    return out
+
+
+def bench_day_feasibility(n: int = 300, rounds: int = 200) -> float:
+    """本機量測：n 站的一天算一次要幾毫秒（python "wonder map.py" bench-feasibility）"""
+    rnd = random.Random(0)
+    stops = []
+    for i in range(n):
+        t = 8 * 60 + i
+        stops.append({
+            "_id": f"s{i}",
+            "lat": 25.0 + rnd.random() * 0.1,
+            "lng": 121.5 + rnd.random() * 0.1,
+            "startTime": minutes_to_hhmm(t),
+            "endTime": minutes_to_hhmm(t + 1),
+        })
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        compute_day_feasibility(stops)
+    return (time.perf_counter() - t0) / rounds * 1000.0
+
 
 PLACES_KEY = os.environ.get("GOOGLE_PLACES_API_KEY")
 
-def fetch_place_details(place_id: str):
+PLACES_NOT_FOUND_STATUS = {"NOT_FOUND", "ZERO_RESULTS", "INVALID_REQUEST"}
+
+
+def _fetch_place_details_raw(place_id: str, language: str = "zh-TW"):
+    """
+    回傳：(ok, result)
+    ok=False 代表暫時性錯誤（不要快取）；ok=True 且 result=None 代表查無資料（負快取）
+    """
     if not PLACES_KEY or not place_id:
-        return None
+        return False, None
 
     url = "https://maps.googleapis.com/maps/api/place/details/json"
     params = {
         "place_id": place_id,
         "fields": "opening_hours,current_opening_hours,name",
-        "language": "zh-TW",
+        "language": language,
         "key": PLACES_KEY
     }
 
-    r = requests.get(url, params=params, timeout=10)
+    try:
+        r = http_request(UPSTREAM_PLACES, "GET", url, timeout=10, params=params)
+    except Exception:
+        return False, None
     if r.status_code != 200:
-        return None
+        return False, None
 
     data = r.json()
-    return data.get("result")
+    status = data.get("status") or "OK"
+    if status in PLACES_NOT_FOUND_STATUS:
+        return True, None
+    if status != "OK":
+        return False, None
+    return True, (data.get("result") or None)
+
+
+def fetch_place_details(place_id: str, language: str = "zh-TW"):
+    ok, result = _fetch_place_details_raw(place_id, language)
+    return result if ok else None
+
+
+# ===== Places 詳細資料快取（記憶體 LRU + Firestore placeCache） =====
+PLACES_CACHE_TTL_SEC = int(os.environ.get("PLACES_CACHE_TTL_SEC") or 7 * 86400)
+PLACES_NEGATIVE_TTL_SEC = int(os.environ.get("PLACES_NEGATIVE_TTL_SEC") or 86400)
+PLACES_STALE_GRACE_SEC = int(os.environ.get("PLACES_STALE_GRACE_SEC") or 30 * 86400)
+PLACES_CACHE_MAX_ITEMS = 2000
+
+_places_lock = threading.Lock()
+_places_mem = OrderedDict()     # (place_id, lang) -> (fetched_at, found, result)
+_places_refreshing = set()
+_places_refresh_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="places-refresh")
+
+
+def _place_cache_doc_id(place_id: str, language: str) -> str:
+    return f"{place_id}_{language}".replace("/", "_")
+
+
+def _places_mem_put(key, entry):
+    with _places_lock:
+        _places_mem[key] = entry
+        _places_mem.move_to_end(key)
+        while len(_places_mem) > PLACES_CACHE_MAX_ITEMS:
+            _places_mem.popitem(last=False)
+
+
+def _refresh_place_details(place_id: str, language: str):
+    """打 Places 並寫回兩層快取；暫時性錯誤不覆蓋舊資料。回傳 entry 或 None"""
+    key = (place_id, language)
+    try:
+        ok, result = _fetch_place_details_raw(place_id, language)
+        if not ok:
+            return None
+        entry = (time.time(), result is not None, result)
+        _places_mem_put(key, entry)
+        try:
+            db.collection("placeCache").document(_place_cache_doc_id(place_id, language)).set({
+                "placeId": place_id,
+                "language": language,
+                "found": entry[1],
+                "result": result,
+                "fetchedAt": entry[0],
+            })
+        except Exception:
+            pass
+        return entry
+    finally:
+        with _places_lock:
+            _places_refreshing.discard(key)
+
+
+def get_place_details_cached(place_id: str, language: str = "zh-TW"):
+    """
+    TTL 內直接回快取；過期但還在寬限期就先回舊資料、背景更新（stale-while-revalidate）
+    查無資料也會快取（較短的 TTL），避免每次 AI 刷新都重打
+    """
+    if not place_id:
+        return None
+
+    key = (place_id, language)
+    with _places_lock:
+        entry = _places_mem.get(key)
+        if entry is not None:
+            _places_mem.move_to_end(key)
+
+    if entry is None:
+        try:
+            doc = db.collection("placeCache").document(_place_cache_doc_id(place_id, language)).get()
+            if doc.exists:
+                d = doc.to_dict() or {}
+                entry = (float(d.get("fetchedAt") or 0.0), bool(d.get("found")), d.get("result"))
+                _places_mem_put(key, entry)
+        except Exception:
+            entry = None
+
+    now = time.time()
+    if entry is not None:
+        fetched_at, found, result = entry
+        ttl = PLACES_CACHE_TTL_SEC if found else PLACES_NEGATIVE_TTL_SEC
+        age = now - fetched_at
+        if age < ttl:
+            return result
+        if found and age < ttl + PLACES_STALE_GRACE_SEC:
+            with _places_lock:
+                start_refresh = key not in _places_refreshing
+                _places_refreshing.add(key)
+            if start_refresh:
+                _places_refresh_executor.submit(_refresh_place_details, place_id, language)
+            return result
+
+    with _places_lock:
+        _places_refreshing.add(key)
+    fresh = _refresh_place_details(place_id, language)
+    if fresh is not None:
+        return fresh[2]
+    # Places 暫時失敗：有舊資料就先用
+    return entry[2] if entry is not None else None
+
+
+def fetch_place_opening_hours(place_id: str):
+    details = get_place_details_cached(place_id) or {}
+    return details.get("opening_hours") or details.get("current_opening_hours") or None
 
 
 print("GEMINI_API_KEY len =", len(get_gemini_api_key()))
 print("GEMINI_MODEL =", PLACES_KEY)
 
 
+# ===== Firestore 批次讀取 =====
+def get_docs_in_order(collection: str, ids, field_paths=None) -> dict:
+    """
+    用一次 get_all 批次讀取多筆文件（可指定欄位投影）
+    回傳：{doc_id: dict}，不存在的文件不會出現在結果裡
+    get_all 不保證回傳順序，呼叫端請用原本的 ids 順序走訪
+    """
+    col = db.collection(collection)
+    refs = []
+    seen = set()
+    for doc_id in ids or []:
+        if not isinstance(doc_id, str) or not doc_id or doc_id in seen:
+            continue
+        seen.add(doc_id)
+        refs.append(col.document(doc_id))
+
+    if not refs:
+        return {}
+
+    out = {}
+    for snap in db.get_all(refs, field_paths=field_paths):
+        if snap.exists:
+            out[snap.id] = snap.to_dict() or {}
+    return out
+
+
+# ===== 分頁（keyset：createdAt + doc id）/ ETag =====
+PAGE_TOKEN_HEADER = "X-Next-Page-Token"
+
+
+def _ts_micros(ts) -> int:
+    if not ts:
+        return 0
+    try:
+        return int(ts.timestamp()) * 1_000_000 + ts.microsecond
+    except Exception:
+        return 0
+
+
+def encode_page_token(ts, doc_id: str) -> str:
+    raw = f"{_ts_micros(ts)}|{doc_id}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_page_token(token: str):
+    """回傳 (createdAt datetime, doc_id, 排序鍵)；格式不對丟 ValueError"""
+    pad = "=" * (-len(token) % 4)
+    raw = base64.urlsafe_b64decode(token + pad).decode("utf-8")
+    us_s, doc_id = raw.split("|", 1)
+    us = int(us_s)
+    if not doc_id:
+        raise ValueError("empty doc id")
+    dt = datetime.datetime.fromtimestamp(us // 1_000_000, tz=datetime.timezone.utc) \
+        + datetime.timedelta(microseconds=us % 1_000_000)
+    return dt, doc_id, (us, doc_id)
+
+
+def keyset_page(col, base_q, fields: list, page_token: str = None, limit: int = None):
+    """
+    依 createdAt DESC, doc id DESC 取一頁（只讀 fields 欄位）
+    回傳：(docs, next_page_token)
+    沒有複合索引時 Firestore 會丟 FailedPrecondition → 退回全讀 + Python 排序（行為一樣，只是比較貴）
+    其他錯誤（權限、暫時性）照樣丟出去，不要變成全表掃描
+    """
+    cursor = decode_page_token(page_token) if page_token else None
+    select_fields = list(dict.fromkeys(list(fields) + ["createdAt"]))
+
+    try:
+        q = base_q.select(select_fields) \
+            .order_by("createdAt", direction=firestore.Query.DESCENDING) \
+            .order_by("__name__", direction=firestore.Query.DESCENDING)
+        if cursor:
+            q = q.start_after({"createdAt": cursor[0], "__name__": col.document(cursor[1])})
+        if limit:
+            q = q.limit(limit)
+        docs = list(q.get())
+    except FailedPrecondition:
+        def key(d):
+            return (_ts_micros((d.to_dict() or {}).get("createdAt")), d.id)
+
+        docs = sorted(base_q.select(select_fields).get(), key=key, reverse=True)
+        if cursor:
+            docs = [d for d in docs if key(d) < cursor[2]]
+        if limit:
+            docs = docs[:limit]
+
+    next_token = None
+    if limit and len(docs) == limit:
+        last = docs[-1]
+        next_token = encode_page_token((last.to_dict() or {}).get("createdAt"), last.id)
+    return docs, next_token
+
+
+def json_with_etag(payload, next_token: str = None):
+    """內容沒變（If-None-Match 命中）就回 304；下一頁 token 放在 header，body 維持原本的格式"""
+    raw = json.dumps([payload, next_token], sort_keys=True, ensure_ascii=False, default=str)
+    etag = hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    if request.if_none_match.contains(etag):
+        resp = app.response_class(status=304)
+    else:
+        resp = jsonify(payload)
+    resp.set_etag(etag)
+    if next_token:
+        resp.headers[PAGE_TOKEN_HEADER] = next_token
+    return resp
+
+
+def _page_args(default_limit=None, max_limit: int = 500):
+    """讀 limit / pageToken；limit 沒給就用 default_limit（None = 不分頁）"""
+    raw = request.args.get("limit")
+    limit = default_limit
+    if raw:
+        try:
+            limit = int(raw)
+        except Exception:
+            limit = default_limit
+    if limit is not None:
+        limit = max(1, min(limit, max_limit))
+    return limit, (request.args.get("pageToken") or "").strip() or None
+
+
+# ===== 批次刪除（子集合 + Storage 前綴，背景執行）=====
+DELETE_JOB_WORKERS = int(os.environ.get("DELETE_JOB_WORKERS") or 2)
+STORAGE_DELETE_BATCH = 100       # GCS batch request 一次最多 100 個
+
+# 各種根 doc 底下已知的子集合結構（照著走，不用每個 doc 都打一次 collections() 探索）
+DELETE_SUBCOLLECTIONS = {
+    "trip": {"days": {"stops": {}}, "tombstones": {}},
+    "post": {"spots": {}},
+}
+
+delete_job_executor = ThreadPoolExecutor(max_workers=DELETE_JOB_WORKERS, thread_name_prefix="delete-job")
+
+
+def _delete_job_ref(job_id: str):
+    return db.collection("deleteJobs").document(job_id)
+
+
+class _DeleteProgress:
+    """累計刪除數量，每 commit 一批就寫回 job doc"""
+
+    def __init__(self, job_ref):
+        self.job_ref = job_ref
+        self.docs = 0
+        self.blobs = 0
+
+    def report(self):
+        self.job_ref.set({
+            "docsDeleted": self.docs,
+            "blobsDeleted": self.blobs,
+            "updatedAt": admin_firestore.SERVER_TIMESTAMP,
+        }, merge=True)
+
+
+def _delete_refs_batched(refs: list, progress: _DeleteProgress):
+    for i in range(0, len(refs), FIRESTORE_BATCH_LIMIT):
+        batch = db.batch()
+        chunk = refs[i:i + FIRESTORE_BATCH_LIMIT]
+        for r in chunk:
+            batch.delete(r)
+        batch.commit()
+        progress.docs += len(chunk)
+        progress.report()
+
+
+def delete_subcollections(doc_ref, schema: dict, progress: _DeleteProgress):
+    """
+    照 schema（DELETE_SUBCOLLECTIONS）把 doc_ref 底下的子集合刪光，先刪子孫再刪自己
+    list_documents 會列出「只有子集合、本身不存在」的 doc（例如 days/1），一樣要往下走
+    """
+    for name, children in schema.items():
+        pending = []
+        for child in doc_ref.collection(name).list_documents(page_size=FIRESTORE_BATCH_LIMIT):
+            if children:
+                delete_subcollections(child, children, progress)
+            pending.append(child)
+            if len(pending) >= FIRESTORE_BATCH_LIMIT:
+                _delete_refs_batched(pending, progress)
+                pending = []
+        if pending:
+            _delete_refs_batched(pending, progress)
+
+
+def delete_storage_prefix(prefix: str, progress: _DeleteProgress):
+    """刪掉 Storage 某個前綴底下所有檔案（用 batch request，一次最多 100 個）"""
+    chunk = []
+
+    def flush():
+        with bucket.client.batch(raise_exception=False):
+            for b in chunk:
+                b.delete()
+        progress.blobs += len(chunk)
+        progress.report()
+
+    for blob in bucket.list_blobs(prefix=prefix):
+        chunk.append(blob)
+        if len(chunk) >= STORAGE_DELETE_BATCH:
+            flush()
+            chunk = []
+    if chunk:
+        flush()
+
+
+def _run_delete_job(job_id: str, kind: str, doc_path: str, storage_prefix: str):
+    ref = _delete_job_ref(job_id)
+    ref.set({"status": "running", "updatedAt": admin_firestore.SERVER_TIMESTAMP}, merge=True)
+    progress = _DeleteProgress(ref)
+    try:
+        schema = DELETE_SUBCOLLECTIONS.get(kind)
+        if schema is None:
+            raise ValueError(f"unknown delete job kind: {kind}")
+        delete_subcollections(db.document(doc_path), schema, progress)
+        if storage_prefix:
+            delete_storage_prefix(storage_prefix, progress)
+        ref.set({
+            "status": "done",
+            "docsDeleted": progress.docs,
+            "blobsDeleted": progress.blobs,
+            "updatedAt": admin_firestore.SERVER_TIMESTAMP,
+        }, merge=True)
+    except Exception as e:
+        ref.set({
+            "status": "error",
+            "error": str(e),
+            "docsDeleted": progress.docs,
+            "blobsDeleted": progress.blobs,
+            "updatedAt": admin_firestore.SERVER_TIMESTAMP,
+        }, merge=True)
+
+
+def enqueue_delete_job(kind: str, doc_ref, storage_prefix: str, email: str) -> str:
+    """
+    根 doc 由呼叫端先同步刪掉（列表馬上看不到），這裡只排子集合 + Storage 的清理
+    回傳 jobId，可用 GET /me/delete-jobs/<jobId> 查進度
+    """
+    job_id = uuid.uuid4().hex
+    _delete_job_ref(job_id).set({
+        "kind": kind,
+        "targetId": doc_ref.id,
+        "docPath": doc_ref.path,
+        "storagePrefix": storage_prefix,
+        "requestedBy": email,
+        "status": "pending",
+        "docsDeleted": 0,
+        "blobsDeleted": 0,
+        "createdAt": admin_firestore.SERVER_TIMESTAMP,
+        "updatedAt": admin_firestore.SERVER_TIMESTAMP,
+    })
+    delete_job_executor.submit(_run_delete_job, job_id, kind, doc_ref.path, storage_prefix)
+    return job_id
+
+
+def resume_pending_delete_jobs():
+    """重啟後把沒刪完的任務重跑（刪除是冪等的，從頭再走一次沒關係）"""
+    for status in ("pending", "running"):
+        for doc in db.collection("deleteJobs").where("status", "==", status).get():
+            j = doc.to_dict() or {}
+            if not j.get("docPath"):
+                continue
+            delete_job_executor.submit(
+                _run_delete_job, doc.id, j.get("kind") or "", j["docPath"], j.get("storagePrefix") or ""
+            )
+
+
+# GET /me/delete-jobs/<jobId>?email=xxx
+@app.get("/me/delete-jobs/<job_id>")
+def get_delete_job_status(job_id: str):
+    email = (request.args.get("email") or "").strip()
+    if not email:
+        return jsonify(error="email is required"), 400
+
+    doc = _delete_job_ref(job_id).get()
+    if not doc.exists:
+        return jsonify(error="job not found"), 404
+
+    j = doc.to_dict() or {}
+    if j.get("requestedBy") != email:
+        return jsonify(error="job not found"), 404
+
+    return jsonify(
+        jobId=job_id,
+        kind=j.get("kind"),
+        targetId=j.get("targetId"),
+        status=j.get("status", "pending"),
+        docsDeleted=j.get("docsDeleted", 0),
+        blobsDeleted=j.get("blobsDeleted", 0),
+        error=j.get("error"),
+        updatedAtMillis=_ms_from_ts(j.get("updatedAt")),
+    )
+
+
+# ===== 照片直傳 Storage（簽名 resumable 上傳網址 + finalize）=====
+PHOTO_UPLOAD_URL_TTL_SEC = 15 * 60          # 上傳網址有效時間
+PHOTO_MAX_BYTES = int(os.environ.get("PHOTO_MAX_BYTES") or 15 * 1024 * 1024)
+PHOTO_CONTENT_TYPES = {"image/jpeg": "jpg", "image/png": "png", "image/webp": "webp"}
+
+
+def new_photo_upload(prefix: str, name_prefix: str, content_type: str):
+    """
+    在 prefix 底下產生一個新檔名，回傳簽名 resumable 上傳資訊
+    client：POST uploadUrl（帶 headers）拿到 session URI → PUT 檔案 → 呼叫 finalize
+    回傳 (payload, error)；error 不是 None 時 payload 為 None
+    """
+    content_type = (content_type or "image/jpeg").strip().lower()
+    ext = PHOTO_CONTENT_TYPES.get(content_type)
+    if not ext:
+        return None, f"contentType must be one of {', '.join(PHOTO_CONTENT_TYPES)}"
+
+    storage_path = f"{prefix}{name_prefix}_{uuid.uuid4().hex}.{ext}"
+    headers = {
+        "x-goog-resumable": "start",
+        "Content-Type": content_type,
+        "x-goog-content-length-range": f"0,{PHOTO_MAX_BYTES}",
+    }
+    url = bucket.blob(storage_path).generate_signed_url(
+        version="v4",
+        expiration=datetime.timedelta(seconds=PHOTO_UPLOAD_URL_TTL_SEC),
+        method="POST",
+        content_type=content_type,
+        headers=headers,
+    )
+    return {
+        "uploadUrl": url,
+        "method": "POST",
+        "headers": headers,
+        "storagePath": storage_path,
+        "maxBytes": PHOTO_MAX_BYTES,
+        "expiresAtMillis": int((time.time() + PHOTO_UPLOAD_URL_TTL_SEC) * 1000),
+    }, None
+
+
+def finalize_photo_upload(prefix: str, storage_path: str):
+    """
+    確認檔案真的傳上去了、而且在這個 target 的 prefix 底下
+    有 Pillow 就下載回來轉成各尺寸（原檔刪掉），回傳 (photo_fields, (error, code))
+    """
+    storage_path = (storage_path or "").strip()
+    if not storage_path:
+        return None, ("storagePath is required", 400)
+    if not storage_path.startswith(prefix) or ".." in storage_path:
+        return None, ("permission denied", 403)
+
+    blob = bucket.get_blob(storage_path)
+    if blob is None:
+        return None, ("upload not found", 404)
+    if (blob.size or 0) > PHOTO_MAX_BYTES or blob.content_type not in PHOTO_CONTENT_TYPES:
+        blob.delete()
+        return None, ("invalid upload", 400)
+
+    if not _has_pil:
+        return photo_path_fields(storage_path, {}), None
+
+    name_prefix = storage_path[len(prefix):].rsplit(".", 1)[0]
+    try:
+        fields = save_photo(prefix, name_prefix, blob.download_as_bytes())
+    except ValueError:
+        blob.delete()
+        return None, ("invalid image", 400)
+    except FutureTimeoutError:
+        # 原檔先留著，client 可以再 finalize 一次
+        return None, ("image processing timed out", 503)
+    blob.delete()
+    return fields, None
+
+
+# ===== 照片處理（轉正 / 去 EXIF / 縮圖 / 重新壓縮）=====
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS") or 2)
+IMAGE_FORMAT = (os.environ.get("IMAGE_FORMAT") or "WEBP").upper()   # WEBP / JPEG
+IMAGE_QUALITY = int(os.environ.get("IMAGE_QUALITY") or 82)
+IMAGE_MAX_PIXELS = 40_000_000   # 防解壓炸彈
+IMAGE_VARIANTS = (("thumb", 128), ("medium", 512), ("large", 1600))   # 最長邊；large 當 photoUrl
+IMAGE_PROCESS_TIMEOUT_SEC = 30
+
+# 解碼 / 縮圖很吃 CPU，限制同時處理張數
+image_executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="image")
+
+
+def render_image_variants(raw: bytes) -> dict:
+    """raw 圖片 → {variant: bytes}；不是圖片就丟 ValueError"""
+    try:
+        img = Image.open(io.BytesIO(raw))
+        if img.width * img.height > IMAGE_MAX_PIXELS:
+            raise ValueError("image too large")
+        img = ImageOps.exif_transpose(img)
+    except ValueError:
+        raise
+    except Exception as e:
+        raise ValueError(str(e))
+
+    keep_alpha = IMAGE_FORMAT == "WEBP" and img.mode in ("RGBA", "LA", "P")
+    img = img.convert("RGBA" if keep_alpha else "RGB")
+
+    out = {}
+    for name, size in IMAGE_VARIANTS:
+        v = img.copy()
+        v.thumbnail((size, size), Image.LANCZOS)
+        buf = io.BytesIO()
+        # 重新存檔時不帶 exif（GPS 之類一起去掉）
+        if IMAGE_FORMAT == "WEBP":
+            v.save(buf, "WEBP", quality=IMAGE_QUALITY, method=4)
+        else:
+            v.save(buf, "JPEG", quality=IMAGE_QUALITY, optimize=True, progressive=True)
+        out[name] = buf.getvalue()
+    return out
+
+
+def save_photo(prefix: str, name_prefix: str, raw: bytes, content_type: str = "image/jpeg") -> dict:
+    """
+    上傳一張照片到 prefix 底下，回傳要寫進 Firestore 的欄位（只存 blob 路徑，讀的時候再簽網址）：
+    { "photoPath": large 路徑, "photoVariantPaths": {"thumb": path, "medium": path, "large": path} }
+    沒有 Pillow 時照原檔上傳，photoVariantPaths 為空
+    """
+    base = f"{prefix}{name_prefix}_{uuid.uuid4().hex}"
+    if not _has_pil:
+        path = f"{base}.{PHOTO_CONTENT_TYPES.get(content_type, 'jpg')}"
+        bucket.blob(path).upload_from_string(raw, content_type=content_type)
+        return photo_path_fields(path, {})
+
+    rendered = image_executor.submit(render_image_variants, raw).result(timeout=IMAGE_PROCESS_TIMEOUT_SEC)
+    ext, mime = ("webp", "image/webp") if IMAGE_FORMAT == "WEBP" else ("jpg", "image/jpeg")
+
+    variants = {}
+    for name, data in rendered.items():
+        blob = bucket.blob(f"{base}_{name}.{ext}")
+        blob.cache_control = "public, max-age=31536000, immutable"
+        blob.upload_from_string(data, content_type=mime)
+        variants[name] = blob.name
+    return photo_path_fields(variants["large"], variants)
+
+
+def read_uploaded_photo(photo):
+    """multipart 的 photo 讀成 bytes；超過 PHOTO_MAX_BYTES 回 None"""
+    raw = photo.read(PHOTO_MAX_BYTES + 1)
+    if len(raw) > PHOTO_MAX_BYTES:
+        return None
+    return raw
+
+
+def photo_path_fields(path: str, variant_paths: dict) -> dict:
+    """新照片只存路徑；舊的 photoUrl / photoVariants（會過期的簽名網址）一起清掉"""
+    return {
+        "photoPath": path,
+        "photoVariantPaths": variant_paths,
+        "photoUrl": admin_firestore.DELETE_FIELD,
+        "photoVariants": admin_firestore.DELETE_FIELD,
+    }
+
+
+# ===== 簽名網址快取（Firestore 只存路徑，讀取時現簽，快到期才重簽）=====
+SIGNED_URL_TTL_SEC = 60 * 60 * 24 * 7      # 簽出去的網址有效 7 天
+SIGNED_URL_REFRESH_SEC = 60 * 60 * 24      # 剩不到 1 天就重簽，client 拿到的網址至少還能用 1 天
+SIGNED_URL_CACHE_MAX = int(os.environ.get("SIGNED_URL_CACHE_MAX") or 20000)
+
+
+class SignedUrlCache:
+    """blob path -> (url, expires_at) 的 LRU；簽名是本機 RSA 運算，但列表一次幾百張還是省下來"""
+
+    def __init__(self, max_items: int, ttl_sec: int, refresh_sec: int):
+        self.max_items = max_items
+        self.ttl_sec = ttl_sec
+        self.refresh_sec = refresh_sec
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path: str):
+        if not path:
+            return None
+        now = time.time()
+        with self._lock:
+            item = self._items.get(path)
+            if item and item[1] - now > self.refresh_sec:
+                self._items.move_to_end(path)
+                self.hits += 1
+                return item[0]
+            self.misses += 1
+
+        url = bucket.blob(path).generate_signed_url(expiration=datetime.timedelta(seconds=self.ttl_sec))
+        with self._lock:
+            self._items[path] = (url, now + self.ttl_sec)
+            self._items.move_to_end(path)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+        return url
+
+
+signed_url_cache = SignedUrlCache(SIGNED_URL_CACHE_MAX, SIGNED_URL_TTL_SEC, SIGNED_URL_REFRESH_SEC)
+
+
+def signed_url_epoch() -> int:
+    """
+    放進 ETag 用：每 SIGNED_URL_REFRESH_SEC 換一次
+    304 讓 client 沿用的 body 最多再用一個週期，裡面的簽名網址在那之前都還有效
+    """
+    return int(time.time() // SIGNED_URL_REFRESH_SEC)
+
+
+def photo_urls_of(d: dict) -> dict:
+    """
+    Firestore doc → 回給 client 的 { "photoUrl", "photoVariants" }
+    有 photoPath 就用快取現簽；還沒 migrate 的舊資料沿用存好的網址
+    """
+    path = d.get("photoPath")
+    if not path:
+        return {"photoUrl": d.get("photoUrl"), "photoVariants": d.get("photoVariants") or {}}
+    variants = {k: signed_url_cache.get(v) for k, v in (d.get("photoVariantPaths") or {}).items()}
+    return {"photoUrl": signed_url_cache.get(path), "photoVariants": variants}
+
+
+def blob_path_from_url(url: str):
+    """把我們 bucket 的網址（簽名 / 下載網址）還原成 blob path；不是我們的就回 None"""
+    if not isinstance(url, str) or not url:
+        return None
+    try:
+        u = urlparse(url)
+    except Exception:
+        return None
+    path = unquote(u.path or "")
+    if u.netloc == "storage.googleapis.com" and path.startswith(f"/{FIREBASE_STORAGE_BUCKET}/"):
+        return path[len(FIREBASE_STORAGE_BUCKET) + 2:]
+    if u.netloc == f"{FIREBASE_STORAGE_BUCKET}.storage.googleapis.com":
+        return path.lstrip("/") or None
+    # firebasestorage.googleapis.com/v0/b/<bucket>/o/<path>
+    prefix = f"/v0/b/{FIREBASE_STORAGE_BUCKET}/o/"
+    if u.netloc == "firebasestorage.googleapis.com" and path.startswith(prefix):
+        return path[len(prefix):] or None
+    return None
+
+
+def migrate_photo_paths() -> int:
+    """一次性 migration：users / 貼文 spots / 行程 stops 的 photoUrl → photoPath，回傳更新筆數"""
+    sources = [
+        db.collection("users"),
+        db.collection_group("spots"),
+        db.collection_group("stops"),
+    ]
+    updated = 0
+    batch = db.batch()
+    pending = 0
+    for src in sources:
+        for doc in src.select(["photoUrl", "photoVariants", "photoPath"]).stream():
+            d = doc.to_dict() or {}
+            if d.get("photoPath"):
+                continue
+            path = blob_path_from_url(d.get("photoUrl"))
+            if not path:
+                continue
+            variants = {}
+            for name, url in (d.get("photoVariants") or {}).items():
+                vp = blob_path_from_url(url)
+                if vp:
+                    variants[name] = vp
+            batch.update(doc.reference, photo_path_fields(path, variants))
+            pending += 1
+            updated += 1
+            if pending >= FIRESTORE_BATCH_LIMIT:
+                batch.commit()
+                batch = db.batch()
+                pending = 0
+    if pending:
+        batch.commit()
+    return updated
+
+
 # ===== 測試 API =====
 @app.get("/api/hello")
 def hello():
     return jsonify(message="Hello from Flask!")
 
 
+# GET /api/upstreams  （外部 API 延遲分布 / 熔斷狀態）
+@app.get("/api/upstreams")
+def upstream_stats():
+    return jsonify({up.name: up.stats() for up in (UPSTREAM_GEMINI, UPSTREAM_PLACES)})
+
+
+# GET /ai/cache/stats  （Gemini 快取命中率）
+@app.get("/ai/cache/stats")
+def ai_cache_stats():
+    return jsonify(gemini_cache.snapshot())
+
+
 # ===== Profile APIs =====
 
 @app.get("/me/profile")
@@ -276,7 +1765,7 @@ def get_profile():
         userName=d.get("userName", ""),
         userLabel=d.get("userLabel", ""),
         introduction=d.get("introduction", ""),
-        photoUrl=d.get("photoUrl"),
+        **photo_urls_of(d),
         firstLogin=d.get("firstLogin", True)
     )
 
@@ -296,10 +1785,15 @@ def update_profile():
         "firstLogin": data.get("firstLogin", True),
     }
 
-    if data.get("photoUrl"):
+    # client 常把 GET 拿到的簽名網址原封送回來：是我們 bucket 的就不存（photoPath 才是本體）
+    if data.get("photoUrl") and not blob_path_from_url(data["photoUrl"]):
         updates["photoUrl"] = data["photoUrl"]
+        updates["photoPath"] = admin_firestore.DELETE_FIELD
+        updates["photoVariantPaths"] = admin_firestore.DELETE_FIELD
 
     db.collection("users").document(email).set(updates, merge=True)
+    post_search_index.set_owner_name(email, updates["userName"])
+    reco_user_cache.invalidate(email)
     return jsonify(ok=True)
 
 
@@ -310,19 +1804,52 @@ def upload_profile_photo():
     if not email or not photo:
         return jsonify(error="email and photo required"), 400
 
-    safe_email = email.replace("/", "_")
-    filename = f"profile_{uuid.uuid4().hex}.jpg"
-    path = f"users/{safe_email}/{filename}"
+    raw = read_uploaded_photo(photo)
+    if raw is None:
+        return jsonify(error="photo too large"), 413
+    try:
+        fields = save_photo(_profile_photo_prefix(email), "profile", raw)
+    except ValueError:
+        return jsonify(error="invalid image"), 400
+    except FutureTimeoutError:
+        return jsonify(error="image processing timed out"), 503
 
-    blob = bucket.blob(path)
-    blob.upload_from_file(photo, content_type="image/jpeg")
-    url = blob.generate_signed_url(expiration=60 * 60 * 24 * 7)
+    db.collection("users").document(email).set(fields, merge=True)
+    return jsonify(**photo_urls_of(fields))
 
-    db.collection("users").document(email).set(
-        {"photoUrl": url},
-        merge=True
-    )
-    return jsonify(photoUrl=url)
+
+def _profile_photo_prefix(email: str) -> str:
+    return f"users/{email.replace('/', '_')}/"
+
+
+# POST /me/profile/photo/upload-url  body: { "email": "...", "contentType": "image/jpeg" }
+@app.post("/me/profile/photo/upload-url")
+def create_profile_photo_upload():
+    data = request.get_json(force=True) or {}
+    email = (data.get("email") or "").strip()
+    if not email:
+        return jsonify(error="email is required"), 400
+
+    payload, err = new_photo_upload(_profile_photo_prefix(email), "profile", data.get("contentType"))
+    if err:
+        return jsonify(error=err), 400
+    return jsonify(payload)
+
+
+# POST /me/profile/photo/finalize  body: { "email": "...", "storagePath": "..." }
+@app.post("/me/profile/photo/finalize")
+def finalize_profile_photo():
+    data = request.get_json(force=True) or {}
+    email = (data.get("email") or "").strip()
+    if not email:
+        return jsonify(error="email is required"), 400
+
+    fields, err = finalize_photo_upload(_profile_photo_prefix(email), data.get("storagePath"))
+    if err:
+        return jsonify(error=err[0]), err[1]
+
+    db.collection("users").document(email).set(fields, merge=True)
+    return jsonify(**photo_urls_of(fields))
 
 
 # ===== Favorites =====
@@ -339,10 +1866,11 @@ def get_favorites():
     fav_ids = (user.to_dict() or {}).get("favorites", [])
     results = []
 
+    # 一次 multi-get，只取需要的欄位
+    docs = get_docs_in_order("posts", fav_ids, ["mapName", "mapType", "ownerEmail"])
     for pid in fav_ids:
-        pdoc = db.collection("posts").document(pid).get()
-        if pdoc.exists:
-            p = pdoc.to_dict() or {}
+        p = docs.get(pid)
+        if p is not None:
             results.append({
                 "id": pid,
                 "mapName": p.get("mapName", ""),
@@ -366,15 +1894,18 @@ def get_following():
     following = (me.to_dict() or {}).get("following", [])
     out = []
 
+    docs = get_docs_in_order(
+        "users", following,
+        ["userName", "introduction", "photoUrl", "photoVariants", "photoPath", "photoVariantPaths"],
+    )
     for fe in following:
-        u = db.collection("users").document(fe).get()
-        if u.exists:
-            d = u.to_dict() or {}
+        d = docs.get(fe)
+        if d is not None:
             out.append({
                 "email": fe,
                 "userName": d.get("userName", ""),
                 "introduction": d.get("introduction", ""),
-                "photoUrl": d.get("photoUrl")
+                **photo_urls_of(d),
             })
     return jsonify(out)
 
@@ -386,25 +1917,28 @@ def get_my_posts():
     if not email:
         return jsonify([])
 
-    q = db.collection("posts").where("ownerEmail", "==", email)
-    snap = q.get()
+    limit, page_token = _page_args()
+    col = db.collection("posts")
+    try:
+        snap, next_token = keyset_page(
+            col, col.where("ownerEmail", "==", email),
+            ["mapName", "mapType", "isRecommended"], page_token, limit
+        )
+    except ValueError:
+        return jsonify(error="invalid pageToken"), 400
 
     out = []
     for doc in snap:
         p = doc.to_dict() or {}
-        ts = p.get("createdAt")
-        ms = int(ts.timestamp() * 1000) if ts else 0
-
         out.append({
             "id": doc.id,
             "mapName": p.get("mapName", ""),
             "mapType": p.get("mapType", ""),
-            "createdAtMillis": ms,
+            "createdAtMillis": _ms_from_ts(p.get("createdAt")),
             "isRecommended": bool(p.get("isRecommended", False))
         })
 
-    out.sort(key=lambda x: x["createdAtMillis"], reverse=True)
-    return jsonify(out)
+    return json_with_etag(out, next_token)
 
 
 @app.delete("/me/posts/<post_id>")
@@ -421,15 +1955,15 @@ def delete_my_post_api(post_id):
     if (doc.to_dict() or {}).get("ownerEmail") != email:
         return jsonify(error="permission denied"), 403
 
-    try:
-        spots = ref.collection("spots").get()
-        for s in spots:
-            ref.collection("spots").document(s.id).delete()
-    except Exception:
-        pass
-
     ref.delete()
-    return jsonify(ok=True)
+    post_search_index.remove(post_id)
+    recent_posts_pool.remove(post_id)
+    spot_geo_index.remove_post(post_id)
+    spot_cluster_cache.invalidate(post_id)
+
+    # spots 子集合 + Storage 照片丟到背景刪
+    job_id = enqueue_delete_job("post", ref, f"posts/{post_id}/", email)
+    return jsonify(ok=True, jobId=job_id)
 
 
 # ===== AI API =====
@@ -440,6 +1974,11 @@ def ai_ask():
     if not prompt:
         return jsonify(error="prompt is required"), 400
 
+    # 串流模式：{"stream": true | "sse" | "ndjson"}
+    mode = stream_mode_of(data)
+    if mode:
+        return stream_text_response(stream_gemini(prompt), mode)
+
     try:
         text = call_gemini(prompt)
         return jsonify(text=text)
@@ -476,6 +2015,14 @@ def ai_voice():
 使用者問題：{user_text}
 """.strip()
 
+    # 串流模式：TTS 可以收到第一句就開始念
+    mode = stream_mode_of(data)
+    if mode:
+        return stream_text_response(
+            stream_gemini(prompt), mode,
+            finish=lambda t: t.strip() or GEMINI_EMPTY_TEXT,
+        )
+
     try:
         text = call_gemini(prompt).strip() or "（AI 沒有回覆內容）"
         return jsonify(text=text)
@@ -506,6 +2053,16 @@ def create_my_post():
     }
     ref = db.collection("posts").document()
     ref.set(doc)
+
+    row = {
+        "id": ref.id,
+        "ownerEmail": email,
+        "mapName": map_name,
+        "mapType": map_type,
+        "createdAtMillis": int(time.time() * 1000),
+    }
+    post_search_index.upsert(ref.id, row)
+    recent_posts_pool.upsert(dict(row, likes=0, isRecommended=is_rec))
     return jsonify(id=ref.id)
 
 
@@ -551,6 +2108,20 @@ def update_my_post(post_id: str):
         "mapType": map_type,
         "updatedAt": admin_firestore.SERVER_TIMESTAMP
     })
+
+    row = {
+        "id": post_id,
+        "ownerEmail": email,
+        "mapName": map_name,
+        "mapType": map_type,
+        "createdAtMillis": _ms_from_ts(cur.get("createdAt")),
+    }
+    post_search_index.upsert(post_id, row)
+    recent_posts_pool.update_if_present(dict(
+        row,
+        likes=int(cur.get("likes", 0) or 0),
+        isRecommended=bool(cur.get("isRecommended", False)),
+    ))
     return jsonify(ok=True)
 
 
@@ -593,7 +2164,7 @@ def get_spots(post_id: str):
             "description": s.get("description", ""),
             "lat": float(s.get("lat", 0.0)),
             "lng": float(s.get("lng", 0.0)),
-            "photoUrl": s.get("photoUrl"),
+            **photo_urls_of(s),
         })
     return jsonify(out)
 
@@ -626,12 +2197,15 @@ def create_spot(post_id: str):
         "description": description,
         "lat": float(lat),
         "lng": float(lng),
+        "geohash": geohash_encode(float(lat), float(lng)),
         "photoUrl": None,
         "createdAt": admin_firestore.SERVER_TIMESTAMP,
         "updatedAt": admin_firestore.SERVER_TIMESTAMP,
     }
     ref = post_ref.collection("spots").document()
     ref.set(spot)
+    spot_geo_index.upsert(post_id, ref.id, spot)
+    spot_cluster_cache.invalidate(post_id)
     return jsonify(id=ref.id)
 
 
@@ -655,14 +2229,26 @@ def update_spot(post_id: str, spot_id: str):
         return jsonify(error="permission denied"), 403
 
     spot_ref = post_ref.collection("spots").document(spot_id)
-    if not spot_ref.get().exists:
+    spot_doc = spot_ref.get()
+    if not spot_doc.exists:
         return jsonify(error="spot not found"), 404
 
-    spot_ref.update({
+    updates = {
         "name": name,
         "description": description,
         "updatedAt": admin_firestore.SERVER_TIMESTAMP
-    })
+    }
+    # 可選：移動位置（有帶 lat/lng 才改，geohash 跟著重算）
+    if data.get("lat") is not None and data.get("lng") is not None:
+        updates["lat"] = float(data["lat"])
+        updates["lng"] = float(data["lng"])
+        updates["geohash"] = geohash_encode(updates["lat"], updates["lng"])
+
+    spot_ref.update(updates)
+    merged = spot_doc.to_dict() or {}
+    merged.update(updates)
+    spot_geo_index.upsert(post_id, spot_id, merged)
+    spot_cluster_cache.invalidate(post_id)
     return jsonify(ok=True)
 
 
@@ -673,59 +2259,523 @@ def delete_spot(post_id: str, spot_id: str):
     if not email:
         return jsonify(error="email is required"), 400
 
-    post_ref = db.collection("posts").document(post_id)
-    post_doc = post_ref.get()
-    if not post_doc.exists:
-        return jsonify(error="post not found"), 404
+    post_ref = db.collection("posts").document(post_id)
+    post_doc = post_ref.get()
+    if not post_doc.exists:
+        return jsonify(error="post not found"), 404
+
+    if (post_doc.to_dict() or {}).get("ownerEmail") != email:
+        return jsonify(error="permission denied"), 403
+
+    spot_ref = post_ref.collection("spots").document(spot_id)
+    if not spot_ref.get().exists:
+        return jsonify(error="spot not found"), 404
+
+    spot_ref.delete()
+    spot_geo_index.remove(post_id, spot_id)
+    spot_cluster_cache.invalidate(post_id)
+    return jsonify(ok=True)
+
+
+# POST /posts/<post_id>/spots/<spot_id>/photo  (multipart: email + photo)
+@app.post("/posts/<post_id>/spots/<spot_id>/photo")
+def upload_spot_photo(post_id: str, spot_id: str):
+    email = (request.form.get("email") or "").strip()
+    photo = request.files.get("photo")
+
+    if not email or not photo:
+        return jsonify(error="email and photo are required"), 400
+
+    spot_ref, err = _owned_spot_ref(post_id, spot_id, email)
+    if err:
+        return jsonify(error=err[0]), err[1]
+
+    raw = read_uploaded_photo(photo)
+    if raw is None:
+        return jsonify(error="photo too large"), 413
+    try:
+        fields = save_photo(f"posts/{post_id}/spots/{spot_id}/", "spot", raw)
+    except ValueError:
+        return jsonify(error="invalid image"), 400
+    except FutureTimeoutError:
+        return jsonify(error="image processing timed out"), 503
+
+    spot_ref.update({**fields, "updatedAt": admin_firestore.SERVER_TIMESTAMP})
+    return jsonify(ok=True)
+
+
+def _owned_spot_ref(post_id: str, spot_id: str, email: str):
+    """post owner 才能改 spot 照片；回傳 (spot_ref, (error, code))"""
+    post_ref = db.collection("posts").document(post_id)
+    post_doc = post_ref.get()
+    if not post_doc.exists:
+        return None, ("post not found", 404)
+    if (post_doc.to_dict() or {}).get("ownerEmail") != email:
+        return None, ("permission denied", 403)
+
+    spot_ref = post_ref.collection("spots").document(spot_id)
+    if not spot_ref.get().exists:
+        return None, ("spot not found", 404)
+    return spot_ref, None
+
+
+# POST /posts/<post_id>/spots/<spot_id>/photo/upload-url  body: { "email": "...", "contentType": "image/jpeg" }
+@app.post("/posts/<post_id>/spots/<spot_id>/photo/upload-url")
+def create_spot_photo_upload(post_id: str, spot_id: str):
+    data = request.get_json(force=True) or {}
+    email = (data.get("email") or "").strip()
+    if not email:
+        return jsonify(error="email is required"), 400
+
+    _, err = _owned_spot_ref(post_id, spot_id, email)
+    if err:
+        return jsonify(error=err[0]), err[1]
+
+    payload, msg = new_photo_upload(f"posts/{post_id}/spots/{spot_id}/", "spot", data.get("contentType"))
+    if msg:
+        return jsonify(error=msg), 400
+    return jsonify(payload)
+
+
+# POST /posts/<post_id>/spots/<spot_id>/photo/finalize  body: { "email": "...", "storagePath": "..." }
+@app.post("/posts/<post_id>/spots/<spot_id>/photo/finalize")
+def finalize_spot_photo(post_id: str, spot_id: str):
+    data = request.get_json(force=True) or {}
+    email = (data.get("email") or "").strip()
+    if not email:
+        return jsonify(error="email is required"), 400
+
+    spot_ref, err = _owned_spot_ref(post_id, spot_id, email)
+    if err:
+        return jsonify(error=err[0]), err[1]
+
+    fields, err = finalize_photo_upload(f"posts/{post_id}/spots/{spot_id}/", data.get("storagePath"))
+    if err:
+        return jsonify(error=err[0]), err[1]
+
+    spot_ref.update({**fields, "updatedAt": admin_firestore.SERVER_TIMESTAMP})
+    return jsonify(ok=True, **photo_urls_of(fields))
+
+# ========= 附近景點（geohash 索引） =========
+GEOHASH_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+GEOHASH_PRECISION = 9             # 存在 spot 上的精度（約 5m）
+SPOT_GEO_REBUILD_SEC = 1800       # 多 worker 時定期整份重建，吃到其他程序的寫入
+NEARBY_DEFAULT_RADIUS_M = 1000
+NEARBY_MAX_RADIUS_M = 50000
+NEARBY_DEFAULT_LIMIT = 20
+NEARBY_MAX_LIMIT = 100
+
+
+def geohash_encode(lat: float, lng: float, precision: int = GEOHASH_PRECISION) -> str:
+    lat = max(-90.0, min(90.0, lat))
+    lng = ((lng + 180.0) % 360.0) - 180.0
+    lat_lo, lat_hi = -90.0, 90.0
+    lng_lo, lng_hi = -180.0, 180.0
+    out = []
+    bits = 0
+    ch = 0
+    even = True   # 偶數 bit 切經度
+    while len(out) < precision:
+        if even:
+            mid = (lng_lo + lng_hi) / 2
+            if lng >= mid:
+                ch = (ch << 1) | 1
+                lng_lo = mid
+            else:
+                ch <<= 1
+                lng_hi = mid
+        else:
+            mid = (lat_lo + lat_hi) / 2
+            if lat >= mid:
+                ch = (ch << 1) | 1
+                lat_lo = mid
+            else:
+                ch <<= 1
+                lat_hi = mid
+        even = not even
+        bits += 1
+        if bits == 5:
+            out.append(GEOHASH_BASE32[ch])
+            bits = 0
+            ch = 0
+    return "".join(out)
+
+
+def geohash_cell_size_deg(precision: int):
+    """回傳 (高度 deg, 寬度 deg)"""
+    n = 5 * precision
+    lng_bits = (n + 1) // 2
+    lat_bits = n // 2
+    return 180.0 / (2 ** lat_bits), 360.0 / (2 ** lng_bits)
+
+
+def geohash_cover(lat: float, lng: float, radius_m: float) -> list:
+    """
+    挑一個格子邊長 >= radius 的精度，回傳中心格 + 周圍 8 格（去重）
+    半徑內的點一定落在這 9 格裡
+    """
+    cos_lat = max(0.01, math.cos(math.radians(lat)))
+    precision = 1
+    for p in range(GEOHASH_PRECISION, 0, -1):
+        h, w = geohash_cell_size_deg(p)
+        if h * 111320.0 >= radius_m and w * 111320.0 * cos_lat >= radius_m:
+            precision = p
+            break
+    h, w = geohash_cell_size_deg(precision)
+    cells = []
+    for dlat in (-h, 0.0, h):
+        for dlng in (-w, 0.0, w):
+            cell = geohash_encode(lat + dlat, lng + dlng, precision)
+            if cell not in cells:
+                cells.append(cell)
+    return cells
+
+
+class SpotGeoIndex:
+    """
+    所有公開地圖 spots 的記憶體索引：依 geohash 排序的 list
+    查詢時對每個覆蓋格子做一次 bisect 範圍掃描，不會掃到其他地方的 spot
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rebuild_lock = threading.Lock()
+        self._keys = []    # 排序好的 (geohash, post_id, spot_id)
+        self._rows = {}    # (post_id, spot_id) -> row
+        self._loaded_at = 0.0
+
+    def _remove_locked(self, key):
+        row = self._rows.pop(key, None)
+        if row is None:
+            return
+        k = (row["geohash"], key[0], key[1])
+        i = bisect.bisect_left(self._keys, k)
+        if i < len(self._keys) and self._keys[i] == k:
+            del self._keys[i]
+
+    def upsert(self, post_id: str, spot_id: str, spot: dict):
+        try:
+            lat = float(spot.get("lat"))
+            lng = float(spot.get("lng"))
+        except (TypeError, ValueError):
+            return
+        row = {
+            "postId": post_id,
+            "id": spot_id,
+            "name": spot.get("name", ""),
+            "description": spot.get("description", ""),
+            "lat": lat,
+            "lng": lng,
+            "geohash": spot.get("geohash") or geohash_encode(lat, lng),
+        }
+        key = (post_id, spot_id)
+        with self._lock:
+            self._remove_locked(key)
+            self._rows[key] = row
+            bisect.insort(self._keys, (row["geohash"], post_id, spot_id))
+
+    def remove(self, post_id: str, spot_id: str):
+        with self._lock:
+            self._remove_locked((post_id, spot_id))
+
+    def remove_post(self, post_id: str):
+        with self._lock:
+            for key in [k for k in self._rows if k[0] == post_id]:
+                self._remove_locked(key)
+
+    def rebuild(self):
+        snap = db.collection_group("spots").select(["name", "description", "lat", "lng", "geohash"]).get()
+        rows = {}
+        for doc in snap:
+            post_ref = doc.reference.parent.parent
+            if post_ref is None or post_ref.parent.id != "posts":
+                continue
+            d = doc.to_dict() or {}
+            try:
+                lat = float(d.get("lat"))
+                lng = float(d.get("lng"))
+            except (TypeError, ValueError):
+                continue
+            rows[(post_ref.id, doc.id)] = {
+                "postId": post_ref.id,
+                "id": doc.id,
+                "name": d.get("name", ""),
+                "description": d.get("description", ""),
+                "lat": lat,
+                "lng": lng,
+                "geohash": d.get("geohash") or geohash_encode(lat, lng),
+            }
+        keys = sorted((r["geohash"], k[0], k[1]) for k, r in rows.items())
+        with self._lock:
+            self._rows = rows
+            self._keys = keys
+            self._loaded_at = time.time()
+
+    def ensure_fresh(self):
+        if time.time() - self._loaded_at <= SPOT_GEO_REBUILD_SEC:
+            return
+        # 已經有索引時，別的 thread 正在重建就直接用舊的
+        if not self._rebuild_lock.acquire(blocking=not self._loaded_at):
+            return
+        try:
+            if time.time() - self._loaded_at > SPOT_GEO_REBUILD_SEC:
+                self.rebuild()
+        finally:
+            self._rebuild_lock.release()
+
+    def nearby(self, lat: float, lng: float, radius_m: float, k: int) -> list:
+        cells = geohash_cover(lat, lng, radius_m)
+        hits = []
+        with self._lock:
+            for cell in cells:
+                i = bisect.bisect_left(self._keys, (cell,))
+                while i < len(self._keys) and self._keys[i][0].startswith(cell):
+                    _, pid, sid = self._keys[i]
+                    row = self._rows[(pid, sid)]
+                    d = haversine_meters(lat, lng, row["lat"], row["lng"])
+                    if d <= radius_m:
+                        hits.append((d, row))
+                    i += 1
+        best = heapq.nsmallest(k, hits, key=lambda x: x[0])
+        out = []
+        for d, row in best:
+            item = {k2: v for k2, v in row.items() if k2 != "geohash"}
+            item["distanceMeters"] = round(d, 1)
+            out.append(item)
+        return out
+
+
+spot_geo_index = SpotGeoIndex()
+
+
+# GET /spots/nearby?lat=25.03&lng=121.56&radius=1000&limit=20
+@app.get("/spots/nearby")
+def get_nearby_spots():
+    try:
+        lat = float(request.args.get("lat"))
+        lng = float(request.args.get("lng"))
+    except (TypeError, ValueError):
+        return jsonify(error="lat and lng are required"), 400
+    if not (-90.0 <= lat <= 90.0 and -180.0 <= lng <= 180.0):
+        return jsonify(error="lat/lng out of range"), 400
+
+    try:
+        radius = float(request.args.get("radius") or NEARBY_DEFAULT_RADIUS_M)
+    except ValueError:
+        radius = NEARBY_DEFAULT_RADIUS_M
+    radius = max(1.0, min(radius, NEARBY_MAX_RADIUS_M))
+
+    try:
+        limit = int(request.args.get("limit") or NEARBY_DEFAULT_LIMIT)
+    except ValueError:
+        limit = NEARBY_DEFAULT_LIMIT
+    limit = max(1, min(limit, NEARBY_MAX_LIMIT))
+
+    try:
+        spot_geo_index.ensure_fresh()
+    except Exception as e:
+        # 重建失敗時沿用舊索引；完全沒有索引才回錯
+        app.logger.warning("spot geo index rebuild failed: %s", e)
+        if not spot_geo_index._loaded_at:
+            return jsonify(error=f"nearby index unavailable: {e}"), 503
+    return jsonify(spot_geo_index.nearby(lat, lng, radius, limit))
+
+
+# ========= 地圖 marker 分群（supercluster 風格，每個 post 建一次） =========
+CLUSTER_RADIUS_PX = 60
+CLUSTER_EXTENT = 512          # tile 像素大小
+CLUSTER_MIN_ZOOM = 0
+CLUSTER_MAX_ZOOM = 16         # 超過這個 zoom 就不分群，直接回單點
+CLUSTER_MIN_POINTS = 2
+CLUSTER_MAX_LAT = 85.0511     # Web Mercator 的緯度範圍；±90 會除以 0
+CLUSTER_CACHE_MAX_POSTS = int(os.environ.get("CLUSTER_CACHE_MAX_POSTS") or 200)
+
+
+def _lng_x(lng: float) -> float:
+    return lng / 360.0 + 0.5
+
 
-    if (post_doc.to_dict() or {}).get("ownerEmail") != email:
-        return jsonify(error="permission denied"), 403
+def _lat_y(lat: float) -> float:
+    lat = max(-CLUSTER_MAX_LAT, min(CLUSTER_MAX_LAT, lat))
+    sin = math.sin(math.radians(lat))
+    y = 0.5 - 0.25 * math.log((1 + sin) / (1 - sin)) / math.pi
+    return min(1.0, max(0.0, y))
 
-    spot_ref = post_ref.collection("spots").document(spot_id)
-    if not spot_ref.get().exists:
-        return jsonify(error="spot not found"), 404
 
-    spot_ref.delete()
-    return jsonify(ok=True)
+def _x_lng(x: float) -> float:
+    return (x - 0.5) * 360.0
 
 
-# POST /posts/<post_id>/spots/<spot_id>/photo  (multipart: email + photo)
-@app.post("/posts/<post_id>/spots/<spot_id>/photo")
-def upload_spot_photo(post_id: str, spot_id: str):
-    email = (request.form.get("email") or "").strip()
-    photo = request.files.get("photo")
+def _y_lat(y: float) -> float:
+    y2 = (180.0 - y * 360.0) * math.pi / 180.0
+    return 360.0 * math.atan(math.exp(y2)) / math.pi - 90.0
 
-    if not email or not photo:
-        return jsonify(error="email and photo are required"), 400
 
-    post_ref = db.collection("posts").document(post_id)
-    post_doc = post_ref.get()
-    if not post_doc.exists:
-        return jsonify(error="post not found"), 404
+class SpotClusterHierarchy:
+    """
+    每個 zoom 一層；上一層（zoom+1）的點在半徑內就併成一個 cluster（加權重心）
+    鄰居查詢用 cell = 半徑 的格子（3x3 格），每層依 x 排序，bbox 查詢用 bisect
+    """
 
-    if (post_doc.to_dict() or {}).get("ownerEmail") != email:
-        return jsonify(error="permission denied"), 403
+    def __init__(self, spots: list):
+        # 點：{x, y, count, zoom, spot}；zoom = 這個 cluster 在哪一層生成（單點為 None）
+        pts = []
+        for sp in spots:
+            x, y = _lng_x(sp["lng"]), _lat_y(sp["lat"])
+            pts.append({"x": x, "y": y, "count": 1, "zoom": None, "spot": sp})
+        self.total = len(pts)
+
+        self.levels = {}
+        self._xs = {}
+        self._set_level(CLUSTER_MAX_ZOOM + 1, pts)
+        for z in range(CLUSTER_MAX_ZOOM, CLUSTER_MIN_ZOOM - 1, -1):
+            pts = self._cluster(pts, z)
+            self._set_level(z, pts)
+
+    def _set_level(self, z: int, pts: list):
+        pts = sorted(pts, key=lambda p: p["x"])
+        self.levels[z] = pts
+        self._xs[z] = [p["x"] for p in pts]
+
+    @staticmethod
+    def _cluster(pts: list, zoom: int) -> list:
+        r = CLUSTER_RADIUS_PX / (CLUSTER_EXTENT * (2 ** zoom))
+        grid = {}
+        for i, p in enumerate(pts):
+            grid.setdefault((int(p["x"] / r), int(p["y"] / r)), []).append(i)
+
+        visited = [False] * len(pts)
+        out = []
+        for i, p in enumerate(pts):
+            if visited[i]:
+                continue
+            visited[i] = True
+            cx, cy = int(p["x"] / r), int(p["y"] / r)
+            members = [p]
+            for gx in (cx - 1, cx, cx + 1):
+                for gy in (cy - 1, cy, cy + 1):
+                    for j in grid.get((gx, gy), ()):
+                        if visited[j]:
+                            continue
+                        q = pts[j]
+                        if (q["x"] - p["x"]) ** 2 + (q["y"] - p["y"]) ** 2 <= r * r:
+                            visited[j] = True
+                            members.append(q)
+
+            count = sum(m["count"] for m in members)
+            if len(members) == 1 or count < CLUSTER_MIN_POINTS:
+                out.extend(members)
+                continue
+            out.append({
+                "x": sum(m["x"] * m["count"] for m in members) / count,
+                "y": sum(m["y"] * m["count"] for m in members) / count,
+                "count": count,
+                "zoom": zoom,
+                # 代表點：最大的子群的代表點
+                "spot": max(members, key=lambda m: m["count"])["spot"],
+            })
+        return out
+
+    def query(self, west: float, south: float, east: float, north: float, zoom: int) -> list:
+        z = max(CLUSTER_MIN_ZOOM, min(int(zoom), CLUSTER_MAX_ZOOM + 1))
+        if west > east:
+            # 跨 180 度經線：拆成兩段
+            return self.query(west, south, 180.0, north, z) + self.query(-180.0, south, east, north, z)
+
+        pts = self.levels[z]
+        xs = self._xs[z]
+        x0, x1 = _lng_x(west), _lng_x(east)
+        y0, y1 = _lat_y(north), _lat_y(south)
+        out = []
+        for i in range(bisect.bisect_left(xs, x0), bisect.bisect_right(xs, x1)):
+            p = pts[i]
+            if not (y0 <= p["y"] <= y1):
+                continue
+            if p["count"] == 1:
+                sp = p["spot"]
+                out.append({"count": 1, "lat": sp["lat"], "lng": sp["lng"], "spot": sp})
+            else:
+                out.append({
+                    "count": p["count"],
+                    "lat": round(_y_lat(p["y"]), 7),
+                    "lng": round(_x_lng(p["x"]), 7),
+                    "expansionZoom": p["zoom"] + 1,
+                    "spot": p["spot"],
+                })
+        return out
+
+
+class SpotClusterCache:
+    """post_id -> SpotClusterHierarchy 的 LRU；spots 有變就丟掉，下次查詢再建"""
+
+    def __init__(self, max_posts: int):
+        self.max_posts = max_posts
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+
+    def get(self, post_id: str):
+        with self._lock:
+            h = self._items.get(post_id)
+            if h is not None:
+                self._items.move_to_end(post_id)
+                return h
+
+        spots = []
+        for d in db.collection("posts").document(post_id).collection("spots").select(["name", "lat", "lng"]).get():
+            s = d.to_dict() or {}
+            try:
+                spots.append({"id": d.id, "name": s.get("name", ""),
+                              "lat": float(s.get("lat")), "lng": float(s.get("lng"))})
+            except (TypeError, ValueError):
+                continue
+        h = SpotClusterHierarchy(spots)
 
-    spot_ref = post_ref.collection("spots").document(spot_id)
-    if not spot_ref.get().exists:
-        return jsonify(error="spot not found"), 404
+        with self._lock:
+            self._items[post_id] = h
+            self._items.move_to_end(post_id)
+            while len(self._items) > self.max_posts:
+                self._items.popitem(last=False)
+        return h
 
-    filename = f"spot_{uuid.uuid4().hex}.jpg"
-    storage_path = f"posts/{post_id}/spots/{spot_id}/{filename}"
+    def invalidate(self, post_id: str):
+        with self._lock:
+            self._items.pop(post_id, None)
 
-    blob = bucket.blob(storage_path)
-    blob.upload_from_file(photo, content_type="image/jpeg")
 
-    # 7天簽名網址（你目前的做法）
-    url = blob.generate_signed_url(expiration=60 * 60 * 24 * 7)
+spot_cluster_cache = SpotClusterCache(CLUSTER_CACHE_MAX_POSTS)
+
+
+# GET /posts/<post_id>/spots/clusters?bbox=west,south,east,north&zoom=12
+@app.get("/posts/<post_id>/spots/clusters")
+def get_spot_clusters(post_id: str):
+    try:
+        west, south, east, north = [float(v) for v in (request.args.get("bbox") or "").split(",")]
+    except ValueError:
+        return jsonify(error="bbox must be west,south,east,north"), 400
+    try:
+        zoom = int(float(request.args.get("zoom")))
+    except (TypeError, ValueError):
+        return jsonify(error="zoom is required"), 400
+
+    if not db.collection("posts").document(post_id).get().exists:
+        return jsonify(error="post not found"), 404
+
+    south, north = max(-85.05113, south), min(85.05113, north)
+    h = spot_cluster_cache.get(post_id)
+    return json_with_etag({
+        "zoom": max(CLUSTER_MIN_ZOOM, min(zoom, CLUSTER_MAX_ZOOM + 1)),
+        "total": h.total,
+        "clusters": h.query(west, south, east, north, zoom),
+    })
 
-    spot_ref.update({"photoUrl": url, "updatedAt": admin_firestore.SERVER_TIMESTAMP})
-    return jsonify(ok=True)
 
 # ========= Trips API（PathActivity 用） =========
 
 def _trip_doc_to_res(doc):
-    d = doc.to_dict() or {}
+    return _trip_dict_to_res(doc.id, doc.to_dict() or {})
+
+
+def _trip_dict_to_res(trip_id: str, d: dict):
     def ts_to_ms(ts):
         try:
             return int(ts.timestamp() * 1000) if ts else None
@@ -733,7 +2783,7 @@ def _trip_doc_to_res(doc):
             return None
 
     return {
-        "id": doc.id,
+        "id": trip_id,
         "ownerEmail": d.get("ownerEmail", ""),
         "title": d.get("title", ""),
         "collaborators": d.get("collaborators", []) or [],
@@ -743,6 +2793,219 @@ def _trip_doc_to_res(doc):
         "days": int(d.get("days", 7) or 7),
     }
 
+# ===== 行程權限（owner / collaborators）=====
+TRIP_ACL_TTL_SEC = 30
+
+
+class TripAclCache:
+    """trip_id -> trip dict 的短 TTL 快取；加協作者 / 刪行程 / owner 修改時失效"""
+
+    def __init__(self, ttl_sec: int):
+        self.ttl_sec = ttl_sec
+        self._lock = threading.Lock()
+        self._items = {}
+
+    def get(self, trip_id: str):
+        now = time.time()
+        with self._lock:
+            item = self._items.get(trip_id)
+            if item and now - item[0] < self.ttl_sec:
+                return item[1]
+
+        doc = db.collection("trips").document(trip_id).get()
+        if not doc.exists:
+            self.invalidate(trip_id)
+            return None
+
+        trip = doc.to_dict() or {}
+        with self._lock:
+            self._items[trip_id] = (now, trip)
+        return trip
+
+    def invalidate(self, trip_id: str):
+        with self._lock:
+            self._items.pop(trip_id, None)
+
+
+trip_acl_cache = TripAclCache(TRIP_ACL_TTL_SEC)
+
+
+def authorize_trip_member(trip_id: str, email: str, missing_json=None):
+    """
+    email 必須是 owner 或 collaborators；通過回 None 並設好 g.email / g.trip / g.trip_ref，否則回錯誤 response
+    要先驗 body 再讀 trip 的 handler 直接呼叫這個，其他用 require_trip_member
+    """
+    trip = trip_acl_cache.get(trip_id)
+    if trip is None:
+        if missing_json is not None:
+            return jsonify(missing_json)
+        return jsonify(error="trip not found"), 404
+
+    if email not in trip_members(trip):
+        return jsonify(error="permission denied"), 403
+
+    g.email = email
+    g.trip = trip
+    g.trip_ref = db.collection("trips").document(trip_id)
+    return None
+
+
+def require_trip_member(email_source: str = "args", missing_json=None):
+    """
+    共用權限檢查：email 必須是 owner 或 collaborators
+    通過後 g.email / g.trip / g.trip_ref 可直接用，不用再讀一次 trip
+    missing_json 不是 None 時，trip 不存在就回這個內容（200），否則回 404
+    """
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            src = request.form if email_source == "form" else request.args
+            email = (src.get("email") or "").strip()
+            if not email:
+                return jsonify(error="email is required"), 400
+
+            denied = authorize_trip_member(kwargs.get("trip_id"), email, missing_json)
+            if denied is not None:
+                return denied
+            return fn(*args, **kwargs)
+        return wrapper
+    return deco
+
+
+def trip_members(trip: dict) -> list:
+    """owner + collaborators（去重、保留順序），存成 trips.members 給 /me/trips 單一查詢用"""
+    out = []
+    for e in [(trip.get("ownerEmail") or "").strip()] + list(trip.get("collaborators", []) or []):
+        if isinstance(e, str) and e and e not in out:
+            out.append(e)
+    return out
+
+
+@firestore.transactional
+def _owner_trip_txn(txn, ref, email: str, mutate):
+    snap = ref.get(transaction=txn)
+    if not snap.exists:
+        return "not_found"
+
+    cur = snap.to_dict() or {}
+    if cur.get("ownerEmail") != email:
+        return "forbidden"
+
+    updates = mutate(cur) or {}
+    merged = dict(cur)
+    merged.update(updates)
+    # 順便補齊舊資料沒有的 members
+    members = trip_members(merged)
+    if cur.get("members") != members:
+        updates["members"] = members
+    if updates:
+        txn.update(ref, updates)
+    return "ok"
+
+
+def update_trip_as_owner(trip_id: str, email: str, mutate) -> str:
+    """讀 trip → 確認是 owner → 套用 mutate(cur) 回傳的欄位，全部在同一個 transaction 裡"""
+    ref = db.collection("trips").document(trip_id)
+    status = _owner_trip_txn(db.transaction(), ref, email, mutate)
+    trip_acl_cache.invalidate(trip_id)
+    return status
+
+
+def backfill_stop_trip_ids() -> int:
+    """一次性 migration：幫舊的 stop 補上 tripId / day（snapshot 的 collection group 查詢要用），回傳更新筆數"""
+    updated = 0
+    batch = db.batch()
+    pending = 0
+    for doc in db.collection_group("stops").select(["tripId", "day"]).stream():
+        day_ref = doc.reference.parent.parent
+        trip_ref = day_ref.parent.parent if day_ref is not None else None
+        if trip_ref is None or trip_ref.parent.id != "trips":
+            continue
+        cur = doc.to_dict() or {}
+        try:
+            day = int(day_ref.id)
+        except ValueError:
+            continue
+        if cur.get("tripId") == trip_ref.id and cur.get("day") == day:
+            continue
+        batch.update(doc.reference, {"tripId": trip_ref.id, "day": day})
+        pending += 1
+        updated += 1
+        if pending >= FIRESTORE_BATCH_LIMIT:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+    if pending:
+        batch.commit()
+    return updated
+
+
+def backfill_trip_members() -> int:
+    """一次性 migration：幫舊的 trip 補上 members 欄位，回傳更新筆數"""
+    updated = 0
+    batch = db.batch()
+    pending = 0
+    for doc in db.collection("trips").select(["ownerEmail", "collaborators", "members"]).get():
+        cur = doc.to_dict() or {}
+        members = trip_members(cur)
+        if cur.get("members") == members:
+            continue
+        batch.update(doc.reference, {"members": members})
+        pending += 1
+        updated += 1
+        if pending >= FIRESTORE_BATCH_LIMIT:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+    if pending:
+        batch.commit()
+    return updated
+
+
+TRIP_MEMBERS_BACKFILLED_MAX = 10000
+_trip_members_backfilled = OrderedDict()  # email -> True；這個 process 已經幫他補過 members
+_trip_members_backfill_lock = threading.Lock()
+
+
+def ensure_trip_members_for(email: str):
+    """
+    懶惰版 backfill_trip_members：只補這個人擁有 / 協作的 trip（兩個單欄位查詢）
+    沒跑過 migrate-trip-members 的舊 trip 也不會從 /me/trips 消失；每個 email 每個 process 只做一次
+    """
+    with _trip_members_backfill_lock:
+        if email in _trip_members_backfilled:
+            _trip_members_backfilled.move_to_end(email)
+            return
+
+    col = db.collection("trips")
+    fields = ["ownerEmail", "collaborators", "members"]
+    batch = db.batch()
+    pending = 0
+    seen = set()
+    for q in (col.where("ownerEmail", "==", email), col.where("collaborators", "array_contains", email)):
+        for doc in q.select(fields).get():
+            if doc.id in seen:
+                continue
+            seen.add(doc.id)
+            cur = doc.to_dict() or {}
+            members = trip_members(cur)
+            if cur.get("members") == members:
+                continue
+            batch.update(doc.reference, {"members": members})
+            pending += 1
+            if pending >= FIRESTORE_BATCH_LIMIT:
+                batch.commit()
+                batch = db.batch()
+                pending = 0
+    if pending:
+        batch.commit()
+
+    with _trip_members_backfill_lock:
+        _trip_members_backfilled[email] = True
+        while len(_trip_members_backfilled) > TRIP_MEMBERS_BACKFILLED_MAX:
+            _trip_members_backfilled.popitem(last=False)
+
+
 @app.post("/me/trips/<trip_id>/collaborators")
 def add_trip_collaborator(trip_id):
     data = request.get_json(force=True) or {}
@@ -754,23 +3017,18 @@ def add_trip_collaborator(trip_id):
     if email == collab:
         return jsonify(error="cannot add yourself"), 400
 
-    ref = db.collection("trips").document(trip_id)
-    snap = ref.get()
-    if not snap.exists:
-        return jsonify(error="trip not found"), 404
-
-    trip = snap.to_dict() or {}
-    owner = (trip.get("ownerEmail") or "").strip()
-
+    def mutate(cur):
+        collaborators = list(cur.get("collaborators", []) or [])
+        if collab in collaborators:
+            return {}
+        return {"collaborators": collaborators + [collab]}
 
-    if email != owner:
+    status = update_trip_as_owner(trip_id, email, mutate)
+    if status == "not_found":
+        return jsonify(error="trip not found"), 404
+    if status == "forbidden":
         return jsonify(error="only owner can add collaborators"), 403
 
-
-    ref.update({
-        "collaborators": admin_firestore.ArrayUnion([collab])
-    })
-
     return jsonify(ok=True)
 
 # GET /me/trips?email=xxx  （我擁有 + 我是協作者）
@@ -780,20 +3038,22 @@ def get_my_trips():
     if not email:
         return jsonify([])
 
-    merged = {}
+    limit, page_token = _page_args()
+    col = db.collection("trips")
+    fields = ["ownerEmail", "title", "collaborators", "startDate", "endDate", "days"]
 
-    mine = db.collection("trips").where("ownerEmail", "==", email).get()
-    for doc in mine:
-        merged[doc.id] = _trip_doc_to_res(doc)
+    # 第一頁先確保這個人的舊 trip 都有 members，不然下面的查詢會漏掉
+    if not page_token:
+        ensure_trip_members_for(email)
 
-    shared = db.collection("trips").where("collaborators", "array_contains", email).get()
-    for doc in shared:
-        merged[doc.id] = _trip_doc_to_res(doc)
+    # members = owner + collaborators，一個有序查詢就好（複合索引：members array_contains + createdAt desc）
+    try:
+        docs, next_token = keyset_page(col, col.where("members", "array_contains", email), fields, page_token, limit)
+    except ValueError:
+        return jsonify(error="invalid pageToken"), 400
 
-    # createdAtMillis desc
-    out = list(merged.values())
-    out.sort(key=lambda x: x.get("createdAtMillis") or 0, reverse=True)
-    return jsonify(out)
+    out = [_trip_doc_to_res(doc) for doc in docs]
+    return json_with_etag(out, next_token)
 
 # POST /me/trips  body: {email,title,startMillis,endMillis}
 @app.post("/me/trips")
@@ -824,6 +3084,7 @@ def create_trip():
     "title": title,
     "days": days,
     "collaborators": [],
+    "members": [email],
     "createdAt": admin_firestore.SERVER_TIMESTAMP,
     "startDate": datetime.datetime.fromtimestamp(start_ms / 1000),
     "endDate": datetime.datetime.fromtimestamp(end_ms / 1000),
@@ -847,16 +3108,12 @@ def rename_trip(trip_id: str):
     if not title:
         return jsonify(error="title is required"), 400
 
-    ref = db.collection("trips").document(trip_id)
-    doc = ref.get()
-    if not doc.exists:
+    status = update_trip_as_owner(trip_id, email, lambda cur: {"title": title})
+    if status == "not_found":
         return jsonify(error="trip not found"), 404
-
-    cur = doc.to_dict() or {}
-    if cur.get("ownerEmail") != email:
+    if status == "forbidden":
         return jsonify(error="permission denied"), 403
 
-    ref.update({"title": title})
     return jsonify(ok=True)
 
 # PUT /me/trips/<trip_id>/dates  body:{email,startMillis,endMillis}
@@ -872,15 +3129,6 @@ def change_trip_dates(trip_id: str):
     if start_ms is None or end_ms is None:
         return jsonify(error="startMillis and endMillis are required"), 400
 
-    ref = db.collection("trips").document(trip_id)
-    doc = ref.get()
-    if not doc.exists:
-        return jsonify(error="trip not found"), 404
-
-    cur = doc.to_dict() or {}
-    if cur.get("ownerEmail") != email:
-        return jsonify(error="permission denied"), 403
-
     start_ms = int(start_ms)
     end_ms = int(end_ms)
     max_end = start_ms + 6 * 86_400_000
@@ -890,11 +3138,16 @@ def change_trip_dates(trip_id: str):
     days = int((end_ms - start_ms) / 86_400_000) + 1
     days = max(1, min(7, days))
 
-    ref.update({
+    status = update_trip_as_owner(trip_id, email, lambda cur: {
         "startDate": admin_firestore.Timestamp.from_millis(start_ms),
         "endDate": admin_firestore.Timestamp.from_millis(end_ms),
         "days": days
     })
+    if status == "not_found":
+        return jsonify(error="trip not found"), 404
+    if status == "forbidden":
+        return jsonify(error="permission denied"), 403
+
     return jsonify(ok=True)
 
 # DELETE /me/trips/<trip_id>?email=xxx
@@ -914,7 +3167,11 @@ def delete_trip(trip_id: str):
         return jsonify(error="permission denied"), 403
 
     ref.delete()
-    return jsonify(ok=True)
+    trip_acl_cache.invalidate(trip_id)
+
+    # days/*/stops 子集合 + Storage 照片丟到背景刪
+    job_id = enqueue_delete_job("trip", ref, f"trips/{trip_id}/", email)
+    return jsonify(ok=True, jobId=job_id)
 
 # ========= Public Posts API（給 RecommendActivity 用） =========
 # GET /posts/public?limit=300
@@ -926,40 +3183,214 @@ def get_public_posts():
         limit = 300
     limit = max(1, min(limit, 500))
 
-    q = db.collection("posts")
+    page_token = (request.args.get("pageToken") or "").strip() or None
+    col = db.collection("posts")
     try:
-        q = q.order_by("createdAt", direction=firestore.Query.DESCENDING)
+        snap, next_token = keyset_page(
+            col, col, ["ownerEmail", "mapName", "mapType", "likes", "isRecommended"], page_token, limit
+        )
+    except ValueError:
+        return jsonify(error="invalid pageToken"), 400
+
+    results = [_public_post_row(doc.id, doc.to_dict() or {}) for doc in snap]
+    return json_with_etag(results, next_token)
+
+# ========= 個人化推薦（server 端打分，取代 RecommendActivity 本機算 300 筆） =========
+RECO_POOL_SIZE = 300
+RECO_INCREMENTAL_SEC = 60       # 每分鐘只抓比 watermark 新的貼文
+RECO_FULL_REFRESH_SEC = 900     # 定期整份重抓（吃到 likes 之類的變動）
+RECO_USER_TTL_SEC = 300
+RECO_DEFAULT_LIMIT = 20
+RECO_MAX_LIMIT = 50
+
+_LABEL_SPLIT_RE = re.compile(r"[,、/｜|\s\u3000]+")
+
+
+def _public_post_row(doc_id: str, p: dict) -> dict:
+    return {
+        "id": doc_id,
+        "ownerEmail": p.get("ownerEmail", ""),
+        "mapName": p.get("mapName", ""),
+        "mapType": p.get("mapType", ""),
+        "createdAtMillis": _ms_from_ts(p.get("createdAt")),
+        "likes": int(p.get("likes", 0) or 0),
+        "isRecommended": bool(p.get("isRecommended", False)),
+    }
+
+
+class RecentPostsPool:
+    """最近 N 筆公開貼文的記憶體快照；新貼文用 createdAt watermark 增量補進來"""
+
+    FIELDS = ["ownerEmail", "mapName", "mapType", "createdAt", "likes", "isRecommended"]
+
+    def __init__(self, size: int):
+        self.size = size
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._rows = {}
+        self._watermark = None   # 目前看過最新一筆的 createdAt（Firestore timestamp）
+        self._full_at = 0.0
+        self._incr_at = 0.0
+
+    def _trim(self):
+        if len(self._rows) <= self.size:
+            return
+        keep = sorted(self._rows.values(), key=lambda r: r["createdAtMillis"], reverse=True)[:self.size]
+        self._rows = {r["id"]: r for r in keep}
+
+    def _query(self, newer_than=None):
+        q = db.collection("posts").select(self.FIELDS)
+        if newer_than is not None:
+            q = q.where("createdAt", ">", newer_than)
+        return q.order_by("createdAt", direction=firestore.Query.DESCENDING).limit(self.size).get()
+
+    def refresh(self):
+        now = time.time()
+        full = now - self._full_at > RECO_FULL_REFRESH_SEC
+        if not full and now - self._incr_at <= RECO_INCREMENTAL_SEC:
+            return
+        # 已經有資料時，別的 thread 在更新就先用舊快照
+        if not self._refresh_lock.acquire(blocking=not self._full_at):
+            return
+        try:
+            snap = self._query(None if full else self._watermark)
+            rows = {}
+            newest = None
+            for doc in snap:
+                p = doc.to_dict() or {}
+                rows[doc.id] = _public_post_row(doc.id, p)
+                if newest is None and p.get("createdAt"):
+                    newest = p.get("createdAt")
+
+            with self._lock:
+                if full:
+                    self._rows = rows
+                else:
+                    self._rows.update(rows)
+                self._trim()
+                if newest is not None:
+                    self._watermark = newest
+                self._incr_at = now
+                if full:
+                    self._full_at = now
+        finally:
+            self._refresh_lock.release()
+
+    def upsert(self, row: dict):
+        with self._lock:
+            self._rows[row["id"]] = row
+            self._trim()
+
+    def update_if_present(self, row: dict):
+        with self._lock:
+            if row["id"] in self._rows:
+                self._rows[row["id"]] = row
+
+    def remove(self, post_id: str):
+        with self._lock:
+            self._rows.pop(post_id, None)
+
+    def rows(self) -> list:
+        with self._lock:
+            return list(self._rows.values())
+
+
+class RecoUserCache:
+    """每個使用者的興趣標籤 + 追蹤名單（短 TTL，改 profile 時失效）"""
+
+    def __init__(self, ttl_sec: int):
+        self.ttl_sec = ttl_sec
+        self._lock = threading.Lock()
+        self._items = {}
+
+    def get(self, email: str):
+        now = time.time()
+        with self._lock:
+            item = self._items.get(email)
+            if item and now - item[0] < self.ttl_sec:
+                return item[1], item[2]
+
+        doc = db.collection("users").document(email).get(field_paths=["userLabel", "following"])
+        d = (doc.to_dict() or {}) if doc.exists else {}
+        labels = {x.strip().lower() for x in _LABEL_SPLIT_RE.split(d.get("userLabel") or "") if x.strip()}
+        following = {x for x in (d.get("following") or []) if isinstance(x, str) and x}
+
+        with self._lock:
+            self._items[email] = (now, labels, following)
+        return labels, following
+
+    def invalidate(self, email: str):
+        with self._lock:
+            self._items.pop(email, None)
+
+
+recent_posts_pool = RecentPostsPool(RECO_POOL_SIZE)
+reco_user_cache = RecoUserCache(RECO_USER_TTL_SEC)
+
+
+def score_post_for_user(row: dict, labels: set, following: set, now_ms: int) -> int:
+    """跟 RecommendActivity 原本的規則一致"""
+    score = 0
+
+    # 1) 追蹤作者加權
+    if row["ownerEmail"] in following:
+        score += 300
+
+    # 2) 興趣標籤：出現在 mapType / mapName
+    name_l = (row["mapName"] or "").lower()
+    type_l = (row["mapType"] or "").lower()
+    score += sum(200 for lb in labels if lb in type_l) + sum(120 for lb in labels if lb in name_l)
+
+    # 3) 熱度：likes 上限 100
+    score += max(0, min(row["likes"], 100))
+
+    # 4) 新鮮度：近 30 天給 0~120 分
+    ms = row["createdAtMillis"]
+    days = (now_ms - ms) // 86_400_000 if ms > 0 else 999
+    score += max(0, min(120, 120 - days * 4))
+    return score
+
+
+# GET /me/recommendations?email=xxx&limit=20&pageToken=xxx
+@app.get("/me/recommendations")
+def get_my_recommendations():
+    email = (request.args.get("email") or "").strip()
+    try:
+        limit = int(request.args.get("limit") or RECO_DEFAULT_LIMIT)
+    except Exception:
+        limit = RECO_DEFAULT_LIMIT
+    limit = max(1, min(limit, RECO_MAX_LIMIT))
+    try:
+        offset = max(0, int(request.args.get("pageToken") or 0))
     except Exception:
-        pass
+        return jsonify(error="invalid pageToken"), 400
 
-    snap = q.limit(limit).get()
+    try:
+        recent_posts_pool.refresh()
+    except Exception as e:
+        if not recent_posts_pool._full_at:
+            return jsonify(error=f"recommendation pool unavailable: {e}"), 503
 
-    results = []
-    for doc in snap:
-        p = doc.to_dict() or {}
+    labels, following = (set(), set())
+    if email:
+        try:
+            labels, following = reco_user_cache.get(email)
+        except Exception:
+            pass
 
-        ts = p.get("createdAt")
-        if ts:
-            try:
-                created_ms = int(ts.timestamp() * 1000)
-            except Exception:
-                created_ms = 0
-        else:
-            created_ms = 0
+    now_ms = int(time.time() * 1000)
+    ranked = []
+    for row in recent_posts_pool.rows():
+        ranked.append((score_post_for_user(row, labels, following, now_ms), row["createdAtMillis"], row))
+    ranked.sort(key=lambda x: (x[0], x[1]), reverse=True)
 
-        results.append({
-            "id": doc.id,
-            "ownerEmail": p.get("ownerEmail", ""),
-            "mapName": p.get("mapName", ""),
-            "mapType": p.get("mapType", ""),
-            "createdAtMillis": created_ms,
-            "likes": int(p.get("likes", 0) or 0),
-            "isRecommended": bool(p.get("isRecommended", False))
-        })
+    page = ranked[offset:offset + limit]
+    next_offset = offset + limit
+    return jsonify(
+        items=[dict(row, score=score) for score, _, row in page],
+        nextPageToken=str(next_offset) if next_offset < len(ranked) else None,
+    )
 
-    # 保險排序
-    results.sort(key=lambda x: x.get("createdAtMillis", 0), reverse=True)
-    return jsonify(results)
 
 # ========= Auth APIs =========
 # POST /auth/register
@@ -1007,47 +3438,208 @@ def register():
     except Exception as e:
         return jsonify(error=str(e)), 500
     
-    # ===== Search Posts API（給 SearchActivity 用）=====
-# GET /posts/search?q=xxx&limit=300
 
+# ========= 搜尋索引（in-process inverted index） =========
+# mapName / mapType / 作者名稱 -> 倒排索引；中文用字元 bigram，英數用單字
+SEARCH_FIELD_WEIGHTS = {"mapName": 3.0, "mapType": 2.0, "ownerName": 1.0}
+SEARCH_INDEX_REBUILD_SEC = 600  # 多 worker 時，定期整份重建以吃到其他程序的寫入
+SEARCH_DEFAULT_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
+
+_CJK_RE = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+")
+_WORD_RE = re.compile(r"[0-9a-z]+|[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+")
+
+
+def tokenize_for_search(text: str, for_query: bool = False) -> list:
+    """
+    英數：整個單字（小寫）；建索引時另外放長度 >= 2 的前綴，讓打到一半的字也查得到
+    中文：連續字元切 bigram；建索引時另外放 unigram，讓單字查詢也查得到
+    """
+    out = []
+    for run in _WORD_RE.findall((text or "").lower()):
+        if not _CJK_RE.fullmatch(run):
+            out.append(run)
+            if not for_query:
+                out.extend(run[:i] for i in range(2, len(run)))
+            continue
+        if len(run) == 1:
+            out.append(run)
+            continue
+        out.extend(run[i:i + 2] for i in range(len(run) - 1))
+        if not for_query:
+            out.extend(run)
+    return out
+
+
+class PostSearchIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rebuild_lock = threading.Lock()
+        self._docs = {}       # post_id -> row
+        self._doc_tokens = {} # post_id -> {token: weight}
+        self._postings = {}   # token -> {post_id: weight}
+        self._owner_names = {}
+        self._loaded_at = 0.0
+
+    # ----- 維護 -----
+    def _unindex(self, post_id: str):
+        for tok in self._doc_tokens.pop(post_id, {}):
+            plist = self._postings.get(tok)
+            if plist is None:
+                continue
+            plist.pop(post_id, None)
+            if not plist:
+                del self._postings[tok]
+        self._docs.pop(post_id, None)
+
+    def _index(self, post_id: str, row: dict):
+        self._unindex(post_id)
+        row = dict(row)
+        row["ownerName"] = self._owner_names.get(row.get("ownerEmail") or "", "")
+
+        weights = {}
+        for field, w in SEARCH_FIELD_WEIGHTS.items():
+            for tok in tokenize_for_search(row.get(field) or ""):
+                weights[tok] = weights.get(tok, 0.0) + w
+
+        self._docs[post_id] = row
+        self._doc_tokens[post_id] = weights
+        for tok, w in weights.items():
+            self._postings.setdefault(tok, {})[post_id] = w
+
+    def upsert(self, post_id: str, row: dict):
+        with self._lock:
+            self._index(post_id, row)
+
+    def remove(self, post_id: str):
+        with self._lock:
+            self._unindex(post_id)
+
+    def set_owner_name(self, email: str, user_name: str):
+        with self._lock:
+            if self._owner_names.get(email, "") == (user_name or ""):
+                return
+            self._owner_names[email] = user_name or ""
+            for pid, row in list(self._docs.items()):
+                if row.get("ownerEmail") == email:
+                    self._index(pid, row)
+
+    def rebuild(self):
+        """整份重建：一次 select() 掃 posts + 一次 multi-get 作者名稱"""
+        snap = db.collection("posts").select(
+            ["ownerEmail", "mapName", "mapType", "createdAt"]
+        ).get()
+
+        rows = {}
+        for doc in snap:
+            p = doc.to_dict() or {}
+            rows[doc.id] = {
+                "id": doc.id,
+                "ownerEmail": p.get("ownerEmail", ""),
+                "mapName": p.get("mapName", ""),
+                "mapType": p.get("mapType", ""),
+                "createdAtMillis": _ms_from_ts(p.get("createdAt")),
+            }
+
+        owners = {r["ownerEmail"] for r in rows.values() if r["ownerEmail"]}
+        users = get_docs_in_order("users", list(owners), ["userName"])
+
+        with self._lock:
+            self._docs = {}
+            self._doc_tokens = {}
+            self._postings = {}
+            self._owner_names = {e: (u.get("userName") or "") for e, u in users.items()}
+            for pid, row in rows.items():
+                self._index(pid, row)
+            self._loaded_at = time.time()
+
+    def ensure_fresh(self):
+        if time.time() - self._loaded_at <= SEARCH_INDEX_REBUILD_SEC:
+            return
+        # 已經有索引時，別的 thread 正在重建就直接用舊的
+        if not self._rebuild_lock.acquire(blocking=not self._loaded_at):
+            return
+        try:
+            if time.time() - self._loaded_at > SEARCH_INDEX_REBUILD_SEC:
+                self.rebuild()
+        finally:
+            self._rebuild_lock.release()
+
+    # ----- 查詢 -----
+    def search(self, q: str, k: int) -> list:
+        q_tokens = list(dict.fromkeys(tokenize_for_search(q, for_query=True)))
+        q_lower = (q or "").strip().lower()
+        if not q_tokens:
+            return []
+
+        with self._lock:
+            n_docs = max(1, len(self._docs))
+            scores = {}
+            hits = {}
+            for tok in q_tokens:
+                plist = self._postings.get(tok)
+                if not plist:
+                    continue
+                idf = math.log(1.0 + n_docs / len(plist))
+                for pid, w in plist.items():
+                    scores[pid] = scores.get(pid, 0.0) + idf * w
+                    hits[pid] = hits.get(pid, 0) + 1
+
+            ranked = []
+            for pid, base in scores.items():
+                coverage = hits[pid] / len(q_tokens)
+                # 至少命中一半的 token 才算（避免 bigram 亂配）
+                if coverage < 0.5:
+                    continue
+                row = self._docs[pid]
+                score = base * coverage * coverage
+                # 完整子字串命中：名稱 > 分類（跟 Android 原本的加權一致）
+                if q_lower in (row.get("mapName") or "").lower():
+                    score += 200
+                elif q_lower in (row.get("mapType") or "").lower():
+                    score += 180
+                ranked.append((score, row.get("createdAtMillis", 0), pid))
+
+            ranked.sort(reverse=True)
+            out = []
+            for score, _, pid in ranked[:k]:
+                row = self._docs[pid]
+                out.append({
+                    "id": pid,
+                    "ownerEmail": row.get("ownerEmail", ""),
+                    "mapName": row.get("mapName", ""),
+                    "mapType": row.get("mapType", ""),
+                    "createdAtMillis": row.get("createdAtMillis", 0),
+                    "score": round(score, 4),
+                })
+            return out
+
+
+post_search_index = PostSearchIndex()
+
+
+# ===== Search Posts API（給 SearchActivity 用）=====
+# GET /posts/search?q=xxx&limit=20
 @app.get("/posts/search")
 def search_posts():
     q = (request.args.get("q") or "").strip()
-    limit = int(request.args.get("limit") or 300)
+    try:
+        limit = int(request.args.get("limit") or SEARCH_DEFAULT_LIMIT)
+    except Exception:
+        limit = SEARCH_DEFAULT_LIMIT
+    limit = max(1, min(limit, SEARCH_MAX_LIMIT))
 
     if not q:
         return jsonify([])
 
-    # 先抓近 N 筆（跟你 Android 原本一致：抓 300 再做加權）
-    ref = db.collection("posts")
     try:
-        snap = ref.order_by("createdAt", direction=firestore.Query.DESCENDING).limit(limit).get()
-    except Exception:
-        snap = ref.limit(limit).get()
-
-    rows = []
-    for doc in snap:
-        p = doc.to_dict() or {}
-        ts = p.get("createdAt")
-        if ts:
-            try:
-                created_ms = int(ts.timestamp() * 1000)
-            except Exception:
-                created_ms = 0
-        else:
-            created_ms = 0
-
-        rows.append({
-            "id": doc.id,
-            "ownerEmail": p.get("ownerEmail", ""),
-            "mapName": p.get("mapName", ""),
-            "mapType": p.get("mapType", ""),
-            "createdAtMillis": created_ms
-        })
+        post_search_index.ensure_fresh()
+    except Exception as e:
+        # 重建失敗時沿用舊索引；完全沒有索引才回錯
+        if not post_search_index._loaded_at:
+            return jsonify(error=f"search index unavailable: {e}"), 503
 
-    # 保險排序（新→舊）
-    rows.sort(key=lambda x: x.get("createdAtMillis", 0), reverse=True)
-    return jsonify(rows)
+    return jsonify(post_search_index.search(q, limit))
 
 # ========= Trips Stops APIs =========
 
@@ -1061,30 +3653,15 @@ def _ms_from_ts(ts):
 
 # DELETE /trips/<tripId>/days/<day>/stops/<stopId>?email=xxx
 @app.delete("/trips/<trip_id>/days/<int:day>/stops/<stop_id>")
+@require_trip_member()
 def delete_trip_day_stop(trip_id: str, day: int, stop_id: str):
-    email = (request.args.get("email") or "").strip()
-    if not email:
-        return jsonify(error="email is required"), 400
-
     day = max(1, min(day, 7))
 
-    # 1️⃣ 取得行程
-    trip_ref = db.collection("trips").document(trip_id)
-    trip_doc = trip_ref.get()
-    if not trip_doc.exists:
-        return jsonify(error="trip not found"), 404
-
-    trip = trip_doc.to_dict() or {}
-    owner = trip.get("ownerEmail")
-    collaborators = trip.get("collaborators", []) or []
-
-    # 2️⃣ 權限檢查
-    if email != owner and email not in collaborators:
-        return jsonify(error="permission denied"), 403
+    # 1️⃣ 2️⃣ 行程 + 權限檢查由 require_trip_member 處理
 
     # 3️⃣ 取得 stop
     stop_ref = (
-        trip_ref
+        g.trip_ref
         .collection("days").document(str(day))
         .collection("stops").document(stop_id)
     )
@@ -1092,31 +3669,21 @@ def delete_trip_day_stop(trip_id: str, day: int, stop_id: str):
     if not stop_ref.get().exists:
         return jsonify(error="stop not found"), 404
 
-    # 4️⃣ 刪除
-    stop_ref.delete()
+    # 4️⃣ 刪除 + 留 tombstone（delta sync 才知道它被刪了），同一個 batch 一起生效
+    batch = db.batch()
+    batch.delete(stop_ref)
+    batch.set(stop_tombstone_ref(g.trip_ref, stop_id), stop_tombstone(day))
+    batch.commit()
 
     return jsonify(ok=True)
 
 # GET /me/trips/<tripId>/days/<day>/stops?email=xxx
 @app.get("/me/trips/<trip_id>/days/<int:day>/stops")
+@require_trip_member(missing_json=[])
 def get_trip_day_stops(trip_id: str, day: int):
-    email = request.args.get("email")
-    if not email:
-        return jsonify(error="email is required"), 400
     day = max(1, min(day, 7))
 
-    # （簡化版權限）只要是 owner 或 collaborators 才能讀
-    trip_doc = db.collection("trips").document(trip_id).get()
-    if not trip_doc.exists:
-        return jsonify([])
-
-    trip = trip_doc.to_dict() or {}
-    owner = trip.get("ownerEmail")
-    collaborators = trip.get("collaborators", []) or []
-    if email != owner and email not in collaborators:
-        return jsonify(error="permission denied"), 403
-
-    ref = db.collection("trips").document(trip_id)\
+    ref = g.trip_ref\
         .collection("days").document(str(day))\
         .collection("stops")
 
@@ -1126,26 +3693,271 @@ def get_trip_day_stops(trip_id: str, day: int):
     except Exception:
         snap = ref.get()
 
-    out = []
-    for d in snap:
-        s = d.to_dict() or {}
-        out.append({
-            "id": d.id,
-            "name": s.get("name", ""),
-            "description": s.get("description", ""),
-            "lat": float(s.get("lat") or 0.0),
-            "lng": float(s.get("lng") or 0.0),
-            "photoUrl": s.get("photoUrl"),
-            "startTime": s.get("startTime", ""),
-            "endTime": s.get("endTime", ""),
-            "aiSuggestion": s.get("aiSuggestion", ""),
-            "category": s.get("category", "景點"),
-            "createdAtMillis": _ms_from_ts(s.get("createdAt"))
-        })
-
-    out.sort(key=lambda x: x.get("createdAtMillis", 0))
+    out = [_trip_stop_row(d.id, d.to_dict() or {}) for d in snap]
+    out.sort(key=lambda x: stop_order_key(x, (x.get("createdAtMillis") or 0,)))
     return jsonify(out)
 
+
+def _trip_stop_row(stop_id: str, s: dict) -> dict:
+    return {
+        "id": stop_id,
+        "name": s.get("name", ""),
+        "description": s.get("description", ""),
+        "lat": float(s.get("lat") or 0.0),
+        "lng": float(s.get("lng") or 0.0),
+        **photo_urls_of(s),
+        "startTime": s.get("startTime", ""),
+        "endTime": s.get("endTime", ""),
+        "aiSuggestion": s.get("aiSuggestion", ""),
+        "category": s.get("category", "景點"),
+        "order": s.get("order"),
+        "createdAtMillis": _ms_from_ts(s.get("createdAt"))
+    }
+
+
+def load_trip_stops(trip_id: str, trip_ref, days: int):
+    """
+    整趟行程的 stops：一次 collection group 查詢（stops 上有反正規化的 tripId / day）
+    索引還沒建好時退回逐天讀；回傳 [(day, stop_id, dict)]
+    """
+    try:
+        snap = db.collection_group("stops").where("tripId", "==", trip_id).get()
+        out = []
+        for d in snap:
+            s = d.to_dict() or {}
+            # 保險：只收這個 trip 底下的（路徑 trips/<id>/days/<day>/stops/<stop>）
+            if d.reference.parent.parent.parent.parent.id != trip_id:
+                continue
+            out.append((int(s.get("day") or d.reference.parent.parent.id), d.id, s))
+        return out
+    except FailedPrecondition:
+        out = []
+        for day in range(1, days + 1):
+            for d in trip_ref.collection("days").document(str(day)).collection("stops").get():
+                out.append((day, d.id, d.to_dict() or {}))
+        return out
+
+
+def trip_stops_version(trip_id: str):
+    """
+    (stop 數, 最新 updatedAt ms)：一個 count 聚合 + 一筆 limit(1)，不讀整趟 stops
+    要 collection group 複合索引 stops(tripId ASC, updatedAt DESC)；還沒建回 None，呼叫端改用整趟讀
+    """
+    q = db.collection_group("stops").where("tripId", "==", trip_id)
+    if not hasattr(q, "count"):   # 舊版 SDK 沒有聚合查詢
+        return None
+    try:
+        n = int(q.count().get()[0][0].value)
+        top = q.order_by("updatedAt", direction=firestore.Query.DESCENDING).select(["updatedAt"]).limit(1).get()
+    except FailedPrecondition:
+        return None
+    latest = _ms_from_ts((top[0].to_dict() or {}).get("updatedAt")) if top else 0
+    return n, latest or 0
+
+
+def gzip_json_response(payload, etag: str):
+    """client 有帶 Accept-Encoding: gzip 就壓縮；ETag 一樣時回 304"""
+    if request.if_none_match.contains(etag):
+        resp = app.response_class(status=304)
+        resp.set_etag(etag)
+        return resp
+
+    body = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    resp = app.response_class(mimetype="application/json")
+    if "gzip" in (request.headers.get("Accept-Encoding") or "").lower():
+        resp.set_data(gzip.compress(body, compresslevel=6))
+        resp.headers["Content-Encoding"] = "gzip"
+    else:
+        resp.set_data(body)
+    resp.headers["Vary"] = "Accept-Encoding"
+    resp.set_etag(etag)
+    return resp
+
+
+# ===== Delta sync（updatedAt watermark + 刪除 tombstone）=====
+TOMBSTONE_RETENTION_SEC = int(os.environ.get("TOMBSTONE_RETENTION_SEC") or 30 * 86400)
+TOMBSTONE_COMPACT_EVERY_SEC = 3600
+CHANGES_SKEW_MS = 5000   # SERVER_TIMESTAMP 先取時間後 commit：往回多看幾秒，client 依 id 覆蓋即可
+
+_tombstone_compacted_at = OrderedDict()   # trip_id -> 上次 compaction 時間（依時間排，過期就丟）
+_tombstone_lock = threading.Lock()
+
+
+def stop_tombstone_ref(trip_ref, stop_id: str):
+    return trip_ref.collection("tombstones").document(stop_id)
+
+
+def stop_tombstone(day: int) -> dict:
+    return {"day": day, "deletedAt": admin_firestore.SERVER_TIMESTAMP}
+
+
+def compact_tombstones(trip_ref=None) -> int:
+    """
+    刪掉超過保留期限的 tombstone（trip_ref=None 就每個 trip 各跑一次），回傳刪除筆數
+    不用 collection group 查 deletedAt：那要另外設 collection group 單欄位索引，沒設會 FAILED_PRECONDITION
+    """
+    if trip_ref is None:
+        return sum(compact_tombstones(d.reference) for d in db.collection("trips").select([]).stream())
+
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=TOMBSTONE_RETENTION_SEC)
+    src = trip_ref.collection("tombstones")
+    refs = [d.reference for d in src.where("deletedAt", "<", cutoff).select([]).stream()]
+    for i in range(0, len(refs), FIRESTORE_BATCH_LIMIT):
+        batch = db.batch()
+        for r in refs[i:i + FIRESTORE_BATCH_LIMIT]:
+            batch.delete(r)
+        batch.commit()
+    return len(refs)
+
+
+def _maybe_compact_trip_tombstones(trip_id: str, trip_ref):
+    now = time.time()
+    with _tombstone_lock:
+        if now - _tombstone_compacted_at.get(trip_id, 0.0) < TOMBSTONE_COMPACT_EVERY_SEC:
+            return
+        _tombstone_compacted_at[trip_id] = now
+        _tombstone_compacted_at.move_to_end(trip_id)
+        # 超過一個週期的紀錄沒有用了（下次一定會再跑），從最舊的開始丟
+        while _tombstone_compacted_at:
+            oldest = next(iter(_tombstone_compacted_at.values()))
+            if now - oldest < TOMBSTONE_COMPACT_EVERY_SEC:
+                break
+            _tombstone_compacted_at.popitem(last=False)
+    delete_job_executor.submit(compact_tombstones, trip_ref)
+
+
+# GET /me/trips/<tripId>/changes?email=xxx&since=<watermark>
+# 回傳：{ "changed": [stop..., 含 day / updatedAtMillis], "deleted": [{id, day}], "watermark": ms, "reset": bool }
+# reset=true：since 沒給或太舊（tombstone 已經清掉），changed 是整份，client 要整份替換
+# watermark 一律不早於 server 現在時間 - CHANGES_SKEW_MS：閒置很久的 trip 下次帶回來也不會一直被判太舊
+@app.get("/me/trips/<trip_id>/changes")
+@require_trip_member()
+def get_trip_changes(trip_id: str):
+    try:
+        since = int(request.args.get("since") or 0)
+    except ValueError:
+        return jsonify(error="since must be a millisecond watermark"), 400
+
+    now_ms = int(time.time() * 1000)
+    reset = since <= 0 or since < now_ms - TOMBSTONE_RETENTION_SEC * 1000
+    _maybe_compact_trip_tombstones(trip_id, g.trip_ref)
+
+    changed = []
+    deleted = []
+    watermark = 0
+
+    if reset:
+        n_days = max(1, min(int(g.trip.get("days") or 7), 7))
+        rows = load_trip_stops(trip_id, g.trip_ref, n_days)
+    else:
+        since_dt = datetime.datetime.fromtimestamp((since - CHANGES_SKEW_MS) / 1000, tz=datetime.timezone.utc)
+        try:
+            snap = db.collection_group("stops") \
+                .where("tripId", "==", trip_id) \
+                .where("updatedAt", ">", since_dt) \
+                .get()
+            rows = [(int((d.to_dict() or {}).get("day") or 1), d.id, d.to_dict() or {}) for d in snap]
+        except FailedPrecondition:
+            # (tripId, updatedAt) 的 collection group 索引還沒建：整趟讀回來自己篩
+            n_days = max(1, min(int(g.trip.get("days") or 7), 7))
+            rows = [
+                r for r in load_trip_stops(trip_id, g.trip_ref, n_days)
+                if (_ms_from_ts(r[2].get("updatedAt")) or 0) > since - CHANGES_SKEW_MS
+            ]
+
+        for d in g.trip_ref.collection("tombstones").where("deletedAt", ">", since_dt).get():
+            t = d.to_dict() or {}
+            ms = _ms_from_ts(t.get("deletedAt")) or 0
+            deleted.append({"id": d.id, "day": t.get("day"), "deletedAtMillis": ms})
+            watermark = max(watermark, ms)
+
+    for day, stop_id, st in rows:
+        row = _trip_stop_row(stop_id, st)
+        row["day"] = day
+        row["updatedAtMillis"] = _ms_from_ts(st.get("updatedAt"))
+        changed.append(row)
+        watermark = max(watermark, row["updatedAtMillis"] or 0)
+
+    changed.sort(key=lambda x: (x["day"],) + stop_order_key(x, (x.get("createdAtMillis") or 0,)))
+    watermark = max(watermark, now_ms - CHANGES_SKEW_MS)
+    return jsonify(changed=changed, deleted=deleted, watermark=watermark, reset=reset)
+
+
+# GET /me/trips/<tripId>/snapshot?email=xxx
+# 一次回整趟行程：{ "trip": {...}, "days": [{ "day": 1, "stops": [...] }, ...] }
+@app.get("/me/trips/<trip_id>/snapshot")
+@require_trip_member()
+def get_trip_snapshot(trip_id: str):
+    trip = _trip_dict_to_res(trip_id, g.trip)
+    n_days = max(1, min(int(trip.get("days") or 7), 7))
+
+    # ETag：trip 內容 + stops 數量 + 最新 updatedAt + 簽名網址週期
+    # 先用 count + limit(1) 便宜地算，304 就不用把整趟 stops 讀出來
+    def snapshot_etag(n_stops: int, latest_ms: int) -> str:
+        raw = json.dumps([trip, n_stops, latest_ms, signed_url_epoch()], sort_keys=True, default=str)
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    version = trip_stops_version(trip_id)
+    if version is not None:
+        etag = snapshot_etag(*version)
+        if request.if_none_match.contains(etag):
+            return gzip_json_response(None, etag)
+
+    rows = load_trip_stops(trip_id, g.trip_ref, n_days)
+    latest = max((_ms_from_ts(s.get("updatedAt")) or 0 for _, _, s in rows), default=0)
+    etag = snapshot_etag(len(rows), latest)
+    if request.if_none_match.contains(etag):
+        return gzip_json_response(None, etag)
+
+    by_day = {}
+    for day, stop_id, s in rows:
+        by_day.setdefault(day, []).append(_trip_stop_row(stop_id, s))
+    days = []
+    for day in range(1, max([n_days] + list(by_day)) + 1):
+        stops = by_day.get(day, [])
+        stops.sort(key=lambda x: stop_order_key(x, (x.get("createdAtMillis") or 0,)))
+        days.append({"day": day, "stops": stops})
+
+    return gzip_json_response({"trip": trip, "days": days, "updatedAtMillis": latest or None}, etag)
+
+STOP_HHMM_RE = re.compile(r"^\d{2}:\d{2}$")
+
+
+def validate_stop_times(start_time: str, end_time: str):
+    """允許空值或 HH:mm；兩個都有時 start <= end（字串 HH:mm 直接比可用）。回傳錯誤訊息或 None"""
+    if start_time and not STOP_HHMM_RE.match(start_time):
+        return "startTime format must be HH:mm"
+    if end_time and not STOP_HHMM_RE.match(end_time):
+        return "endTime format must be HH:mm"
+    if start_time and end_time and start_time > end_time:
+        return "startTime must be <= endTime"
+    return None
+
+
+def stop_updates_from_json(data: dict) -> dict:
+    """PUT / 批次更新共用：只收有出現在 body 的欄位"""
+    updates = {}
+
+    # 文字欄位
+    for k in ["name", "description", "category", "startTime", "endTime"]:
+        if k in data:
+            updates[k] = (data.get(k) or "").strip()
+
+    # 數字欄位
+    if "lat" in data:
+        updates["lat"] = float(data.get("lat") or 0.0)
+    if "lng" in data:
+        updates["lng"] = float(data.get("lng") or 0.0)
+
+    # 物件欄位
+    if "openingHours" in data:
+        updates["openingHours"] = data.get("openingHours")
+    if data.get("placeId"):
+        updates["placeId"] = str(data.get("placeId")).strip()
+
+    return updates
+
+
 # POST /me/trips/<tripId>/days/<day>/stops
 # 新增一個行程點（給 PickLocationActivity 用）
 @app.post("/me/trips/<trip_id>/days/<int:day>/stops")
@@ -1171,32 +3983,20 @@ def add_trip_day_stop(trip_id: str, day: int):
     if lat is None or lng is None:
         return jsonify(error="lat and lng are required"), 400
 
-    # （可選）時間格式檢查：允許空值或 HH:mm
-    hhmm = re.compile(r"^\d{2}:\d{2}$")
-    if start_time and not hhmm.match(start_time):
-        return jsonify(error="startTime format must be HH:mm"), 400
-    if end_time and not hhmm.match(end_time):
-        return jsonify(error="endTime format must be HH:mm"), 400
-
-    # （可選）若兩個時間都有，檢查 start <= end（字串 HH:mm 直接比可用）
-    if start_time and end_time and start_time > end_time:
-        return jsonify(error="startTime must be <= endTime"), 400
-
-    # 權限檢查（跟 GET 一致）
-    trip_ref = db.collection("trips").document(trip_id)
-    trip_doc = trip_ref.get()
-    if not trip_doc.exists:
-        return jsonify(error="trip not found"), 404
-
-    trip = trip_doc.to_dict() or {}
-    owner = trip.get("ownerEmail")
-    collaborators = trip.get("collaborators", []) or []
+    err = validate_stop_times(start_time, end_time)
+    if err:
+        return jsonify(error=err), 400
 
-    if email != owner and email not in collaborators:
-        return jsonify(error="permission denied"), 403
+    # 權限檢查（跟 GET 一致）；body 驗過才讀 trip
+    denied = authorize_trip_member(trip_id, email)
+    if denied is not None:
+        return denied
+    trip_ref = g.trip_ref
 
     # ✅ 新增 stop（把時間存進去）
     stop = {
+        "tripId": trip_id,   # 反正規化：整趟 snapshot 用 collection group 查
+        "day": day,
         "name": name,
         "description": description,
         "lat": float(lat),
@@ -1209,6 +4009,8 @@ def add_trip_day_stop(trip_id: str, day: int):
         "createdAt": admin_firestore.SERVER_TIMESTAMP,
         "updatedAt": admin_firestore.SERVER_TIMESTAMP,
     }
+    if place_id:
+        stop["placeId"] = str(place_id).strip()
 
     ref = trip_ref \
         .collection("days").document(str(day)) \
@@ -1219,30 +4021,16 @@ def add_trip_day_stop(trip_id: str, day: int):
     return jsonify(id=ref.id), 200
 
 @app.post("/trips/<trip_id>/days/<int:day>/stops/<stop_id>/photo")
+@require_trip_member(email_source="form")
 def upload_trip_stop_photo(trip_id: str, day: int, stop_id: str):
-    email = (request.form.get("email") or "").strip()
     photo = request.files.get("photo")
-
-    if not email or not photo:
-        return jsonify(error="email and photo are required"), 400
+    if not photo:
+        return jsonify(error="photo is required"), 400
 
     day = max(1, min(day, 7))
 
-    # 權限檢查：owner 或 collaborator 才能上傳
-    trip_ref = db.collection("trips").document(trip_id)
-    trip_doc = trip_ref.get()
-    if not trip_doc.exists:
-        return jsonify(error="trip not found"), 404
-
-    trip = trip_doc.to_dict() or {}
-    owner = trip.get("ownerEmail")
-    collaborators = trip.get("collaborators", []) or []
-
-    if email != owner and email not in collaborators:
-        return jsonify(error="permission denied"), 403
-
     # stop 是否存在
-    stop_ref = trip_ref \
+    stop_ref = g.trip_ref \
         .collection("days").document(str(day)) \
         .collection("stops").document(stop_id)
 
@@ -1250,23 +4038,71 @@ def upload_trip_stop_photo(trip_id: str, day: int, stop_id: str):
     if not stop_doc.exists:
         return jsonify(error="stop not found"), 404
 
-    # 上傳到 Storage
-    filename = f"stop_{stop_id}_{uuid.uuid4().hex}.jpg"
-    storage_path = f"trips/{trip_id}/days/{day}/stops/{stop_id}/{filename}"
-
-    blob = bucket.blob(storage_path)
-    blob.upload_from_file(photo, content_type="image/jpeg")
-
-    # 簽名網址（7天）—測試很方便
-    url = blob.generate_signed_url(expiration=60 * 60 * 24 * 7)
+    # 上傳到 Storage（有 Pillow 會一起產生縮圖）
+    raw = read_uploaded_photo(photo)
+    if raw is None:
+        return jsonify(error="photo too large"), 413
+    try:
+        fields = save_photo(_trip_stop_photo_prefix(trip_id, day, stop_id), f"stop_{stop_id}", raw)
+    except ValueError:
+        return jsonify(error="invalid image"), 400
+    except FutureTimeoutError:
+        return jsonify(error="image processing timed out"), 503
 
     # 寫回 Firestore
     stop_ref.set(
-        {"photoUrl": url, "updatedAt": admin_firestore.SERVER_TIMESTAMP},
+        {**fields, "updatedAt": admin_firestore.SERVER_TIMESTAMP},
         merge=True
     )
 
-    return jsonify(photoUrl=url), 200
+    return jsonify(**photo_urls_of(fields)), 200
+
+
+def _trip_stop_photo_prefix(trip_id: str, day: int, stop_id: str) -> str:
+    return f"trips/{trip_id}/days/{day}/stops/{stop_id}/"
+
+
+# POST /trips/<tripId>/days/<day>/stops/<stopId>/photo/upload-url?email=xxx  body: { "contentType": "image/jpeg" }
+@app.post("/trips/<trip_id>/days/<int:day>/stops/<stop_id>/photo/upload-url")
+@require_trip_member()
+def create_trip_stop_photo_upload(trip_id: str, day: int, stop_id: str):
+    day = max(1, min(day, 7))
+    data = request.get_json(silent=True) or {}
+
+    stop_ref = g.trip_ref \
+        .collection("days").document(str(day)) \
+        .collection("stops").document(stop_id)
+    if not stop_ref.get().exists:
+        return jsonify(error="stop not found"), 404
+
+    payload, err = new_photo_upload(_trip_stop_photo_prefix(trip_id, day, stop_id), f"stop_{stop_id}", data.get("contentType"))
+    if err:
+        return jsonify(error=err), 400
+    return jsonify(payload)
+
+
+# POST /trips/<tripId>/days/<day>/stops/<stopId>/photo/finalize?email=xxx  body: { "storagePath": "..." }
+@app.post("/trips/<trip_id>/days/<int:day>/stops/<stop_id>/photo/finalize")
+@require_trip_member()
+def finalize_trip_stop_photo(trip_id: str, day: int, stop_id: str):
+    day = max(1, min(day, 7))
+    data = request.get_json(force=True) or {}
+
+    stop_ref = g.trip_ref \
+        .collection("days").document(str(day)) \
+        .collection("stops").document(stop_id)
+    if not stop_ref.get().exists:
+        return jsonify(error="stop not found"), 404
+
+    fields, err = finalize_photo_upload(_trip_stop_photo_prefix(trip_id, day, stop_id), data.get("storagePath"))
+    if err:
+        return jsonify(error=err[0]), err[1]
+
+    stop_ref.set(
+        {**fields, "updatedAt": admin_firestore.SERVER_TIMESTAMP},
+        merge=True
+    )
+    return jsonify(**photo_urls_of(fields)), 200
 
 # POST /me/trips/<tripId>/days/<day>/stops/<stopId>/ai?email=xxx
 # body: { "prompt": "....(optional)" }
@@ -1281,26 +4117,55 @@ AI_AFFECT_FIELDS = {
     "openingHours",
 }
 
-def build_stop_ai_prompt(trip_id: str, day: int, stop_id: str) -> tuple[str, any]:
-    """
-    讀取 stop + 組合 prompt
-    回傳：(prompt, stop_ref)
-    """
-    day = max(1, min(day, 7))
+LATLNG_EPSILON = 1e-6  # 約 0.1 m，前端 double 來回轉換的誤差不算修改
 
-    stop_ref = (
-        db.collection("trips").document(trip_id)
-        .collection("days").document(str(day))
-        .collection("stops").document(stop_id)
-    )
-    stop_doc = stop_ref.get()
-    if not stop_doc.exists:
-        raise RuntimeError("stop not found")
 
-    s = stop_doc.to_dict() or {}
+def normalize_opening_hours(oh):
+    """營業時間正規化成穩定的 JSON 字串（比對 / 指紋用）；空值一律視為 None"""
+    if not oh:
+        return None
+    if isinstance(oh, dict):
+        oh = {k: v for k, v in oh.items() if v not in (None, "", [], {})}
+        if isinstance(oh.get("weekday_text"), list):
+            oh["weekday_text"] = [str(x).strip() for x in oh["weekday_text"]]
+        if not oh:
+            return None
+    return json.dumps(oh, sort_keys=True, ensure_ascii=False, default=str)
+
+
+def ai_field_changed(field: str, old, new) -> bool:
+    if field in ("lat", "lng"):
+        return abs(float(old or 0.0) - float(new or 0.0)) > LATLNG_EPSILON
+    if field == "openingHours":
+        return normalize_opening_hours(old) != normalize_opening_hours(new)
+    return str(old or "").strip() != str(new or "").strip()
+
+
+def stop_ai_fingerprint(s: dict) -> str:
+    """影響 AI 建議的欄位指紋，跟 aiSuggestion 一起存（aiInputHash）"""
+    parts = {
+        "name": (s.get("name") or "").strip(),
+        "description": (s.get("description") or "").strip(),
+        "category": (s.get("category") or "").strip(),
+        "startTime": (s.get("startTime") or "").strip(),
+        "endTime": (s.get("endTime") or "").strip(),
+        "lat": round(float(s.get("lat") or 0.0), 6),
+        "lng": round(float(s.get("lng") or 0.0), 6),
+        "openingHours": normalize_opening_hours(s.get("openingHours")),
+    }
+    raw = json.dumps(parts, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+STOP_AI_OUTPUT_RULES = """1) 1~2 句即可，不要條列
+2) 不要太長（約 35-70 字；若要提醒遲到可略長）
+3) 不要出現「我無法查詢網路」之類字句
+4) 若可能不在營業時間內，必須出現「可能不在營業時間」的提醒
+5) 若可能遲到，必須明確提醒並給至少 2 個解法"""
 
-    
 
+def ensure_stop_opening_hours(stop_ref, s: dict):
+    """stop 沒有營業時間但有 placeId 時，去 Places 抓一次並寫回（會直接改 s）"""
     place_id = s.get("placeId")
     opening_hours = s.get("openingHours")
 
@@ -1317,32 +4182,29 @@ def build_stop_ai_prompt(trip_id: str, day: int, stop_id: str) -> tuple[str, any
     )
 
         if opening_hours:
+            compiled = compile_opening_hours(opening_hours)
             stop_ref.set(
                 {
                     "openingHours": opening_hours,
+                    "openingHoursCompiled": compiled,
                     },
                     merge=True
                     )
             s["openingHours"] = opening_hours
+            s["openingHoursCompiled"] = compiled
 
 
-    
-
-    # ===== 組內容 =====
-    name = (s.get("name") or "").strip() or "未命名地點"
-    category = (s.get("category") or "景點").strip() or "景點"
+def stop_prompt_hints(s: dict, late_flag, weekday: int = None):
+    """回傳：(營業狀態提示, 遲到規則)；weekday = 行程那天星期幾（None = 今天）"""
     start_time = (s.get("startTime") or "").strip()
-    end_time = (s.get("endTime") or "").strip()
-    time_part = f"{start_time} - {end_time}" if start_time and end_time else "未指定時間"
-    lat = s.get("lat") or 0.0
-    lng = s.get("lng") or 0.0
-    desc = (s.get("description") or "").strip() or "無"
 
-    # ===== 營業時間判斷 =====
-    opening_hours = s.get("openingHours")
+    # ===== 營業時間判斷（用編譯好的區間表）=====
     open_state = None
-    if opening_hours and start_time:
-        open_state = is_likely_open(opening_hours, start_time)
+    mins = parse_hhmm_to_minutes(start_time)
+    if mins is not None:
+        if weekday is None:
+            weekday = datetime.datetime.now(TRIP_TZ).weekday()
+        open_state = opening_state_at(stop_opening_compiled(s), weekday, mins)[0]
 
     if open_state is True:
         open_hint = "【營業狀態】你安排的時間可能在營業時間內，請正常給建議。"
@@ -1351,9 +4213,6 @@ def build_stop_ai_prompt(trip_id: str, day: int, stop_id: str) -> tuple[str, any
     else:
         open_hint = "【營業狀態】查不到確切營業時間，請不要亂猜，改成提醒使用者自行確認營業時間。"
 
-    # ===== 下一站距離/遲到風險判斷 =====
-    next_stop, dist_m, travel_min, late_flag, travel_hint = get_next_stop_info(trip_id, day, stop_id)
-
     if late_flag is True:
         late_rule = "【遲到規則】你必須明確提醒「可能遲到」，並提供至少 2 個可行解法（例如：縮短本站停留、調整下一站開始時間、改變交通方式、或把下一站改成備案）。"
     elif late_flag is False:
@@ -1361,6 +4220,56 @@ def build_stop_ai_prompt(trip_id: str, day: int, stop_id: str) -> tuple[str, any
     else:
         late_rule = "【遲到規則】資料不足無法判斷遲到，請用保守語氣提醒使用者自行確認路況與時間。"
 
+    return open_hint, late_rule
+
+
+def stop_prompt_fields(s: dict) -> str:
+    name = (s.get("name") or "").strip() or "未命名地點"
+    category = (s.get("category") or "景點").strip() or "景點"
+    start_time = (s.get("startTime") or "").strip()
+    end_time = (s.get("endTime") or "").strip()
+    time_part = f"{start_time} - {end_time}" if start_time and end_time else "未指定時間"
+    lat = s.get("lat") or 0.0
+    lng = s.get("lng") or 0.0
+    desc = (s.get("description") or "").strip() or "無"
+    return (
+        f"【地點】{name}\n"
+        f"【類型】{category}\n"
+        f"【時間】{time_part}\n"
+        f"【座標】({lat}, {lng})\n"
+        f"【使用者描述】{desc}"
+    )
+
+
+def build_stop_ai_prompt(trip_id: str, day: int, stop_id: str) -> tuple[str, any, str]:
+    """
+    讀取 stop + 組合 prompt
+    回傳：(prompt, stop_ref, 輸入指紋)
+    """
+    day = max(1, min(day, 7))
+
+    stop_ref = (
+        db.collection("trips").document(trip_id)
+        .collection("days").document(str(day))
+        .collection("stops").document(stop_id)
+    )
+    # 當天 stops 只讀一次：本站 + 下一站都從這裡拿
+    stops = load_day_stops(trip_id, day)
+    idx = next((i for i, x in enumerate(stops) if x["_id"] == stop_id), -1)
+    if idx < 0:
+        raise RuntimeError("stop not found")
+
+    s = stops[idx]
+    ensure_stop_opening_hours(stop_ref, s)
+
+    # ===== 下一站距離/遲到風險判斷（整天一次算完）=====
+    try:
+        _, _, _, late_flag, travel_hint = compute_day_legs(stops)[stop_id]
+    except Exception as e:
+        late_flag, travel_hint = None, f"【移動/遲到判斷】計算失敗：{e}"
+    weekday = trip_day_weekday(trip_acl_cache.get(trip_id), day)
+    open_hint, late_rule = stop_prompt_hints(s, late_flag, weekday)
+
     prompt = f"""
 你是一位旅遊行程規劃助理，請用「繁體中文」為下面這個行程點產生一段「很像旅遊 APP 卡片內的建議文字」。
 
@@ -1369,28 +4278,20 @@ def build_stop_ai_prompt(trip_id: str, day: int, stop_id: str) -> tuple[str, any
 {travel_hint}
 {late_rule}
 
-【地點】{name}
-【類型】{category}
-【時間】{time_part}
-【座標】({lat}, {lng})
-【使用者描述】{desc}
+{stop_prompt_fields(s)}
 
 輸出規則：
-1) 1~2 句即可，不要條列
-2) 不要太長（約 35-70 字；若要提醒遲到可略長）
-3) 不要出現「我無法查詢網路」之類字句
-4) 若可能不在營業時間內，必須出現「可能不在營業時間」的提醒
-5) 若可能遲到，必須明確提醒並給至少 2 個解法
+{STOP_AI_OUTPUT_RULES}
 """.strip()
 
-    return prompt, stop_ref
+    return prompt, stop_ref, stop_ai_fingerprint(s)
 
 
 def build_and_generate_ai_for_stop(trip_id: str, day: int, stop_id: str) -> str:
     """
     ✅ 共用：產生 AI 建議 + 寫回 Firestore，回傳文字
     """
-    prompt, stop_ref = build_stop_ai_prompt(trip_id, day, stop_id)
+    prompt, stop_ref, fingerprint = build_stop_ai_prompt(trip_id, day, stop_id)
 
     text = call_gemini(prompt).strip()
     if not text:
@@ -1399,6 +4300,7 @@ def build_and_generate_ai_for_stop(trip_id: str, day: int, stop_id: str) -> str:
     stop_ref.set(
         {
             "aiSuggestion": text,
+            "aiInputHash": fingerprint,
             "aiUpdatedAt": admin_firestore.SERVER_TIMESTAMP,
             "updatedAt": admin_firestore.SERVER_TIMESTAMP,  # 可選：同步更新
         },
@@ -1407,27 +4309,693 @@ def build_and_generate_ai_for_stop(trip_id: str, day: int, stop_id: str) -> str:
     return text
 
 
+# GET /me/trips/<tripId>/days/<day>/feasibility?email=xxx&mode=drive
+@app.get("/me/trips/<trip_id>/days/<int:day>/feasibility")
+@require_trip_member()
+def get_trip_day_feasibility(trip_id: str, day: int):
+    day = max(1, min(day, 7))
+    mode = (request.args.get("mode") or "drive").strip()
+    if mode not in TRAVEL_MODES:
+        return jsonify(error=f"mode must be one of {', '.join(TRAVEL_MODES)}"), 400
+
+    stops = load_day_stops(trip_id, day)
+    cols = compute_day_feasibility(stops, mode=mode)
+    legs = feasibility_rows(cols)
+
+    return jsonify(
+        day=day,
+        mode=mode,
+        stops=[{
+            "id": s["_id"],
+            "name": s.get("name", ""),
+            "startTime": s.get("startTime", ""),
+            "endTime": s.get("endTime", ""),
+        } for s in stops],
+        legs=legs,
+        opening=evaluate_opening_batch(stops, trip_day_weekday(g.trip, day)),
+        lateCount=sum(1 for leg in legs if leg["late"]),
+        totalTravelMin=sum(leg["travelMin"][mode] or 0 for leg in legs),
+    )
+
+
+# ==========================================
+# 行程排序最佳化（TSP with time windows）
+# ==========================================
+OPTIMIZER_DP_MAX_STOPS = 8           # 站數 <= 這個值用精確 DP，其餘用啟發式
+OPTIMIZER_MAX_STOPS = 40             # 建問題本身就是 O(n²)，超過就不算了
+OPTIMIZER_DEFAULT_BUDGET_MS = 300
+OPTIMIZER_MAX_BUDGET_MS = 1000
+OPTIMIZER_DEFAULT_STAY_MIN = 60
+OPTIMIZER_DEFAULT_DAY_START = 9 * 60
+OPTIMIZER_SLOT_MIN = 5               # 營業時間以 5 分鐘為單位預先展開
+_DAY_SLOTS = 24 * 60 // OPTIMIZER_SLOT_MIN
+
+
+class _OptimizerTimeout(Exception):
+    pass
+
+
+def _stop_stay_minutes(s: dict) -> int:
+    st = parse_hhmm_to_minutes((s.get("startTime") or "").strip())
+    et = parse_hhmm_to_minutes((s.get("endTime") or "").strip())
+    if st is not None and et is not None and et > st:
+        return et - st
+    return OPTIMIZER_DEFAULT_STAY_MIN
+
+
+def _next_valid_slots(s: dict, stay: int, weekday: int) -> list:
+    """
+    next_valid[slot] = 從這個 slot 起最早可以開始停留的 slot（整段停留都在營業中）；沒有則 None
+    查不到營業時間（opening_state_at 回 None）一律當作有開
+    """
+    compiled = stop_opening_compiled(s)
+    if not compiled:
+        return list(range(_DAY_SLOTS))
+
+    valid = []
+    for slot in range(_DAY_SLOTS):
+        start = slot * OPTIMIZER_SLOT_MIN
+        if start + stay > 24 * 60:
+            valid.append(False)
+            continue
+        # 要整段停留都落在同一個營業區間裡（中午休息、剛好打烊都不能跨過去）
+        state, until = opening_state_at(compiled, weekday, start)
+        valid.append(state is None or (state is True and (until is None or until >= stay)))
+    out = [None] * _DAY_SLOTS
+    nxt = None
+    for i in range(_DAY_SLOTS - 1, -1, -1):
+        if valid[i]:
+            nxt = i
+        out[i] = nxt
+    return out
+
+
+class ItineraryProblem:
+    def __init__(self, stops: list, mode: str = "drive", weekday: int = None, deadline: float = None):
+        """deadline（perf_counter）給了就邊建邊檢查，超過丟 _OptimizerTimeout"""
+        def check_deadline():
+            if deadline is not None and time.perf_counter() > deadline:
+                raise _OptimizerTimeout()
+
+        self.stops = stops
+        self.n = len(stops)
+        self.stay = [_stop_stay_minutes(s) for s in stops]
+        if weekday is None:
+            weekday = datetime.datetime.now(TRIP_TZ).weekday()
+        self.next_valid = []
+        for s, st in zip(stops, self.stay):
+            check_deadline()
+            self.next_valid.append(_next_valid_slots(s, st, weekday))
+
+        starts = [parse_hhmm_to_minutes((s.get("startTime") or "").strip()) for s in stops]
+        starts = [x for x in starts if x is not None]
+        self.day_start = min(starts) if starts else OPTIMIZER_DEFAULT_DAY_START
+
+        # 兩兩車程（缺座標的站移動時間算 0）
+        self.travel = [[0] * self.n for _ in range(self.n)]
+        for i, a in enumerate(stops):
+            check_deadline()
+            if not _has_coord(a):
+                continue
+            for j, b in enumerate(stops):
+                if i == j or not _has_coord(b):
+                    continue
+                d = haversine_meters(float(a["lat"]), float(a["lng"]), float(b["lat"]), float(b["lng"]))
+                self.travel[i][j] = estimate_travel_minutes_by_distance(d, mode=mode)
+
+    def service_start(self, i: int, arrive: int):
+        """抵達後最早能開始停留的時間（可能要等開門）；當天排不進去回 None"""
+        if arrive >= 24 * 60:
+            return None
+        slot = arrive // OPTIMIZER_SLOT_MIN
+        if self.next_valid[i][slot] == slot:
+            return arrive
+        slot += 1
+        if slot >= _DAY_SLOTS:
+            return None
+        ns = self.next_valid[i][slot]
+        if ns is None:
+            return None
+        return max(arrive, ns * OPTIMIZER_SLOT_MIN)
+
+    def simulate(self, route: list):
+        """回傳：(違反時間窗數, 總車程, 結束時間, 每站排程)"""
+        t = self.day_start
+        travel_total = 0
+        violations = 0
+        plan = []
+        prev = None
+        for i in route:
+            tr = self.travel[prev][i] if prev is not None else 0
+            arrive = t + tr
+            start = self.service_start(i, arrive)
+            ok = start is not None
+            if not ok:
+                violations += 1
+                start = arrive
+            end = start + self.stay[i]
+            plan.append({
+                "index": i, "travelFromPrevMin": tr, "arriveMin": arrive,
+                "startMin": start, "endMin": end, "waitMin": start - arrive, "openOk": ok,
+            })
+            travel_total += tr
+            t = end
+            prev = i
+        return violations, travel_total, t, plan
+
+    def cost(self, route: list):
+        v, tr, end, _ = self.simulate(route)
+        return (v, tr, end)
+
+
+def _solve_dp(p: ItineraryProblem, fixed_first, deadline: float):
+    """Held-Karp + (車程, 時間) Pareto 前緣，時間窗下仍是精確解"""
+    n = p.n
+    full = (1 << n) - 1
+    labels = {}
+    firsts = [fixed_first] if fixed_first is not None else range(n)
+    for i in firsts:
+        st = p.service_start(i, p.day_start)
+        if st is not None:
+            labels[(1 << i, i)] = [(0, st + p.stay[i], (i,))]
+
+    for mask in sorted(range(1, full + 1), key=lambda m: bin(m).count("1")):
+        if time.perf_counter() > deadline:
+            raise _OptimizerTimeout()
+        for last in range(n):
+            front = labels.get((mask, last))
+            if not front:
+                continue
+            for j in range(n):
+                if mask & (1 << j):
+                    continue
+                key = (mask | (1 << j), j)
+                for travel_sum, t, route in front:
+                    tr = p.travel[last][j]
+                    st = p.service_start(j, t + tr)
+                    if st is None:
+                        continue
+                    cand = (travel_sum + tr, st + p.stay[j], route + (j,))
+                    cur = labels.setdefault(key, [])
+                    if any(a <= cand[0] and b <= cand[1] for a, b, _ in cur):
+                        continue
+                    cur[:] = [x for x in cur if not (cand[0] <= x[0] and cand[1] <= x[1])]
+                    cur.append(cand)
+
+    best = None
+    for last in range(n):
+        for travel_sum, t, route in labels.get((full, last), []):
+            if best is None or (travel_sum, t) < best[:2]:
+                best = (travel_sum, t, route)
+    return list(best[2]) if best else None
+
+
+def _solve_heuristic(p: ItineraryProblem, fixed_first, deadline: float, seed_route: list):
+    """nearest-neighbour 起手 + 2-opt / or-opt 改善，時間到就停"""
+    n = p.n
+    remaining = set(range(n))
+    route = []
+    if fixed_first is not None:
+        route.append(fixed_first)
+        remaining.discard(fixed_first)
+    t = p.day_start
+    while remaining:
+        prev = route[-1] if route else None
+        best = None
+        for j in remaining:
+            tr = p.travel[prev][j] if prev is not None else 0
+            st = p.service_start(j, t + tr)
+            key = (st is None, tr if prev is not None else (st or 10 ** 9), j)
+            if best is None or key < best[0]:
+                best = (key, j, st if st is not None else t + tr)
+        _, j, st = best
+        route.append(j)
+        remaining.discard(j)
+        t = st + p.stay[j]
+
+    best_route, best_cost = route, p.cost(route)
+    seed_cost = p.cost(seed_route)
+    if seed_cost < best_cost:
+        best_route, best_cost = list(seed_route), seed_cost
+
+    lo = 1 if fixed_first is not None else 0
+    improved = True
+    timed_out = False
+    while improved and not timed_out:
+        improved = False
+        # 2-opt：反轉一段
+        for i in range(lo, n - 1):
+            for j in range(i + 1, n):
+                if time.perf_counter() > deadline:
+                    timed_out = True
+                    break
+                cand = best_route[:i] + best_route[i:j + 1][::-1] + best_route[j + 1:]
+                c = p.cost(cand)
+                if c < best_cost:
+                    best_route, best_cost, improved = cand, c, True
+            if timed_out:
+                break
+        # or-opt：把長度 1~3 的一段搬到別的位置
+        for seg_len in (1, 2, 3):
+            if timed_out:
+                break
+            for i in range(lo, n - seg_len + 1):
+                seg = best_route[i:i + seg_len]
+                rest = best_route[:i] + best_route[i + seg_len:]
+                for k in range(lo, len(rest) + 1):
+                    if time.perf_counter() > deadline:
+                        timed_out = True
+                        break
+                    if k == i:
+                        continue
+                    cand = rest[:k] + seg + rest[k:]
+                    c = p.cost(cand)
+                    if c < best_cost:
+                        best_route, best_cost, improved = cand, c, True
+                        break
+                if timed_out:
+                    break
+    return best_route, timed_out
+
+
+def optimize_day_order(stops: list, mode: str = "drive", fix_first: bool = True,
+                       budget_ms: int = OPTIMIZER_DEFAULT_BUDGET_MS, weekday: int = None) -> dict:
+    """stops 需已排序（目前順序）；回傳建議順序與時間，不會寫回 Firestore"""
+    t0 = time.perf_counter()
+    deadline = t0 + budget_ms / 1000.0
+    if not stops:
+        return {"method": "none", "order": [], "stops": [], "totalTravelMin": 0,
+                "currentTotalTravelMin": 0, "violations": 0, "timedOut": False}
+
+    try:
+        p = ItineraryProblem(stops, mode=mode, weekday=weekday, deadline=deadline)
+    except _OptimizerTimeout:
+        # 連問題都建不完：照原順序回，不給排程
+        return {"method": "none", "mode": mode, "order": [s["_id"] for s in stops], "changed": False,
+                "stops": [], "totalTravelMin": None, "currentTotalTravelMin": None,
+                "violations": None, "currentViolations": None, "timedOut": True,
+                "elapsedMs": round((time.perf_counter() - t0) * 1000, 1)}
+    current = list(range(p.n))
+    fixed_first = 0 if fix_first else None
+
+    method = "dp"
+    timed_out = False
+    route = None
+    if p.n <= OPTIMIZER_DP_MAX_STOPS:
+        try:
+            route = _solve_dp(p, fixed_first, deadline)
+        except _OptimizerTimeout:
+            timed_out = True
+    if route is None:
+        method = "heuristic"
+        route, h_timeout = _solve_heuristic(p, fixed_first, deadline, current)
+        timed_out = timed_out or h_timeout
+
+    # 沒有比較好就維持原順序
+    if p.cost(current) <= p.cost(route):
+        route = current
+
+    violations, travel_total, _, plan = p.simulate(route)
+    cur_v, cur_travel, _, _ = p.simulate(current)
+
+    out_stops = []
+    for row in plan:
+        s = stops[row["index"]]
+        out_stops.append({
+            "id": s["_id"],
+            "name": s.get("name", ""),
+            "arriveTime": minutes_to_hhmm(row["arriveMin"]),
+            "startTime": minutes_to_hhmm(row["startMin"]),
+            "endTime": minutes_to_hhmm(row["endMin"]),
+            "waitMin": row["waitMin"],
+            "travelFromPrevMin": row["travelFromPrevMin"],
+            "openOk": row["openOk"],
+        })
+
+    return {
+        "method": method,
+        "mode": mode,
+        "order": [stops[i]["_id"] for i in route],
+        "changed": route != current,
+        "stops": out_stops,
+        "totalTravelMin": travel_total,
+        "currentTotalTravelMin": cur_travel,
+        "violations": violations,
+        "currentViolations": cur_v,
+        "timedOut": timed_out,
+        "elapsedMs": round((time.perf_counter() - t0) * 1000, 1),
+    }
+
+
+# POST /me/trips/<tripId>/days/<day>/optimize?email=xxx
+# body: { "mode": "drive", "fixFirst": true, "budgetMs": 300 }（都可省略）
+@app.post("/me/trips/<trip_id>/days/<int:day>/optimize")
+@require_trip_member()
+def optimize_trip_day(trip_id: str, day: int):
+    day = max(1, min(day, 7))
+    data = request.get_json(silent=True) or {}
+    mode = (data.get("mode") or "drive").strip()
+    if mode not in TRAVEL_MODES:
+        return jsonify(error=f"mode must be one of {', '.join(TRAVEL_MODES)}"), 400
+    fix_first = data.get("fixFirst", True)
+    if isinstance(fix_first, str):
+        fix_first = fix_first.strip().lower() not in ("0", "false", "no", "")
+    elif not isinstance(fix_first, bool):
+        return jsonify(error="fixFirst must be a boolean"), 400
+    try:
+        budget_ms = int(data.get("budgetMs") or OPTIMIZER_DEFAULT_BUDGET_MS)
+    except Exception:
+        budget_ms = OPTIMIZER_DEFAULT_BUDGET_MS
+    budget_ms = max(10, min(budget_ms, OPTIMIZER_MAX_BUDGET_MS))
+
+    stops = load_day_stops(trip_id, day)
+    if len(stops) > OPTIMIZER_MAX_STOPS:
+        return jsonify(error=f"too many stops to optimize (max {OPTIMIZER_MAX_STOPS})"), 400
+    return jsonify(optimize_day_order(
+        stops, mode=mode, fix_first=fix_first, budget_ms=budget_ms,
+        weekday=trip_day_weekday(g.trip, day),
+    ))
+
+
+# ==========================================
+# 整天批次生成 AI（一次 prompt 回傳每站 JSON）
+# ==========================================
+AI_DAY_CHUNK_SIZE = 8      # 一個 prompt 最多幾站，太多就切段
+AI_DAY_MAX_PARALLEL = 3    # 切段後最多同時打幾個 Gemini
+FIRESTORE_BATCH_LIMIT = 500
+
+
+def build_day_ai_prompt(entries: list, weekday: int = None) -> str:
+    """entries: [(stop_dict, travel_hint, late_flag), ...]"""
+    blocks = []
+    for s, travel_hint, late_flag in entries:
+        open_hint, late_rule = stop_prompt_hints(s, late_flag, weekday)
+        blocks.append(
+            f"### id: {s['_id']}\n"
+            f"{stop_prompt_fields(s)}\n"
+            f"{open_hint}\n"
+            f"{travel_hint}\n"
+            f"{late_rule}"
+        )
+
+    return f"""
+你是一位旅遊行程規劃助理，請用「繁體中文」為下面每一個行程點各產生一段「很像旅遊 APP 卡片內的建議文字」。
+
+{chr(10).join(blocks)}
+
+每一站的輸出規則：
+{STOP_AI_OUTPUT_RULES}
+
+只輸出 JSON，不要加任何說明或 markdown，格式：
+{{"suggestions": [{{"id": "行程點 id", "text": "建議文字"}}]}}
+""".strip()
+
+
+def parse_day_ai_response(text: str) -> dict:
+    """從 Gemini 回覆中取出 {id: text}；格式壞掉就回空 dict"""
+    raw = (text or "").strip()
+    raw = re.sub(r"^```(?:json)?\s*|\s*```$", "", raw)
+    i, j = raw.find("{"), raw.rfind("}")
+    if i < 0 or j <= i:
+        return {}
+    try:
+        data = json.loads(raw[i:j + 1])
+    except Exception:
+        return {}
+
+    out = {}
+    for item in (data.get("suggestions") or []) if isinstance(data, dict) else []:
+        if not isinstance(item, dict):
+            continue
+        sid = str(item.get("id") or "").strip()
+        txt = str(item.get("text") or "").strip()
+        if sid and txt:
+            out[sid] = txt
+    return out
+
+
+def generate_day_ai(trip_id: str, day: int):
+    """
+    讀一次當天 stops → 一次算完所有移動段 → 切段打 Gemini → 批次寫回
+    回傳：(results {stop_id: text}, missing [stop_id])
+    """
+    stops = load_day_stops(trip_id, day)
+    if not stops:
+        return {}, []
+
+    stops_col = db.collection("trips").document(trip_id) \
+        .collection("days").document(str(day)).collection("stops")
+
+    for s in stops:
+        ensure_stop_opening_hours(stops_col.document(s["_id"]), s)
+
+    legs = compute_day_legs(stops)
+    entries = [(s, legs[s["_id"]][4], legs[s["_id"]][3]) for s in stops]
+    weekday = trip_day_weekday(trip_acl_cache.get(trip_id), day)
+    chunks = [entries[i:i + AI_DAY_CHUNK_SIZE] for i in range(0, len(entries), AI_DAY_CHUNK_SIZE)]
+
+    def run_chunk(chunk):
+        ids = {s["_id"] for s, _, _ in chunk}
+        parsed = parse_day_ai_response(call_gemini(build_day_ai_prompt(chunk, weekday)))
+        return {k: v for k, v in parsed.items() if k in ids}
+
+    results = {}
+    if len(chunks) == 1:
+        results.update(run_chunk(chunks[0]))
+    else:
+        with ThreadPoolExecutor(max_workers=min(AI_DAY_MAX_PARALLEL, len(chunks))) as pool:
+            for part in pool.map(run_chunk, chunks):
+                results.update(part)
+
+    by_id = {s["_id"]: s for s in stops}
+    items = list(results.items())
+    for i in range(0, len(items), FIRESTORE_BATCH_LIMIT):
+        batch = db.batch()
+        for sid, text in items[i:i + FIRESTORE_BATCH_LIMIT]:
+            batch.set(stops_col.document(sid), {
+                "aiSuggestion": text,
+                "aiInputHash": stop_ai_fingerprint(by_id[sid]),
+                "aiUpdatedAt": admin_firestore.SERVER_TIMESTAMP,
+                "updatedAt": admin_firestore.SERVER_TIMESTAMP,
+            }, merge=True)
+        batch.commit()
+
+    missing = [s["_id"] for s in stops if s["_id"] not in results]
+    return results, missing
+
+
+# POST /me/trips/<tripId>/days/<day>/ai?email=xxx
+@app.post("/me/trips/<trip_id>/days/<int:day>/ai")
+@require_trip_member()
+def generate_day_ai_and_save(trip_id: str, day: int):
+    day = max(1, min(day, 7))
+
+    try:
+        results, missing = generate_day_ai(trip_id, day)
+    except Exception as e:
+        return jsonify(error=str(e)), 500
+
+    return jsonify(
+        ok=True,
+        results=[{"id": k, "aiSuggestion": v} for k, v in results.items()],
+        missing=missing,
+    )
+
+
+# ==========================================
+# 背景 AI 任務佇列（aiJobs collection 當持久化任務表）
+# ==========================================
+AI_JOB_WORKERS = int(os.environ.get("AI_JOB_WORKERS") or 4)
+AI_JOB_DEBOUNCE_SEC = float(os.environ.get("AI_JOB_DEBOUNCE_SEC") or 2.0)
+AI_JOB_WRITE_WAIT_SEC = 10.0   # 同一個 stop 的第二個請求最多等第一個把 job doc 寫完多久
+
+ai_job_executor = ThreadPoolExecutor(max_workers=AI_JOB_WORKERS, thread_name_prefix="ai-job")
+_ai_job_lock = threading.Lock()
+# (trip_id, day, stop_id) -> {"jobId", "timer": Timer（doc 還在寫時為 None）, "written": Event, "ok": bool}
+_ai_job_pending = {}
+
+
+def _ai_job_ref(job_id: str):
+    return db.collection("aiJobs").document(job_id)
+
+
+def _run_ai_job(job_id: str, trip_id: str, day: int, stop_id: str):
+    ref = _ai_job_ref(job_id)
+    ref.set({"status": "running", "updatedAt": admin_firestore.SERVER_TIMESTAMP}, merge=True)
+    try:
+        text = build_and_generate_ai_for_stop(trip_id, day, stop_id)
+        ref.set({
+            "status": "done",
+            "text": text,
+            "updatedAt": admin_firestore.SERVER_TIMESTAMP,
+        }, merge=True)
+    except Exception as e:
+        ref.set({
+            "status": "error",
+            "error": str(e),
+            "updatedAt": admin_firestore.SERVER_TIMESTAMP,
+        }, merge=True)
+
+
+def _fire_ai_job(key):
+    with _ai_job_lock:
+        pending = _ai_job_pending.pop(key, None)
+    if pending is None:
+        return
+    trip_id, day, stop_id = key
+    ai_job_executor.submit(_run_ai_job, pending["jobId"], trip_id, day, stop_id)
+
+
+def enqueue_stop_ai_job(trip_id: str, day: int, stop_id: str, email: str = "") -> str:
+    """
+    排一個 stop 的 AI 生成任務，回傳 jobId
+    同一個 stop 在 debounce 時間內重複送出會合併成同一個任務（沿用同一個 jobId）
+    """
+    key = (trip_id, day, stop_id)
+    with _ai_job_lock:
+        pending = _ai_job_pending.get(key)
+        if pending is None:
+            job_id = uuid.uuid4().hex
+            written = threading.Event()
+            _ai_job_pending[key] = {"jobId": job_id, "timer": None, "written": written, "ok": False}
+        elif pending["timer"] is not None:
+            pending["timer"].cancel()
+            _start_ai_job_timer(key, pending)
+            return pending["jobId"]
+
+    if pending is not None:
+        # 建立者還在寫 job doc：等它寫完，寫失敗就不能把這個 jobId 交出去
+        if not pending["written"].wait(timeout=AI_JOB_WRITE_WAIT_SEC) or not pending["ok"]:
+            raise RuntimeError("AI job could not be created")
+        with _ai_job_lock:
+            cur = _ai_job_pending.get(key)
+            if cur is pending and cur["timer"] is not None:
+                cur["timer"].cancel()
+                _start_ai_job_timer(key, cur)
+        return pending["jobId"]
+
+    # Firestore 寫入不要卡在 lock 裡；先寫 doc 再起 timer，避免 timer 先跑到還沒寫好的 job
+    entry = _ai_job_pending[key]
+    try:
+        _ai_job_ref(job_id).set({
+            "tripId": trip_id,
+            "day": day,
+            "stopId": stop_id,
+            "requestedBy": email,
+            "status": "pending",
+            "createdAt": admin_firestore.SERVER_TIMESTAMP,
+            "updatedAt": admin_firestore.SERVER_TIMESTAMP,
+        })
+    except Exception:
+        with _ai_job_lock:
+            _ai_job_pending.pop(key, None)
+        written.set()
+        raise
+
+    with _ai_job_lock:
+        entry["ok"] = True
+        _start_ai_job_timer(key, entry)
+    written.set()
+    return job_id
+
+
+def _start_ai_job_timer(key, entry: dict):
+    """呼叫端要持有 _ai_job_lock"""
+    timer = threading.Timer(AI_JOB_DEBOUNCE_SEC, _fire_ai_job, args=(key,))
+    timer.daemon = True
+    entry["timer"] = timer
+    _ai_job_pending[key] = entry
+    timer.start()
+
+
+def _run_day_ai_job(job_id: str, trip_id: str, day: int):
+    ref = _ai_job_ref(job_id)
+    ref.set({"status": "running", "updatedAt": admin_firestore.SERVER_TIMESTAMP}, merge=True)
+    try:
+        results, missing = generate_day_ai(trip_id, day)
+        ref.set({
+            "status": "done",
+            "updatedStops": len(results),
+            "missing": missing,
+            "updatedAt": admin_firestore.SERVER_TIMESTAMP,
+        }, merge=True)
+    except Exception as e:
+        ref.set({
+            "status": "error",
+            "error": str(e),
+            "updatedAt": admin_firestore.SERVER_TIMESTAMP,
+        }, merge=True)
+
+
+def enqueue_day_ai_job(trip_id: str, day: int, email: str = "") -> str:
+    """排一個整天的 AI 生成任務（一次 prompt 處理所有 stop），回傳 jobId"""
+    job_id = uuid.uuid4().hex
+    _ai_job_ref(job_id).set({
+        "tripId": trip_id,
+        "day": day,
+        "stopId": None,
+        "kind": "day",
+        "requestedBy": email,
+        "status": "pending",
+        "createdAt": admin_firestore.SERVER_TIMESTAMP,
+        "updatedAt": admin_firestore.SERVER_TIMESTAMP,
+    })
+    ai_job_executor.submit(_run_day_ai_job, job_id, trip_id, day)
+    return job_id
+
+
+def resume_pending_ai_jobs():
+    """重啟後把還沒跑完的任務重新排進佇列"""
+    for status in ("pending", "running"):
+        for doc in db.collection("aiJobs").where("status", "==", status).get():
+            j = doc.to_dict() or {}
+            if not j.get("tripId"):
+                continue
+            day = int(j.get("day") or 1)
+            if j.get("kind") == "day":
+                ai_job_executor.submit(_run_day_ai_job, doc.id, j["tripId"], day)
+            elif j.get("stopId"):
+                ai_job_executor.submit(_run_ai_job, doc.id, j["tripId"], day, j["stopId"])
+
+
+# GET /me/trips/<tripId>/ai/jobs/<jobId>?email=xxx
+@app.get("/me/trips/<trip_id>/ai/jobs/<job_id>")
+@require_trip_member()
+def get_ai_job_status(trip_id: str, job_id: str):
+    job_doc = _ai_job_ref(job_id).get()
+    if not job_doc.exists:
+        return jsonify(error="job not found"), 404
+
+    j = job_doc.to_dict() or {}
+    if j.get("tripId") != trip_id:
+        return jsonify(error="job not found"), 404
+
+    return jsonify(
+        jobId=job_id,
+        status=j.get("status", "pending"),
+        day=j.get("day"),
+        stopId=j.get("stopId"),
+        text=j.get("text"),
+        updatedStops=j.get("updatedStops"),
+        missing=j.get("missing"),
+        error=j.get("error"),
+        updatedAtMillis=_ms_from_ts(j.get("updatedAt")),
+    )
+
+
 # ==========================================
 # 1) 手動生成 AI（POST）
 # ==========================================
 @app.post("/me/trips/<trip_id>/days/<int:day>/stops/<stop_id>/ai")
+@require_trip_member()
 def generate_stop_ai_and_save(trip_id: str, day: int, stop_id: str):
-    email = (request.args.get("email") or "").strip()
-    if not email:
-        return jsonify(error="email is required"), 400
-
+    email = g.email
     day = max(1, min(day, 7))
 
-    # ===== 權限檢查（owner 或 collaborators）=====
-    trip_doc = db.collection("trips").document(trip_id).get()
-    if not trip_doc.exists:
-        return jsonify(error="trip not found"), 404
-
-    trip = trip_doc.to_dict() or {}
-    owner = (trip.get("ownerEmail") or "").strip()
-    collaborators = trip.get("collaborators", []) or []
-    if email != owner and email not in collaborators:
-        return jsonify(error="permission denied"), 403
+    # ?async=1 → 丟到背景佇列，馬上回 jobId
+    if (request.args.get("async") or "").strip() in ("1", "true"):
+        job_id = enqueue_stop_ai_job(trip_id, day, stop_id, email)
+        return jsonify(status="pending", jobId=job_id), 202
 
     # ===== 直接用共用方法生成 =====
     try:
@@ -1446,23 +5014,11 @@ def generate_stop_ai_and_save(trip_id: str, day: int, stop_id: str):
 # 2) 更新 stop（PUT）— 有改到影響 AI 的欄位就自動刷新
 # ==========================================
 @app.put("/me/trips/<trip_id>/days/<int:day>/stops/<stop_id>")
+@require_trip_member()
 def update_trip_day_stop(trip_id: str, day: int, stop_id: str):
-    email = (request.args.get("email") or "").strip()
-    if not email:
-        return jsonify(error="email is required"), 400
+    email = g.email
     day = max(1, min(day, 7))
 
-    # ===== 權限檢查 =====
-    trip_doc = db.collection("trips").document(trip_id).get()
-    if not trip_doc.exists:
-        return jsonify(error="trip not found"), 404
-
-    trip = trip_doc.to_dict() or {}
-    owner = (trip.get("ownerEmail") or "").strip()
-    collaborators = trip.get("collaborators", []) or []
-    if email != owner and email not in collaborators:
-        return jsonify(error="permission denied"), 403
-
     stop_ref = (
         db.collection("trips").document(trip_id)
         .collection("days").document(str(day))
@@ -1475,46 +5031,227 @@ def update_trip_day_stop(trip_id: str, day: int, stop_id: str):
     data = request.get_json(force=True) or {}
 
     # ===== 收集更新欄位 =====
-    updates = {}
-
-    # 文字欄位
-    for k in ["name", "description", "category", "startTime", "endTime"]:
-        if k in data:
-            updates[k] = (data.get(k) or "").strip()
-
-    # 數字欄位
-    if "lat" in data:
-        updates["lat"] = float(data.get("lat") or 0.0)
-    if "lng" in data:
-        updates["lng"] = float(data.get("lng") or 0.0)
+    updates = stop_updates_from_json(data)
 
-    # 物件欄位
-    if "openingHours" in data:
-        updates["openingHours"] = data.get("openingHours")
+    # Android 每次都送整個 stop：只留下值真的有變的欄位
+    cur = stop_doc.to_dict() or {}
+    updates = {k: v for k, v in updates.items() if ai_field_changed(k, cur.get(k), v)}
 
     if not updates:
         return jsonify(ok=True, refreshed=False)
 
     # ===== 寫入 Firestore =====
+    with_compiled_opening_hours(updates)
     updates["updatedAt"] = admin_firestore.SERVER_TIMESTAMP
     stop_ref.set(updates, merge=True)
 
-    # ===== 判斷是否需要刷新 AI =====
-    need_refresh = any(k in AI_AFFECT_FIELDS for k in updates.keys())
+    # ===== 判斷是否需要刷新 AI：輸入指紋沒變就不重算 =====
+    merged = dict(cur)
+    merged.update(updates)
+    need_refresh = (
+        any(k in AI_AFFECT_FIELDS for k in updates.keys())
+        and (not cur.get("aiSuggestion") or cur.get("aiInputHash") != stop_ai_fingerprint(merged))
+    )
     if not need_refresh:
         return jsonify(ok=True, refreshed=False)
 
-    # ===== 自動刷新 AI =====
+    # ===== 背景刷新 AI（連續存檔會合併成一次）=====
     try:
-        text = build_and_generate_ai_for_stop(trip_id, day, stop_id)
-        return jsonify(ok=True, refreshed=True, aiSuggestion=text)
+        job_id = enqueue_stop_ai_job(trip_id, day, stop_id, email)
+        return jsonify(ok=True, refreshed="pending", jobId=job_id)
     except Exception as e:
-        # 更新成功，但 AI 刷新失敗
+        # 更新成功，但 AI 任務排不進去
         return jsonify(ok=True, refreshed=False, aiError=str(e))
 
 
+# ==========================================
+# 3) 批次 upsert / 刪除 / 排序（一次送整天的 stops）
+# ==========================================
+BULK_STOPS_MAX_OPS = 200   # 一個 WriteBatch 上限 500；delete 會多寫一筆 tombstone，最多 400
+
+
+# POST /me/trips/<tripId>/days/<day>/stops/bulk?email=xxx
+# body: {
+#   "ops": [
+#     {"op": "create", "name": "...", "lat": 25.0, "lng": 121.5, "startTime": "09:00", ...},
+#     {"op": "update", "id": "<stopId>", "startTime": "10:30"},
+#     {"op": "delete", "id": "<stopId>"}
+#   ],
+#   "refreshAi": true     // 可省略；true 就在寫完後排一個整天 AI 任務
+# }
+# op 省略時：有 id = update、沒 id = create
+# order 欄位（顯示順序）：有出現在 ops 的既有 stop 照陣列順序在它們原本佔的位置間重排，新增的接在最後；
+# 寫完整天重新編號 0..n-1，不會跟之前的 order 撞號
+@app.post("/me/trips/<trip_id>/days/<int:day>/stops/bulk")
+@require_trip_member()
+def bulk_upsert_trip_day_stops(trip_id: str, day: int):
+    day = max(1, min(day, 7))
+    data = request.get_json(force=True) or {}
+    ops = data.get("ops")
+    if not isinstance(ops, list) or not ops:
+        return jsonify(error="ops is required"), 400
+    if len(ops) > BULK_STOPS_MAX_OPS:
+        return jsonify(error=f"too many ops (max {BULK_STOPS_MAX_OPS})"), 400
+
+    stops_col = g.trip_ref.collection("days").document(str(day)).collection("stops")
+
+    # ===== 先正規化 op，再一次讀出所有要改 / 刪的 stop =====
+    normalized = []
+    for i, raw in enumerate(ops):
+        if not isinstance(raw, dict):
+            return jsonify(error=f"ops[{i}] must be an object"), 400
+        stop_id = (raw.get("id") or "").strip()
+        op = (raw.get("op") or ("update" if stop_id else "create")).strip()
+        if op not in ("create", "update", "delete"):
+            return jsonify(error=f"ops[{i}]: op must be create, update or delete"), 400
+        if op != "create" and not stop_id:
+            return jsonify(error=f"ops[{i}]: id is required for {op}"), 400
+        normalized.append((i, op, stop_id, raw))
+
+    # 整天讀一次：要改的 stop 驗證用，重新編 order 也要知道其他 stop 原本的順序
+    current = {d.id: d.to_dict() or {} for d in stops_col.get()}
+
+    # ===== 驗證 + 組寫入清單（全部過了才進 batch commit，一次原子寫入）=====
+    writes = []   # (op, stop_id, data)
+    ids = []
+    created = updated = deleted = 0
+    for i, op, stop_id, raw in normalized:
+        if op == "delete":
+            if stop_id not in current:
+                return jsonify(error=f"ops[{i}]: stop not found"), 404
+            writes.append(("delete", stop_id, None))
+            ids.append(stop_id)
+            deleted += 1
+            continue
+
+        try:
+            fields = stop_updates_from_json(raw)
+        except (TypeError, ValueError):
+            return jsonify(error=f"ops[{i}]: lat and lng must be numbers"), 400
+
+        if op == "create":
+            if raw.get("lat") is None or raw.get("lng") is None:
+                return jsonify(error=f"ops[{i}]: lat and lng are required"), 400
+            stop = {
+                "tripId": trip_id,
+                "day": day,
+                "name": fields.get("name") or "新景點",
+                "description": fields.get("description", ""),
+                "lat": fields["lat"],
+                "lng": fields["lng"],
+                "photoUrl": None,
+                "startTime": fields.get("startTime", ""),
+                "endTime": fields.get("endTime", ""),
+                "aiSuggestion": "",
+                "category": fields.get("category") or "景點",
+                "createdAt": admin_firestore.SERVER_TIMESTAMP,
+                "updatedAt": admin_firestore.SERVER_TIMESTAMP,
+            }
+            for k in ("openingHours", "placeId"):
+                if k in fields:
+                    stop[k] = fields[k]
+            with_compiled_opening_hours(stop)
+            err = validate_stop_times(stop["startTime"], stop["endTime"])
+            if err:
+                return jsonify(error=f"ops[{i}]: {err}"), 400
+            ref = stops_col.document()
+            writes.append(("create", ref.id, stop))
+            ids.append(ref.id)
+            created += 1
+        else:
+            if stop_id not in current:
+                return jsonify(error=f"ops[{i}]: stop not found"), 404
+            cur = current[stop_id]
+            merged = dict(cur)
+            merged.update(fields)
+            err = validate_stop_times(merged.get("startTime") or "", merged.get("endTime") or "")
+            if err:
+                return jsonify(error=f"ops[{i}]: {err}"), 400
+            fields = {k: v for k, v in fields.items() if ai_field_changed(k, cur.get(k), v)}
+            with_compiled_opening_hours(fields)
+            fields["updatedAt"] = admin_firestore.SERVER_TIMESTAMP
+            writes.append(("update", stop_id, fields))
+            ids.append(stop_id)
+            updated += 1
+
+    # ===== 重新編整天的 order =====
+    removed = {sid for op, sid, _ in writes if op == "delete"}
+    touched = list(dict.fromkeys(sid for op, sid, _ in writes if op == "update" and sid not in removed))
+    touched_set = set(touched)
+    final = sorted(current, key=lambda sid: stop_order_key(
+        current[sid], (_ms_from_ts(current[sid].get("createdAt")) or 0, sid)))
+    slots = [k for k, sid in enumerate(final) if sid in touched_set]
+    for k, sid in zip(slots, touched):
+        final[k] = sid
+    final = [sid for sid in final if sid not in removed]
+    final += [sid for op, sid, _ in writes if op == "create"]
+    new_order = {sid: k for k, sid in enumerate(final)}
+
+    renumber = [
+        sid for sid in final
+        if sid in current and sid not in touched_set and current[sid].get("order") != new_order[sid]
+    ]
+    n_writes = len(writes) + len(removed) + len(renumber)   # delete 另外寫 tombstone
+    if n_writes > FIRESTORE_BATCH_LIMIT:
+        return jsonify(error=f"too many writes in one batch (max {FIRESTORE_BATCH_LIMIT})"), 400
+
+    batch = db.batch()
+    for op, sid, payload in writes:
+        ref = stops_col.document(sid)
+        if op == "delete":
+            batch.delete(ref)
+            batch.set(stop_tombstone_ref(g.trip_ref, sid), stop_tombstone(day))
+        elif op == "create":
+            batch.set(ref, {**payload, "order": new_order[sid]})
+        elif sid in new_order:
+            batch.set(ref, {**payload, "order": new_order[sid]}, merge=True)
+        else:
+            # 同一批後面又刪掉的 stop，不用排順序
+            batch.set(ref, payload, merge=True)
+    for sid in renumber:
+        batch.update(stops_col.document(sid), {
+            "order": new_order[sid],
+            "updatedAt": admin_firestore.SERVER_TIMESTAMP,
+        })
+    batch.commit()
+
+    out = dict(ok=True, ids=ids, created=created, updated=updated, deleted=deleted)
+    if data.get("refreshAi"):
+        try:
+            out["aiJobId"] = enqueue_day_ai_job(trip_id, day, g.email)
+        except Exception as e:
+            # 寫入成功，但 AI 任務排不進去
+            out["aiError"] = str(e)
+    return jsonify(out)
+
 
 # ===== 啟動 =====
 if __name__ == "__main__":
+    import sys
+    if "migrate-trip-members" in sys.argv[1:]:
+        print("trips updated:", backfill_trip_members())
+        sys.exit(0)
+    if "compact-tombstones" in sys.argv[1:]:
+        print("tombstones deleted:", compact_tombstones())
+        sys.exit(0)
+    if "migrate-stop-trip-ids" in sys.argv[1:]:
+        print("stops updated:", backfill_stop_trip_ids())
+        sys.exit(0)
+    if "migrate-photo-paths" in sys.argv[1:]:
+        print("photo docs updated:", migrate_photo_paths())
+        sys.exit(0)
+    if "bench-feasibility" in sys.argv[1:]:
+        for n in (10, 100, 300):
+            print(f"feasibility n={n}: {bench_day_feasibility(n):.3f} ms")
+        sys.exit(0)
+
+    try:
+        resume_pending_ai_jobs()
+    except Exception as e:
+        print("resume_pending_ai_jobs failed:", e)
+    try:
+        resume_pending_delete_jobs()
+    except Exception as e:
+        print("resume_pending_delete_jobs failed:", e)
     app.run(host="0.0.0.0", port=5000, debug=True, use_reloader=False)
 